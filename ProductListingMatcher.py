@@ -20,8 +20,32 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import argparse
+import array
+import collections
+import contextlib
+import datetime
+import decimal
+import functools
+import glob
+import heapq
+import importlib.util
+import io
+import json
 import logging
+import math
+import mmap
+import os
+import queue
+import re
+import signal
+import stat
 import sys
+import tempfile
+import threading
+import time
+
+# modules only needed by some features, such as asyncio, NumPy, multiprocessing and the
+# profilers, are imported where they are used so that small runs start quickly
 
 
 def main():
@@ -37,89 +61,3706 @@ def main():
         return e.exit_code
     else:
         try:
-            app.run()
-        except app.Error as e:
-            print("ERROR: {}".format(e))
-            return 1
+            app.run()
+        except app.Error as e:
+            print("ERROR: {}".format(e))
+            return 1
+        else:
+            return 0
+
+
+class ProductListingMatcher:
+
+    def __init__(self, products_path, listings_path, logger, jobs=1, output_path="results.txt",
+                 stats_json_path=None, progress_interval=None, profiler=None,
+                 index_cache_dir=None, state_path=None, serve=False, socket_path=None,
+                 price_filter_ratio=None, json_backend="auto", engine="token",
+                 dedup_cache_size=None, dedup_parse=False, pipeline_queue_size=None,
+                 columnar=False,
+                 audit_path=None, audit_sample_rate=None, audit_products=None,
+                 audit_manufacturers=None):
+        self.products_path = products_path
+        self.listings_path = listings_path
+        self.logger = logger
+        self.jobs = jobs
+        self.output_path = output_path
+        self.stats_json_path = stats_json_path
+        self.progress_interval = progress_interval
+        self.profiler = profiler
+        self.index_cache_dir = index_cache_dir
+        self.state_path = state_path
+        self.state = None
+        self.serve = serve
+        self.socket_path = socket_path
+        self.price_filter_ratio = price_filter_ratio
+        self.json_backend = json_backend
+        self.engine = engine
+        self.dedup_cache_size = dedup_cache_size
+        self.dedup_parse = dedup_parse
+        self.pipeline_queue_size = pipeline_queue_size
+        self.columnar = columnar
+        self.audit_path = audit_path
+        self.audit_sample_rate = audit_sample_rate
+        self.audit_products = audit_products
+        self.audit_manufacturers = audit_manufacturers
+        self.metrics = NullMetrics() if stats_json_path is None else Metrics()
+
+    def run(self):
+        func = self.run_server if self.serve else self.run_matching
+        if self.profiler is None:
+            func()
+        else:
+            self.log("Profiling using {}; output file: {}".format(
+                self.profiler.NAME, self.profiler.output_path))
+            try:
+                self.profiler.run(func)
+            except OSError as e:
+                raise self.Error("unable to write profile: {} ({})".format(
+                    self.profiler.output_path, e))
+
+    def run_matching(self):
+        if self.state_path is not None:
+            self.state = self.load_state()
+        index = self.load_index()
+        products = index.products
+        incremental = self.state is not None
+        if self.price_filter_ratio is None:
+            price_filter = None
+        else:
+            price_filter = PriceFilter(self.price_filter_ratio)
+        with ResultsWriter(self.output_path, products, skip_unmatched=incremental,
+                           price_filter=price_filter) as writer:
+            reader = self.create_listings_reader()
+            if self.audit_path is None:
+                self.match_listings(index, writer, reader)
+                self.write_results(writer)
+            else:
+                try:
+                    with self.create_auditor(index, price_filter) as auditor:
+                        self.match_listings(index, writer, reader, auditor)
+                        self.write_results(writer)
+                except MatchAuditor.Error as e:
+                    raise self.Error(e)
+                self.log("Wrote {} audit records to file: {}".format(
+                    auditor.record_count, self.audit_path))
+                self.metrics.increment("listings_audited", auditor.record_count)
+        if incremental:
+            self.save_state(reader, writer)
+        if self.stats_json_path is not None:
+            self.write_stats_json()
+
+    def run_server(self):
+        index = self.load_index()
+        server = MatchServer(index, self.logger, socket_path=self.socket_path,
+                             load_index=self.load_index, json_backend=self.json_backend)
+        if self.socket_path is None:
+            self.log("Reading listings from stdin")
+        else:
+            self.log("Accepting clients on socket: {}".format(self.socket_path))
+        try:
+            server.run()
+        except OSError as e:
+            raise self.Error("server failed: {}".format(e))
+        self.log_match_stats(server.stats)
+
+    def load_state(self):
+        if not is_plain_file(self.listings_path) and os.path.exists(self.listings_path):
+            raise self.Error("--state-file requires an uncompressed, regular listings file: "
+                             "{}".format(self.listings_path))
+        try:
+            state = IncrementalState.load(self.state_path)
+        except IncrementalState.Error as e:
+            raise self.Error(e)
+        try:
+            products_digest = ProductIndexCache.compute_digest(self.products_path)
+            listings_stat = os.stat(self.listings_path)
+        except OSError as e:
+            raise self.Error("unable to read file: {} ({})".format(e.filename, e.strerror))
+
+        if state is None:
+            self.log("State file {} does not exist; matching all listings".format(
+                self.state_path))
+            state = IncrementalState()
+        else:
+            reason = state.check(products_digest, listings_stat)
+            if reason is not None:
+                self.logger.warning("WARNING: {}; re-matching all listings".format(reason))
+                state = IncrementalState()
+            else:
+                self.log("Resuming from byte {} (line {}) of file: {}".format(
+                    state.listings_offset, state.listings_line_count, self.listings_path))
+
+        state.products_digest = products_digest
+        state.listings_device = listings_stat.st_dev
+        state.listings_inode = listings_stat.st_ino
+        return state
+
+    def save_state(self, reader, writer):
+        state = self.state
+        state.listings_offset = reader.offset
+        state.listings_line_count = reader.line_count
+        for (product, listing_count) in zip(writer.products, writer.listing_counts):
+            if listing_count > 0:
+                state.match_counts[product.name] = (
+                    state.match_counts.get(product.name, 0) + listing_count)
+        self.log("Writing state to file: {}".format(self.state_path))
+        try:
+            state.save(self.state_path)
+        except OSError as e:
+            raise self.Error("unable to write state file: {} ({})".format(
+                self.state_path, e.strerror))
+
+    def load_index(self):
+        if self.index_cache_dir is None:
+            return self.build_index(self.load_products())
+
+        cache = ProductIndexCache(self.index_cache_dir, self.products_path)
+        start_time = time.perf_counter()
+        try:
+            fingerprint = cache.compute_fingerprint()
+        except OSError as e:
+            raise self.Error("unable to read file: {} ({})".format(self.products_path, e))
+        try:
+            index = cache.load(fingerprint)
+        except cache.Error as e:
+            self.logger.warning("WARNING: ignoring product index cache: {}".format(e))
+            index = None
+
+        if index is not None:
+            index.set_engine(self.engine)
+            elapsed_time = time.perf_counter() - start_time
+            self.metrics.add_time("load_index_cache", elapsed_time)
+            self.log("Loaded index of {} products from cache file {} in {:.3f} seconds".format(
+                len(index.products), cache.path, elapsed_time))
+            return index
+
+        index = self.build_index(self.load_products())
+        try:
+            cache.save(fingerprint, index)
+        except OSError as e:
+            self.logger.warning("WARNING: unable to write product index cache: {} ({})".format(
+                cache.path, e))
+        else:
+            self.log("Saved product index to cache file: {}".format(cache.path))
+        return index
+
+    def load_products(self):
+        reader = ProductsReader(self.products_path, self.logger, json_backend=self.json_backend)
+        self.log("Reading products from file: {}".format(self.products_path))
+        with self.metrics.timer("load_products"):
+            try:
+                products = list(reader)
+            except reader.Error as e:
+                raise self.Error(e)
+        reader.log_summary()
+        self.metrics.increment("products_read", len(products))
+        self.metrics.increment("product_parse_failures", reader.error_count)
+        return products
+
+    def build_index(self, products):
+        start_time = time.perf_counter()
+        index = ProductIndex(products, engine=self.engine)
+        elapsed_time = time.perf_counter() - start_time
+        self.metrics.add_time("index", elapsed_time)
+        self.log("Built {} index of {} keys for {} products of {} manufacturers "
+                 "in {:.3f} seconds".format(index.engine, index.key_count(), len(products),
+                                            len(index.manufacturers), elapsed_time))
+        return index
+
+    def create_listings_reader(self):
+        reader = ListingsReader(self.listings_path, self.logger, json_backend=self.json_backend)
+        reader.metrics = self.metrics
+        if self.dedup_cache_size is not None and self.dedup_parse:
+            reader.set_dedup_cache_size(self.dedup_cache_size)
+        if self.state is not None:
+            reader.start_offset = self.state.listings_offset
+            reader.line_count = self.state.listings_line_count
+            reader.complete_lines_only = True
+        return reader
+
+    def create_auditor(self, index, price_filter):
+        try:
+            auditor = MatchAuditor(
+                self.audit_path, index, sample_rate=self.audit_sample_rate,
+                products=self.audit_products, manufacturers=self.audit_manufacturers,
+                price_filter=price_filter)
+        except MatchAuditor.Error as e:
+            raise self.Error(e)
+        for name in auditor.unknown_names:
+            self.logger.warning("WARNING: not auditing unknown product or manufacturer: "
+                                "{}".format(name))
+        return auditor
+
+    def match_listings(self, index, writer, reader=None, auditor=None):
+        if reader is None:
+            reader = self.create_listings_reader()
+        self.log("Reading listings from file: {}".format(self.listings_path))
+        stats = MatchStats(collect_histogram=self.metrics.enabled)
+        if self.progress_interval is not None:
+            reader.progress = ProgressReporter(self.logger, self.progress_interval, reader, stats)
+        index.set_dedup_cache_size(self.dedup_cache_size)
+
+        if self.jobs > 1 and auditor is None:
+            parallel_matcher = ParallelMatcher(
+                index, self.jobs, metrics=self.metrics, profiler=self.profiler,
+                columnar=self.columnar)
+        else:
+            parallel_matcher = None
+
+        dedup_cache_info = reader.dedup_cache_info()
+        try:
+            if auditor is not None:
+                self.log("Auditing {:g} of the selected listings; matching serially".format(
+                    auditor.sample_rate))
+                self.match_listings_audited(index, writer, reader, stats, auditor)
+            elif (parallel_matcher is not None and writer.price_filter is None
+                    and is_plain_file(reader.path)):
+                # the price filter needs every matched listing, so it only works with the
+                # parallel path that sends the listings back to this process; compressed
+                # files and stdin cannot be split into byte ranges, so they use it too
+                self.log("Matching byte ranges of the listings using {} worker processes".format(
+                    self.jobs))
+                parallel_matcher.match_ranges(reader, writer, stats)
+            elif parallel_matcher is None and self.pipeline_queue_size is not None:
+                self.log("Matching listings in a pipeline of threads, queueing up to {} batches "
+                         "of {} lines between stages".format(
+                             self.pipeline_queue_size, Pipeline.DEFAULT_BATCH_SIZE))
+                self.match_listings_pipelined(index, writer, reader, stats)
+            else:
+                if parallel_matcher is not None:
+                    self.log("Matching listings using {} worker processes".format(self.jobs))
+                    matches = parallel_matcher.match(reader, stats)
+                elif self.columnar:
+                    matches = self.match_listing_batches(index, reader, stats)
+                else:
+                    matches = index.match_listings(reader, stats, self.metrics)
+                if self.metrics.enabled:
+                    self.add_matches_timed(matches, writer)
+                else:
+                    for (product_index, listing) in matches:
+                        writer.add(product_index, listing)
+        except (reader.Error, MatchAuditor.Error) as e:
+            raise self.Error(e)
+        except OSError as e:
+            raise self.Error("unable to write temporary results file: {}".format(e))
+
+        # only non-zero for the serial path; the workers count their own parses
+        stats.add_dedup_cache_info(dedup_cache_info, reader.dedup_cache_info())
+        reader.log_summary()
+        self.log_match_stats(stats)
+        self.metrics.add_match_stats(reader, stats)
+        return stats
+
+    def match_listings_audited(self, index, writer, reader, stats, auditor):
+        # a separate loop, so that matching without an audit file does not pay for it
+        cache_info = index.find_title_keys.cache_info()
+        track_sequences = writer.price_filter is not None
+        for (line_number, line) in reader.read_lines():
+            try:
+                listing = reader.parse_line(line)
+            except reader.ParseError as e:
+                reader.on_parse_error(line_number, e)
+                continue
+            product_index = index.match_listing(listing, stats)
+            if product_index is None:
+                auditor.audit(line_number, listing)
+            else:
+                sequence = writer.sequence if track_sequences else None
+                writer.add(product_index, listing)
+                auditor.audit(line_number, listing, sequence)
+        stats.add_title_cache_info(cache_info, index.find_title_keys.cache_info())
+
+    def match_listing_batches(self, index, reader, stats):
+        # yields (product index, listing) like ProductIndex.match_listings(), parsing and
+        # matching ListingBatches so that only the matched listings become Listing objects
+        perf_counter = time.perf_counter
+        parse_time = 0.0
+        match_time = 0.0
+        cache_info = index.find_title_keys.cache_info()
+        try:
+            for lines in Pipeline.iter_batches(reader.read_lines(), ListingBatch.DEFAULT_SIZE):
+                start_time = perf_counter()
+                batch = reader.parse_batch(lines)
+                parse_end_time = perf_counter()
+                parse_time += parse_end_time - start_time
+                matches = [(product_index, batch.listing(row))
+                           for (product_index, row) in index.match_batch(batch, stats)]
+                match_time += perf_counter() - parse_end_time
+                yield from matches
+        finally:
+            stats.add_title_cache_info(cache_info, index.find_title_keys.cache_info())
+            self.metrics.add_time("parse", parse_time)
+            self.metrics.add_time("match", match_time)
+
+    def match_listings_pipelined(self, index, writer, reader, stats):
+        pipeline = Pipeline(self.pipeline_queue_size)
+
+        if self.columnar:
+            parse_batch = reader.parse_batch
+
+            def match_batch(batch):
+                cache_info = index.find_title_keys.cache_info()
+                matches = [(product_index, batch.listing(row))
+                           for (product_index, row) in index.match_batch(batch, stats)]
+                stats.add_title_cache_info(cache_info, index.find_title_keys.cache_info())
+                return matches
+        else:
+            parse_batch = reader.parse_lines
+
+            def match_batch(listings):
+                return list(index.match_listings(listings, stats))
+
+        batches = pipeline.run(
+            "read", pipeline.iter_batches(reader.read_lines(), pipeline.DEFAULT_BATCH_SIZE),
+            [("parse", parse_batch), ("match", match_batch)], "write")
+        with contextlib.closing(batches):
+            for matches in batches:
+                for (product_index, listing) in matches:
+                    writer.add(product_index, listing)
+
+        self.log_pipeline_stats(pipeline)
+        self.metrics.add_pipeline_stats(pipeline)
+
+    def add_matches_timed(self, matches, writer):
+        perf_counter = time.perf_counter
+        output_time = 0.0
+        try:
+            for (product_index, listing) in matches:
+                start_time = perf_counter()
+                writer.add(product_index, listing)
+                output_time += perf_counter() - start_time
+        finally:
+            self.metrics.add_time("output", output_time)
+
+    def write_results(self, writer):
+        if writer.price_filter is not None:
+            self.filter_prices(writer.price_filter, len(writer.products))
+        self.log("Writing results to file: {} (merging {} run file(s))".format(
+            self.output_path, len(writer.run_paths)))
+        with self.metrics.timer("output"):
+            try:
+                matched_product_count = writer.write()
+            except OSError as e:
+                raise self.Error("unable to write results file: {} ({})".format(
+                    self.output_path, e))
+        self.log("{} of {} products matched at least one listing".format(
+            matched_product_count, len(writer.products)))
+        self.metrics.increment("products_matched", matched_product_count)
+
+    def filter_prices(self, price_filter, product_count):
+        with self.metrics.timer("price_filter"):
+            price_filter.apply(product_count)
+        self.log("Rejected {} of {} matched listings priced below {:g} times the median price "
+                 "of their product".format(price_filter.rejected_count,
+                                           price_filter.listing_count(), price_filter.min_ratio))
+        self.metrics.increment("rejected_price_outlier", price_filter.rejected_count)
+
+    def write_stats_json(self):
+        self.log("Writing statistics to file: {}".format(self.stats_json_path))
+        try:
+            with open(self.stats_json_path, "wt", encoding="utf8") as f:
+                json.dump(self.metrics.to_json_object(), f, indent=2, sort_keys=True)
+                f.write("\n")
+        except OSError as e:
+            raise self.Error("unable to write statistics file: {} ({})".format(
+                self.stats_json_path, e))
+
+    def log_match_stats(self, stats):
+        self.log("Matched {} of {} listings ({} ambiguous, {} unknown manufacturer)".format(
+            stats.matched_count, stats.listing_count, stats.ambiguous_count,
+            stats.unknown_manufacturer_count))
+        self.log("Resolved {} of {} listings matching several products by specificity; "
+                 "{} remain ambiguous".format(
+                     stats.resolved_count, stats.resolved_count + stats.ambiguous_count,
+                     stats.ambiguous_count))
+        self.log("Average candidates per listing: {:.2f}".format(
+            stats.average_candidate_count()))
+        self.log("Title cache: {} hits, {} misses ({:.1%} hit rate)".format(
+            stats.title_cache_hit_count, stats.title_cache_miss_count,
+            stats.title_cache_hit_rate()))
+        if stats.duplicate_count or stats.distinct_count:
+            self.log("Dedup: {} of {} listings were duplicates ({:.1%}); matching the {} "
+                     "distinct listings took {:.3f} seconds and looking up the duplicates "
+                     "{:.3f} seconds".format(
+                         stats.duplicate_count, stats.duplicate_count + stats.distinct_count,
+                         stats.duplicate_ratio(), stats.distinct_count,
+                         stats.distinct_match_seconds, stats.duplicate_seconds))
+        if stats.duplicate_line_count or stats.distinct_line_count:
+            self.log("Dedup: {} of {} lines were identical to a recent line ({:.1%}); parsing "
+                     "the {} distinct lines took {:.3f} seconds".format(
+                         stats.duplicate_line_count,
+                         stats.duplicate_line_count + stats.distinct_line_count,
+                         stats.duplicate_line_ratio(), stats.distinct_line_count,
+                         stats.distinct_parse_seconds))
+        if stats.duplicate_count or stats.duplicate_line_count:
+            self.log("Dedup: reusing the results for the duplicates saved an estimated {:.3f} "
+                     "seconds".format(stats.estimated_dedup_saved_seconds()))
+
+    def log_pipeline_stats(self, pipeline):
+        for stage in pipeline.stages:
+            self.log("Pipeline stage {}: {} batches, busy {:.3f} seconds, stalled {:.3f} "
+                     "seconds waiting for input and {:.3f} seconds waiting for output "
+                     "(queue depth {:.1f} average, {} maximum)".format(
+                         stage.name, stage.batch_count, stage.busy_seconds,
+                         stage.input_stall_seconds, stage.output_stall_seconds,
+                         stage.average_queue_depth(), stage.max_queue_depth))
+
+    def log(self, message):
+        self.logger.info(message)
+
+    class Error(Exception):
+        pass
+
+
+class ArgumentParser(argparse.ArgumentParser):
+
+    def __init__(self):
+        super().__init__()
+        self.add_arguments()
+
+    def add_arguments(self):
+        self.add_argument(
+            "-p", "--products-file",
+            default="products.txt",
+            help="""The path of the file containing the products, one per line; it may be
+            compressed with gzip, bzip2 or zstd (the latter requires the zstandard module), and
+            "-" reads it from stdin (default: %(default)s)"""
+        )
+
+        self.add_argument(
+            "-l", "--listings-file",
+            default="listings.txt",
+            help="""The path of the file containing the listings, one per line; it may be
+            compressed like --products-file, and "-" reads it from stdin; compressed files and
+            stdin are decompressed and read by a background thread (default: %(default)s)"""
+        )
+
+        self.add_argument(
+            "-j", "--jobs",
+            type=positive_int,
+            default=1,
+            help="""The number of processes to use to match listings; with more than one, the
+            listings file is divided into byte ranges, each read, parsed and matched by one of a
+            pool of worker processes (default: %(default)s)"""
+        )
+
+        self.add_argument(
+            "-o", "--output-file",
+            default="results.txt",
+            help="""The path of the file to which to write the results, one product per line
+            (default: %(default)s)"""
+        )
+
+        self.add_argument(
+            "--price-filter",
+            nargs="?",
+            type=positive_float,
+            const=PriceFilter.DEFAULT_MIN_RATIO,
+            default=None,
+            metavar="RATIO",
+            help="""Reject matched listings priced below RATIO times the median price of the
+            listings matched to the same product, after converting to a common currency; this
+            drops most accessories whose titles mention a camera's model; requires NumPy
+            (default if specified without a value: %(const)s)"""
+        )
+
+        self.add_argument(
+            "--serve",
+            action="store_true",
+            default=False,
+            help="""Run as a server: load the products once, then read listings as JSON lines
+            from stdin, or from clients of the socket specified by --socket, and write back one
+            JSON line per listing naming the matched product; the products are reloaded on
+            SIGHUP or a {"command": "reload"} line; log messages are written to stderr and
+            --listings-file, --output-file and --state-file are not used"""
+        )
+
+        self.add_argument(
+            "--socket",
+            default=None,
+            metavar="PATH",
+            help="""The path of the Unix socket on which to accept clients in server mode;
+            implies --serve if specified without it (default: read listings from stdin)"""
+        )
+
+        self.add_argument(
+            "--dedup",
+            nargs="?",
+            type=positive_int,
+            const=ProductIndex.DEFAULT_DEDUP_CACHE_SIZE,
+            default=None,
+            metavar="ENTRIES",
+            help="""Match each distinct listing only once: listings with the same title, up to
+            case and spacing, manufacturer, currency and price as one of the last ENTRIES
+            distinct listings get its product without being matched again, and are all still
+            written to the results; this saves time on feeds that repeat listings, and the
+            duplicate ratio and estimated time saved are logged (default if specified without a
+            value: %(const)s)"""
+        )
+
+        self.add_argument(
+            "--dedup-parse",
+            action="store_true",
+            default=False,
+            help="""With --dedup, also parse each distinct line only once, reusing the listing
+            parsed from an identical line among the last ENTRIES distinct lines"""
+        )
+
+        self.add_argument(
+            "--pipeline",
+            nargs="?",
+            type=positive_int,
+            const=Pipeline.DEFAULT_QUEUE_SIZE,
+            default=None,
+            metavar="BATCHES",
+            help="""Read, parse, match and write the listings in a pipeline of threads, with up
+            to BATCHES batches of {} lines queued between stages, so that reading and writing
+            overlap with matching; the time each stage was busy and stalled is logged, to show
+            which one is the bottleneck. Ignored with --jobs greater than 1, whose worker
+            processes already overlap with reading (default if specified without a value:
+            %(const)s)""".format(Pipeline.DEFAULT_BATCH_SIZE)
+        )
+
+        self.add_argument(
+            "--columnar",
+            action="store_true",
+            default=False,
+            help="""Parse and match the listings in batches held as columns of titles, codes
+            and fixed-point prices, creating listing objects only for the matched listings,
+            rather than one object per listing; both give the same results"""
+        )
+
+        self.add_argument(
+            "--audit-file",
+            default=None,
+            metavar="PATH",
+            help="""The path of a file to which to write, as JSON lines, how a sample of the
+            listings were matched: the model keys found in the title, the candidate products and
+            their scores, how ties were decided and the --price-filter outcome; the listings are
+            then matched by a single process, ignoring --jobs, --pipeline and --columnar
+            (default: no listings are audited)"""
+        )
+
+        self.add_argument(
+            "--audit-sample-rate",
+            type=positive_float,
+            default=None,
+            metavar="RATE",
+            help="""The fraction of the selected listings to audit with --audit-file, chosen at
+            random (default: {})""".format(MatchAuditor.DEFAULT_SAMPLE_RATE)
+        )
+
+        self.add_argument(
+            "--audit-product",
+            action="append",
+            default=None,
+            metavar="NAME",
+            help="""Select for --audit-file only the listings with the named product among their
+            candidates; may be specified more than once (default: all listings are selected)"""
+        )
+
+        self.add_argument(
+            "--audit-manufacturer",
+            action="append",
+            default=None,
+            metavar="NAME",
+            help="""Select for --audit-file only the listings of the named manufacturer; may be
+            specified more than once (default: all listings are selected)"""
+        )
+
+        self.add_argument(
+            "--engine",
+            choices=list(ProductIndex.ENGINES),
+            default="token",
+            help="""How to find the product models in listing titles: "token" probes a hash
+            table with each run of adjacent title tokens, "automaton" scans each title once with
+            an Aho-Corasick automaton of all the models (using the pyahocorasick module if it is
+            installed); both give the same results (default: %(default)s)"""
+        )
+
+        self.add_argument(
+            "--json-backend",
+            choices=["auto"] + list(JSON_BACKENDS),
+            default="auto",
+            help="""The library with which to decode the JSON lines of the products and listings
+            files; "auto" uses the fastest one installed, trying {} in that order
+            (default: %(default)s)""".format(", ".join(JSON_BACKENDS))
+        )
+
+        self.add_argument(
+            "--index-cache",
+            default=None,
+            metavar="DIR",
+            help="""The directory in which to cache the parsed and indexed products; the cache
+            is used instead of re-reading the products file as long as the products file has not
+            changed (default: no cache is used)"""
+        )
+
+        self.add_argument(
+            "--state-file",
+            default=None,
+            metavar="PATH",
+            help="""Match incrementally: the byte offset of the listings file matched so far and
+            the number of listings matched to each product are recorded in this file, and each
+            run matches only the listings appended since the previous run; the results file then
+            holds only the products that matched newly appended listings. Everything is
+            re-matched if the products file changes or the listings file is replaced or
+            truncated (default: the whole listings file is matched)"""
+        )
+
+        self.add_argument(
+            "--stats-json",
+            default=None,
+            help="""The path of a file to which to write timers, counters and histograms
+            describing the run, in JSON format (default: no statistics are collected)"""
+        )
+
+        self.add_argument(
+            "--progress-interval",
+            type=positive_float,
+            default=None,
+            metavar="SECONDS",
+            help="""Log a progress line at most every SECONDS seconds while reading the
+            listings (default: no progress is logged)"""
+        )
+
+        self.add_argument(
+            "--profile",
+            nargs="?",
+            choices=["cprofile", "sample"],
+            const="cprofile",
+            default=None,
+            help="""Profile the run, writing the profile to the file specified by
+            --profile-output and logging the hottest functions; "cprofile" records every
+            function call, "sample" periodically samples the call stack, which has much lower
+            overhead for long runs (default if specified without a value: %(const)s)"""
+        )
+
+        self.add_argument(
+            "--profile-output",
+            default=None,
+            help="""The path of the file to which to write the profile; with --jobs, each
+            worker process writes its own profile to this path with ".worker-<pid>" appended;
+            implies --profile if specified without it (default: ProductListingMatcher.prof for
+            cprofile, ProductListingMatcher.stacks for sample)"""
+        )
+
+    def parse_args(self, args=None, namespace=None):
+        namespace = self.Namespace(self)
+        super().parse_args(args=args, namespace=namespace)
+        app = namespace.create_application()
+        return app
+
+    def exit(self, status=0, message=None):
+        raise self.Error(message, status)
+
+    def error(self, message):
+        self.exit(2, message)
+
+    class Namespace(argparse.Namespace):
+
+        def __init__(self, parser):
+            self.parser = parser
+
+        def create_application(self):
+            products_path = self.products_file
+            listings_path = self.listings_file
+
+            serve = self.serve or self.socket is not None
+
+            logger = logging.Logger(name=__name__)
+            handler = logging.StreamHandler(sys.stderr if serve else sys.stdout)
+            logger.addHandler(handler)
+
+            profiler = self.create_profiler(logger)
+
+            try:
+                load_json_backend(self.json_backend)
+            except ImportError as e:
+                self.parser.error("--json-backend {}: {}".format(self.json_backend, e))
+
+            if self.price_filter is not None and not is_numpy_installed():
+                self.parser.error("--price-filter requires NumPy, which is not installed")
+
+            if products_path == STDIN_PATH:
+                if listings_path == STDIN_PATH and not serve:
+                    self.parser.error("--products-file and --listings-file cannot both be "
+                                      "read from stdin")
+                if serve:
+                    self.parser.error("--serve requires a --products-file other than stdin, "
+                                      "to be able to reload it")
+                if self.index_cache is not None:
+                    self.parser.error("--index-cache requires a --products-file other than "
+                                      "stdin")
+            if listings_path == STDIN_PATH and self.state_file is not None and not serve:
+                self.parser.error("--state-file requires a --listings-file other than stdin")
+            if self.dedup_parse and self.dedup is None:
+                self.parser.error("--dedup-parse requires --dedup")
+
+            if self.audit_file is None:
+                for (name, value) in [
+                    ("--audit-sample-rate", self.audit_sample_rate),
+                    ("--audit-product", self.audit_product),
+                    ("--audit-manufacturer", self.audit_manufacturer),
+                ]:
+                    if value is not None:
+                        self.parser.error("{} requires --audit-file".format(name))
+            elif serve:
+                self.parser.error("--audit-file cannot be used with --serve")
+            if self.audit_sample_rate is not None and self.audit_sample_rate > 1:
+                self.parser.error("--audit-sample-rate must not be greater than 1: {:g}".format(
+                    self.audit_sample_rate))
+
+            return ProductListingMatcher(
+                products_path,
+                listings_path,
+                logger,
+                jobs=self.jobs,
+                output_path=self.output_file,
+                stats_json_path=self.stats_json,
+                progress_interval=self.progress_interval,
+                profiler=profiler,
+                index_cache_dir=self.index_cache,
+                state_path=self.state_file,
+                serve=serve,
+                socket_path=self.socket,
+                price_filter_ratio=self.price_filter,
+                json_backend=self.json_backend,
+                engine=self.engine,
+                dedup_cache_size=self.dedup,
+                dedup_parse=self.dedup_parse,
+                pipeline_queue_size=self.pipeline,
+                columnar=self.columnar,
+                audit_path=self.audit_file,
+                audit_sample_rate=self.audit_sample_rate,
+                audit_products=self.audit_product,
+                audit_manufacturers=self.audit_manufacturer,
+            )
+
+        def create_profiler(self, logger):
+            profile = self.profile
+            if profile is None:
+                if self.profile_output is None:
+                    return None
+                profile = "cprofile"
+
+            if profile == "sample":
+                if not SamplingProfiler.is_supported():
+                    self.parser.error("--profile sample is not supported on this platform")
+                profiler_class = SamplingProfiler
+            else:
+                profiler_class = CProfileProfiler
+
+            output_path = self.profile_output
+            if output_path is None:
+                output_path = profiler_class.DEFAULT_OUTPUT_PATH
+            return profiler_class(output_path, logger=logger)
+
+    class Error(Exception):
+
+        def __init__(self, message, exit_code):
+            super().__init__(message)
+            self.exit_code = exit_code
+
+
+def positive_int(s):
+    try:
+        value = int(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid integer: {}".format(s))
+    if value < 1:
+        raise argparse.ArgumentTypeError("must be greater than zero: {}".format(s))
+    return value
+
+
+def positive_float(s):
+    try:
+        value = float(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid number: {}".format(s))
+    if not value > 0:
+        raise argparse.ArgumentTypeError("must be greater than zero: {}".format(s))
+    return value
+
+
+JSON_BACKENDS = ("orjson", "simdjson", "json")
+JSON_BACKENDS_ACCEPTING_MEMORYVIEW = frozenset(["orjson", "simdjson"])
+
+
+def load_json_backend(name):
+    """
+    Returns (name, loads) for the named JSON backend; loads() accepts bytes and raises
+    ValueError if they are not valid JSON, or RecursionError if they are nested too deeply.
+
+    "auto" selects the first of JSON_BACKENDS that is installed. Raises ImportError if the
+    named backend is not installed. loads() may keep state between calls, so each reader calls
+    this to get its own.
+    """
+    if name == "auto":
+        for backend_name in JSON_BACKENDS:
+            try:
+                return load_json_backend(backend_name)
+            except ImportError:
+                pass
+    elif name == "orjson":
+        import orjson
+        return (name, orjson.loads)
+    elif name == "simdjson":
+        import simdjson
+        # reusing a parser is much faster than simdjson.loads(), which creates one per call
+        return (name, functools.partial(simdjson.Parser().parse, recursive=True))
+    elif name == "json":
+        return (name, json.loads)
+    raise ValueError("unknown JSON backend: {}".format(name))
+
+
+STDIN_PATH = "-"
+COMPRESSION_EXTENSIONS = {".gz": "gzip", ".bz2": "bz2", ".zst": "zstd"}
+COMPRESSION_MAGIC_NUMBERS = {b"\x1f\x8b": "gzip", b"BZh": "bz2", b"\x28\xb5\x2f\xfd": "zstd"}
+
+
+def detect_compression(path, head):
+    """
+    Returns the compression format of a file, "gzip", "bz2" or "zstd", or None if it is not
+    compressed. The format is taken from the extension of path or, failing that, from head,
+    the first bytes of the file, so that compressed data piped to stdin is detected too.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    compression = COMPRESSION_EXTENSIONS.get(extension)
+    if compression is not None:
+        return compression
+    for (magic_number, compression) in COMPRESSION_MAGIC_NUMBERS.items():
+        if head.startswith(magic_number):
+            return compression
+    return None
+
+
+def open_input(path, chunk_size):
+    """
+    Opens a file for reading in binary mode, STDIN_PATH meaning stdin, and returns
+    (f, compression) where f reads the decompressed contents of the file and compression is as
+    returned by detect_compression().
+
+    Compressed files and stdin are read, and decompressed, by a BackgroundReader thread, so
+    that this overlaps with processing their contents. Other files are read directly and f is
+    seekable. Raises ImportError if the file is zstd-compressed and the zstandard module is
+    not installed.
+    """
+    if path == STDIN_PATH:
+        raw = open(sys.stdin.fileno(), "rb", buffering=0, closefd=False)
+    else:
+        raw = open(path, "rb", buffering=0)
+    try:
+        f = io.BufferedReader(raw, buffer_size=chunk_size)
+        compression = detect_compression(path, f.peek(4))
+        if compression == "gzip":
+            import gzip
+            f = gzip.GzipFile(fileobj=f, mode="rb")
+        elif compression == "bz2":
+            import bz2
+            f = bz2.BZ2File(f, mode="rb")
+        elif compression == "zstd":
+            import zstandard
+            f = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+        if compression is not None or path == STDIN_PATH:
+            f = BackgroundReader(f, raw, chunk_size)
+    except BaseException:
+        raw.close()
+        raise
+    return (f, compression)
+
+
+def is_plain_file(path):
+    """
+    Returns whether a file is an uncompressed regular file, whose lines can be read starting
+    at any byte offset, as opposed to stdin, a pipe or a compressed file.
+    """
+    if path == STDIN_PATH:
+        return False
+    try:
+        with open(path, "rb") as f:
+            if not stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+                return False
+            head = f.read(4)
+    except OSError:
+        return False
+    return detect_compression(path, head) is None
+
+
+class BackgroundReader:
+    """
+    Reads a binary file in a background thread, so that reading it, and decompressing it in
+    the case of a decompressing file object, overlaps with processing the data read.
+
+    read() returns the chunks of up to chunk_size bytes read by the thread, and then b"" at the
+    end of the file; the thread stays at most MAX_QUEUED_CHUNKS chunks ahead. Errors raised in
+    the thread are raised from read() as OSError. raw is the underlying file, which is closed
+    along with f.
+    """
+
+    MAX_QUEUED_CHUNKS = 4
+
+    def __init__(self, f, raw, chunk_size):
+        self.f = f
+        self.raw = raw
+        self.chunk_size = chunk_size
+        self.chunks = queue.Queue(self.MAX_QUEUED_CHUNKS)
+        self.stopping = threading.Event()
+        self.eof = False
+        self.thread = threading.Thread(target=self.run, name="BackgroundReader", daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def run(self):
+        try:
+            while not self.stopping.is_set():
+                chunk = self.f.read(self.chunk_size)
+                self.put(chunk)
+                if not chunk:
+                    break
+        except Exception as e:
+            # decompressors raise EOFError, zlib.error, zstandard.ZstdError, etc. for corrupt
+            # data, so everything is handed to the reading thread to be reported there
+            self.put(e)
+
+    def put(self, item):
+        while not self.stopping.is_set():
+            try:
+                self.chunks.put(item, timeout=0.1)
+            except queue.Full:
+                pass
+            else:
+                return
+
+    def read(self, size=-1):
+        if self.eof:
+            return b""
+        item = self.chunks.get()
+        if isinstance(item, Exception):
+            self.eof = True
+            if isinstance(item, OSError):
+                raise item
+            raise OSError(str(item) or type(item).__name__) from item
+        if not item:
+            self.eof = True
+        return item
+
+    def seekable(self):
+        return False
+
+    def close(self):
+        self.stopping.set()
+        self.thread.join()
+        try:
+            self.f.close()
+        finally:
+            self.raw.close()
+
+
+class JsonLinesReader:
+
+    MAX_LOGGED_ERRORS = 10
+    CHUNK_SIZE = 1024 * 1024
+    DEFAULT_DEDUP_CACHE_SIZE = 65536
+
+    def __init__(self, path, logger, json_backend="auto"):
+        self.path = path
+        self.logger = logger
+        (self.json_backend, self.json_loads) = load_json_backend(json_backend)
+        self.line_count = 0
+        self.error_count = 0
+        self.metrics = NullMetrics()
+        self.progress = None
+        self.start_offset = 0
+        self.offset = 0
+        self.complete_lines_only = False
+        self.compression = None
+        self.dedup_cache_size = None
+        # the time spent parsing the distinct lines, to estimate the time saved by the dedup
+        # cache
+        self.distinct_parse_seconds = 0.0
+
+    def __iter__(self):
+        if self.metrics.enabled:
+            return self.iter_timed()
+        return self.iter_untimed()
+
+    def iter_untimed(self):
+        for (line_number, line) in self.read_lines():
+            try:
+                obj = self.parse_line(line)
+            except self.ParseError as e:
+                self.on_parse_error(line_number, e)
+            else:
+                yield obj
+
+    def iter_timed(self):
+        perf_counter = time.perf_counter
+        parse_time = 0.0
+        try:
+            for (line_number, line) in self.read_lines():
+                start_time = perf_counter()
+                try:
+                    obj = self.parse_line(line)
+                except self.ParseError as e:
+                    parse_time += perf_counter() - start_time
+                    self.on_parse_error(line_number, e)
+                else:
+                    parse_time += perf_counter() - start_time
+                    yield obj
+        finally:
+            self.metrics.add_time("parse", parse_time)
+
+    def read_lines(self):
+        lines = self.read_raw_lines()
+        if self.metrics.enabled:
+            lines = timed_iter(lines, self.metrics, "read")
+        if self.progress is not None:
+            lines = self.progress.track(lines)
+        return lines
+
+    def read_raw_lines(self):
+        """
+        Yields (line number, line) for each non-blank line, starting at byte offset start_offset.
+
+        The file is read in binary chunks of CHUNK_SIZE bytes which are split into lines, and the
+        lines are yielded undecoded and without their newlines: the JSON backend decodes them,
+        so invalid UTF-8 is a parse error of that line only. The file may be compressed, or be
+        stdin, as handled by open_input(); offsets are then those of the decompressed data, and
+        start_offset must be 0. The offset attribute is kept at the end of the last line read.
+        If complete_lines_only is true then a final line without a trailing newline is not
+        read, since it may be a listing still being appended to the file.
+        """
+        try:
+            (f, self.compression) = open_input(self.path, self.CHUNK_SIZE)
+        except ImportError as e:
+            raise self.Error("unable to decompress file: {} ({})".format(self.path, e))
+        except OSError as e:
+            raise self.Error("unable to open file: {} ({})".format(self.path, e.strerror))
+
+        with f:
+            try:
+                if self.start_offset:
+                    if not f.seekable():
+                        raise self.Error("unable to resume reading from byte {} of file: {} "
+                                         "(compressed files and stdin can only be read from "
+                                         "the start)".format(self.start_offset, self.path))
+                    f.seek(self.start_offset)
+                self.offset = self.start_offset
+                read = functools.partial(f.read, self.CHUNK_SIZE)
+                remainder = b""
+                for chunk in iter(read, b""):
+                    lines = chunk.split(b"\n")
+                    if remainder:
+                        lines[0] = remainder + lines[0]
+                    remainder = lines.pop()
+                    # the offset is only updated per chunk, since it is not needed in between
+                    line_number = self.line_count
+                    for line in lines:
+                        line_number += 1
+                        if line and not line.isspace():
+                            self.line_count = line_number
+                            yield (line_number, line)
+                    self.line_count = line_number
+                    self.offset += len(chunk)
+                self.offset -= len(remainder)
+                if remainder and not self.complete_lines_only:
+                    self.offset += len(remainder)
+                    self.line_count += 1
+                    if not remainder.isspace():
+                        yield (self.line_count, remainder)
+            except OSError as e:
+                raise self.Error("error reading file: {} ({})".format(self.path, e))
+
+    def parse_line(self, line):
+        return self.parse_object(self.decode_line(line))
+
+    def set_dedup_cache_size(self, size):
+        """
+        Parses each distinct line only once: the objects parsed from the last size distinct
+        lines are kept in an LRU cache keyed by the bytes of the line, and returned again for
+        identical lines. Feeds that repeat listings, such as the same item offered by several
+        sellers, then skip parsing the exact repeats; ProductIndex.set_dedup_cache_size() skips
+        matching them, and their near repeats. Malformed lines are not cached. None disables
+        the cache.
+        """
+        self.dedup_cache_size = size
+        self.__dict__.pop("parse_line", None)
+        if size is not None:
+            self.parse_line = functools.lru_cache(size)(self.parse_distinct_line)
+
+    def parse_distinct_line(self, line):
+        start_time = time.perf_counter()
+        try:
+            # the method itself, since parse_line() is this object's caching replacement
+            return type(self).parse_line(self, line)
+        finally:
+            self.distinct_parse_seconds += time.perf_counter() - start_time
+
+    def dedup_cache_info(self):
+        """
+        Returns a snapshot of the (hits, misses, seconds spent parsing the misses) of the dedup
+        cache, or None if it is disabled; MatchStats add_dedup_cache_info() adds the difference
+        between two snapshots.
+        """
+        if self.dedup_cache_size is None:
+            return None
+        cache_info = self.parse_line.cache_info()
+        return (cache_info.hits, cache_info.misses, self.distinct_parse_seconds)
+
+    def parse_lines(self, lines):
+        """
+        Returns the objects parsed from a list of (line number, line), as read by read_lines(),
+        skipping malformed lines as iteration does.
+        """
+        objs = []
+        for (line_number, line) in lines:
+            try:
+                objs.append(self.parse_line(line))
+            except self.ParseError as e:
+                self.on_parse_error(line_number, e)
+        return objs
+
+    def decode_line(self, line):
+        try:
+            obj = self.json_loads(line)
+        except (ValueError, RecursionError) as e:
+            # the json backend raises RecursionError for deeply nested lines
+            raise self.ParseError("invalid JSON: {}".format(e))
+        if not isinstance(obj, dict):
+            raise self.ParseError("JSON object expected")
+        return obj
+
+    def parse_object(self, obj):
+        raise NotImplementedError()
+
+    def on_parse_error(self, line_number, error):
+        self.error_count += 1
+        if self.error_count <= self.MAX_LOGGED_ERRORS:
+            self.logger.warning("WARNING: {}:{}: {}".format(self.path, line_number, error))
+        if self.error_count == self.MAX_LOGGED_ERRORS:
+            self.logger.warning(
+                "WARNING: {}: further parse errors will not be logged".format(self.path))
+
+    def log_summary(self):
+        if self.error_count > 0:
+            self.logger.warning("WARNING: {}: skipped {} malformed line(s) of {}".format(
+                self.path, self.error_count, self.line_count))
+
+    @classmethod
+    def get_string(cls, obj, key, optional=False):
+        try:
+            value = obj[key]
+        except KeyError:
+            if optional:
+                return None
+            raise cls.ParseError("missing key: {}".format(key))
+        if not isinstance(value, str):
+            raise cls.ParseError("string expected for key: {}".format(key))
+        return value
+
+    class Error(Exception):
+        pass
+
+    class ParseError(Exception):
+        pass
+
+
+class ProductsReader(JsonLinesReader):
+
+    def parse_object(self, obj):
+        name = self.get_string(obj, "product_name")
+        manufacturer = sys.intern(self.get_string(obj, "manufacturer"))
+        model = self.get_string(obj, "model")
+        family = self.get_string(obj, "family", optional=True)
+        if family is not None:
+            family = sys.intern(family)
+        announced_date_str = self.get_string(obj, "announced-date")
+        try:
+            announced_date = parse_announced_date(announced_date_str)
+        except ValueError:
+            raise self.ParseError("invalid announced-date: {}".format(announced_date_str))
+        return Product(name, manufacturer, model, family, announced_date)
+
+
+class ListingsReader(JsonLinesReader):
+
+    def parse_object(self, obj):
+        title = self.get_string(obj, "title")
+        manufacturer = sys.intern(self.get_string(obj, "manufacturer"))
+        currency = sys.intern(self.get_string(obj, "currency"))
+        price_str = self.get_string(obj, "price")
+        try:
+            price = decimal.Decimal(price_str)
+        except decimal.InvalidOperation:
+            raise self.ParseError("invalid price: {}".format(price_str))
+        if not price.is_finite():
+            raise self.ParseError("invalid price: {}".format(price_str))
+        return Listing(title, manufacturer, currency, price)
+
+    def parse_batch(self, lines, on_parse_error=None):
+        """
+        Returns a ListingBatch of the listings parsed from a list of (line number, line), as
+        read by read_lines(), passing the line number and ParseError of each malformed line to
+        on_parse_error, by default that of this reader.
+
+        Only listings whose fields are all strings and whose price is a plain decimal number
+        take the fast path of ListingBatch.append(); the others are parsed by parse_object(),
+        so they get the same Listing, or the same error, as they would without batches. With
+        the dedup cache every line is parsed by parse_line(), to use the cache.
+        """
+        if on_parse_error is None:
+            on_parse_error = self.on_parse_error
+        batch = ListingBatch()
+        append = batch.append
+        decode_line = self.decode_line
+        dedup = self.dedup_cache_size is not None
+        for (line_number, line) in lines:
+            try:
+                if dedup:
+                    batch.append_listing(line_number, self.parse_line(line))
+                    continue
+                obj = decode_line(line)
+                title = obj.get("title")
+                manufacturer = obj.get("manufacturer")
+                currency = obj.get("currency")
+                price_str = obj.get("price")
+                if not (type(title) is str and type(manufacturer) is str
+                        and type(currency) is str and type(price_str) is str
+                        and append(line_number, title, manufacturer, currency, price_str)):
+                    batch.append_listing(line_number, self.parse_object(obj))
+            except self.ParseError as e:
+                on_parse_error(line_number, e)
+        return batch
+
+
+def parse_announced_date(s):
+    # e.g. "2010-01-06T19:00:00.000-05:00"; normalized to a naive datetime in UTC
+    value = datetime.datetime.strptime(s, "%Y-%m-%dT%H:%M:%S.%f%z")
+    value = value.astimezone(datetime.timezone.utc)
+    return value.replace(tzinfo=None)
+
+
+TOKEN_SEPARATOR_REGEX = re.compile(r"[\W_]+")
+
+
+def tokenize(s):
+    return [token for token in TOKEN_SEPARATOR_REGEX.split(s.lower()) if token]
+
+
+# the runs of letters and of digits of a model key, e.g. "dsc", "w" and "310" of "dscw310"
+MODEL_KEY_PART_REGEX = re.compile(r"\d+|[^\W\d_]+")
+
+
+MANUFACTURER_ALIASES = {
+    "fuji": "fujifilm",
+    "fuji photo": "fujifilm",
+    "fuji photo film": "fujifilm",
+    "fujifilm": "fujifilm",
+    "hewlett packard": "hp",
+    "hp": "hp",
+    "konica": "konica minolta",
+    "konica minolta": "konica minolta",
+    "minolta": "konica minolta",
+    "eastman kodak": "kodak",
+    "kodak": "kodak",
+    "general electric": "ge",
+    "ge": "ge",
+}
+
+
+class ManufacturerTable:
+    """
+    Maps free-text manufacturer names onto small integer IDs.
+
+    A name is normalized to its tokens and looked up in the alias dictionary, first in full and
+    then by successively shorter token prefixes, so "Canon Canada" resolves to the ID of
+    "Canon" and "FUJI PHOTO FILM CO" to the ID of "Fujifilm". Only manufacturers of known
+    products get an ID. Lookups are memoized by the raw name, because listing feeds repeat a
+    small set of manufacturer strings.
+    """
+
+    MAX_CACHE_SIZE = 100000
+
+    def __init__(self, aliases=None):
+        self.aliases = MANUFACTURER_ALIASES if aliases is None else aliases
+        self.ids = {}
+        self.names = []
+        self.cache = {}
+
+    def add(self, manufacturer):
+        name = " ".join(tokenize(manufacturer))
+        canonical_name = self.aliases.get(name, name)
+        try:
+            return self.ids[canonical_name]
+        except KeyError:
+            pass
+
+        manufacturer_id = len(self.names)
+        self.names.append(canonical_name)
+        self.ids[canonical_name] = manufacturer_id
+        for (alias, alias_canonical_name) in self.aliases.items():
+            if alias_canonical_name == canonical_name:
+                self.ids.setdefault(alias, manufacturer_id)
+        if name:
+            self.ids.setdefault(name, manufacturer_id)
+        self.cache.clear()
+        return manufacturer_id
+
+    def lookup(self, manufacturer):
+        try:
+            return self.cache[manufacturer]
+        except KeyError:
+            pass
+
+        manufacturer_id = None
+        tokens = tokenize(manufacturer)
+        for prefix_length in range(len(tokens), 0, -1):
+            manufacturer_id = self.ids.get(" ".join(tokens[:prefix_length]))
+            if manufacturer_id is not None:
+                break
+
+        if len(self.cache) < self.MAX_CACHE_SIZE:
+            self.cache[manufacturer] = manufacturer_id
+        return manufacturer_id
+
+    def __len__(self):
+        return len(self.names)
+
+
+class ProductMatcher:
+    """
+    The normalized form of a product's model and family, computed once when the index is
+    built so that no per-listing work is spent normalizing products.
+
+    specificity ranks the products matching the same listing: the number of model tokens, then
+    the length of the model key. The model tokens are counted as the runs of letters and of
+    digits of the model key, so that spellings of the same model such as "A1200" and "A-1200"
+    count the same. The model of a candidate always matches in full, so adding the number of
+    family tokens found in the title gives its number of matched tokens.
+    """
+
+    __slots__ = ("product_index", "model_tokens", "model_key", "family_tokens", "specificity")
+
+    def __init__(self, product_index, product):
+        self.product_index = product_index
+        self.model_tokens = tuple(tokenize(product.model))
+        self.model_key = "".join(self.model_tokens)
+        if product.family is None:
+            self.family_tokens = ()
+        else:
+            self.family_tokens = tuple(tokenize(product.family))
+        self.specificity = (len(MODEL_KEY_PART_REGEX.findall(self.model_key)),
+                            len(self.model_key))
+
+    def score(self, title_tokens):
+        """
+        Returns (number of matched tokens, model key length) for a title, given as the set of
+        its tokens, of which this product is a candidate.
+        """
+        (model_token_count, model_key_length) = self.specificity
+        token_count = model_token_count
+        for token in self.family_tokens:
+            if token in title_tokens:
+                token_count += 1
+        return (token_count, model_key_length)
+
+
+class ProductIndex:
+    """
+    An inverted index from normalized model strings to products, partitioned by manufacturer.
+
+    Each product is indexed under the concatenation of the tokens of its model (e.g. "DSC-W310"
+    is indexed as "dscw310") in the bucket of its canonical manufacturer. A listing is first
+    mapped to its manufacturer's bucket and rejected outright if the manufacturer is unknown;
+    otherwise the bucket is probed with the model keys found in the title, which are the joins
+    of runs of adjacent title tokens up to the longest model token count, so "DSC W310",
+    "DSC-W310" and "DSCW310" all probe the same key.
+
+    The model keys of a title are computed once per distinct title and kept in an LRU cache,
+    since listing feeds repeat identical titles a lot.
+
+    A listing matching several products, e.g. "Canon EOS 550D Kit" matching both the "550D"
+    and the "550D Kit" models, goes to the most specific of them (see resolve_ambiguous()) and
+    is only rejected as ambiguous if there is a tie.
+
+    The "automaton" engine finds the same model keys differently: the title tokens are joined
+    and scanned once by an Aho-Corasick automaton of all the model keys, and the occurrences
+    that do not start and end on token boundaries, or span more tokens than the longest model,
+    are dropped. The automaton is not pickled, but rebuilt when the index is unpickled.
+
+    set_dedup_cache_size() makes the index match each distinct listing only once, reusing the
+    outcome for its duplicates; the dedup cache is not pickled either.
+    """
+
+    DEFAULT_TITLE_CACHE_SIZE = 65536
+    DEFAULT_DEDUP_CACHE_SIZE = 65536
+    ENGINES = ("token", "automaton")
+
+    def __init__(self, products, manufacturers=None, title_cache_size=None, engine="token"):
+        self.products = products
+        self.manufacturers = ManufacturerTable() if manufacturers is None else manufacturers
+        if title_cache_size is None:
+            title_cache_size = self.DEFAULT_TITLE_CACHE_SIZE
+        self.title_cache_size = title_cache_size
+        self.matchers = []
+        self.buckets = {}
+        self.model_keys = set()
+        self.max_phrase_length = 1
+
+        for (product_index, product) in enumerate(products):
+            manufacturer_id = self.manufacturers.add(product.manufacturer)
+            matcher = ProductMatcher(product_index, product)
+            self.matchers.append(matcher)
+            if not matcher.model_key:
+                continue
+            postings = self.buckets.setdefault(manufacturer_id, {})
+            postings.setdefault(matcher.model_key, []).append(product_index)
+            self.model_keys.add(matcher.model_key)
+            self.max_phrase_length = max(self.max_phrase_length, len(matcher.model_tokens))
+
+        self.engine = None
+        self.automaton = None
+        self.set_engine(engine)
+        self.dedup_cache_size = None
+        self.dedup_cache = None
+
+    def set_engine(self, engine):
+        if engine not in self.ENGINES:
+            raise ValueError("unknown engine: {}".format(engine))
+        if engine == self.engine:
+            return
+        self.engine = engine
+        if engine == "automaton":
+            self.automaton = create_automaton(self.model_keys)
+        else:
+            self.automaton = None
+        self.create_title_cache()
+
+    def create_title_cache(self):
+        if self.engine == "automaton":
+            find_title_keys = self.find_title_keys_automaton
+        else:
+            find_title_keys = self.find_title_keys_token
+        self.find_title_keys = functools.lru_cache(self.title_cache_size)(find_title_keys)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["find_title_keys"]
+        state["automaton"] = None
+        for name in ("match_listing", "dedup_cache_size", "dedup_cache"):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        engine = state["engine"]
+        self.__dict__.update(state)
+        self.engine = None
+        self.set_engine(engine)
+        self.dedup_cache_size = None
+        self.dedup_cache = None
+
+    def set_dedup_cache_size(self, size):
+        """
+        Matches each distinct listing only once: the outcomes of the last size distinct
+        listings are kept in an LRU cache, and duplicates (see match_deduplicated()) of them get the
+        same product without being matched again, their statistics being replayed into the
+        MatchStats. None disables the cache.
+        """
+        self.dedup_cache_size = size
+        self.__dict__.pop("match_listing", None)
+        if size is None:
+            self.dedup_cache = None
+        else:
+            self.dedup_cache = collections.OrderedDict()
+            self.match_listing = self.match_listing_deduplicated
+
+    def match_listing_deduplicated(self, listing, stats):
+        return self.match_deduplicated(listing.title, listing.manufacturer, listing.currency,
+                                       listing.price, stats)
+
+    def match_deduplicated(self, title, manufacturer, currency, price, stats):
+        """
+        Matches a listing as match_title() does, unless the dedup cache has the outcome of a
+        duplicate. Listings are duplicates if they have the same manufacturer, currency and
+        price, and titles differing only in case and spacing. The title is lowercased as
+        tokenize() does, and whitespace separates tokens, so duplicates always have the same
+        title tokens and thus the same outcome. Splitting and joining a title is costly, so it
+        is only done for titles with runs of spaces, tabs or leading or trailing whitespace.
+
+        Both paths are timed from the start, key included, so that the time saved can be
+        estimated net of the cost of the cache.
+        """
+        perf_counter = time.perf_counter
+        start_time = perf_counter()
+        title_key = title.lower()
+        if "  " in title_key or "\t" in title_key or title_key != title_key.strip():
+            title_key = " ".join(title_key.split())
+        key = (title_key, manufacturer, currency, price)
+        dedup_cache = self.dedup_cache
+        outcome = dedup_cache.get(key)
+        if outcome is not None:
+            dedup_cache.move_to_end(key)
+            stats.add_duplicate(outcome)
+            stats.duplicate_seconds += perf_counter() - start_time
+            return outcome[0]
+
+        candidate_count = stats.candidate_count
+        resolved_count = stats.resolved_count
+        ambiguous_count = stats.ambiguous_count
+        unknown_manufacturer_count = stats.unknown_manufacturer_count
+        postings = self.buckets.get(self.manufacturers.lookup(manufacturer))
+        product_index = self.match_title(title, postings, stats)
+        dedup_cache[key] = (product_index,
+                            stats.candidate_count - candidate_count,
+                            stats.resolved_count - resolved_count,
+                            stats.ambiguous_count - ambiguous_count,
+                            stats.unknown_manufacturer_count - unknown_manufacturer_count)
+        if len(dedup_cache) > self.dedup_cache_size:
+            dedup_cache.popitem(last=False)
+        stats.distinct_count += 1
+        stats.distinct_match_seconds += perf_counter() - start_time
+        return product_index
+
+    def key_count(self):
+        return sum(len(postings) for postings in self.buckets.values())
+
+    def find_title_keys_token(self, title):
+        model_keys = self.model_keys
+        max_phrase_length = self.max_phrase_length
+        title_tokens = tokenize(title)
+        title_keys = []
+        for i in range(len(title_tokens)):
+            phrase = ""
+            for token in title_tokens[i:i + max_phrase_length]:
+                phrase += token
+                if phrase in model_keys:
+                    title_keys.append(phrase)
+        return tuple(title_keys)
+
+    def find_title_keys_automaton(self, title):
+        title_tokens = tokenize(title)
+        # maps the offsets in the joined tokens at which tokens start and end to token numbers
+        token_starts = {}
+        token_ends = {}
+        offset = 0
+        for (i, token) in enumerate(title_tokens):
+            token_starts[offset] = i
+            offset += len(token)
+            token_ends[offset] = i
+
+        matches = []
+        max_phrase_length = self.max_phrase_length
+        for (last_offset, key) in self.automaton.iter("".join(title_tokens)):
+            end = last_offset + 1
+            first_token = token_starts.get(end - len(key))
+            if first_token is None:
+                continue
+            last_token = token_ends.get(end)
+            if last_token is not None and last_token - first_token < max_phrase_length:
+                matches.append((first_token, last_token, key))
+        # in the same order as the token engine finds them
+        matches.sort()
+        return tuple(key for (_, _, key) in matches)
+
+    @staticmethod
+    def find_candidates(postings, title_keys):
+        candidates = []
+        for key in title_keys:
+            product_indices = postings.get(key)
+            if product_indices is not None:
+                candidates.extend(product_indices)
+        return candidates
+
+    def match_listing(self, listing, stats):
+        postings = self.buckets.get(self.manufacturers.lookup(listing.manufacturer))
+        return self.match_title(listing.title, postings, stats)
+
+    def match_title(self, title, postings, stats):
+        # postings is the bucket of the listing's manufacturer, None if it is unknown
+        stats.listing_count += 1
+        if postings is None:
+            stats.unknown_manufacturer_count += 1
+            return None
+
+        candidates = self.find_candidates(postings, self.find_title_keys(title))
+        stats.candidate_count += len(candidates)
+        if stats.candidate_histogram is not None:
+            stats.candidate_histogram[len(candidates)] += 1
+        if not candidates:
+            return None
+
+        matches = set(candidates)
+        if len(matches) == 1:
+            stats.matched_count += 1
+            return matches.pop()
+        product_index = self.resolve_ambiguous(matches, title)
+        if product_index is None:
+            stats.ambiguous_count += 1
+            return None
+        stats.matched_count += 1
+        stats.resolved_count += 1
+        return product_index
+
+    def resolve_ambiguous(self, product_indices, title):
+        """
+        Returns the index of the most specific of several products matching a title, or None if
+        two or more are equally specific.
+
+        Products are ranked by their number of matched model and family tokens, then by the
+        length of their model key; a single pass over the candidates finds the best one. The
+        title is only tokenized again here, off the common path of a single candidate.
+        """
+        title_tokens = set(tokenize(title))
+        matchers = self.matchers
+        best_product_index = None
+        best_score = None
+        tied = False
+        for product_index in product_indices:
+            score = matchers[product_index].score(title_tokens)
+            if best_score is None or score > best_score:
+                best_product_index = product_index
+                best_score = score
+                tied = False
+            elif score == best_score:
+                tied = True
+        return None if tied else best_product_index
+
+    def explain_listing(self, listing):
+        """
+        Returns a dict describing how match_listing() matches a listing: the model keys found in
+        its title, the candidate products with their scores, and the decision, one of
+        "unknown_manufacturer", "no_candidates", "single_candidate", "resolved" and "ambiguous".
+        The title keys are computed afresh rather than looked up in the title cache, so that
+        explaining a listing does not change the cache or its statistics.
+        """
+        explanation = {
+            "title_keys": [],
+            "candidates": [],
+            "decision": "unknown_manufacturer",
+            "product": None,
+        }
+        postings = self.buckets.get(self.manufacturers.lookup(listing.manufacturer))
+        if postings is None:
+            return explanation
+
+        title_keys = self.find_title_keys.__wrapped__(listing.title)
+        candidates = sorted(set(self.find_candidates(postings, title_keys)))
+        title_tokens = set(tokenize(listing.title))
+        explanation["title_keys"] = list(title_keys)
+        explanation["candidates"] = [{
+            "product": self.products[product_index].name,
+            "model_key": self.matchers[product_index].model_key,
+            "score": list(self.matchers[product_index].score(title_tokens)),
+        } for product_index in candidates]
+        if not candidates:
+            explanation["decision"] = "no_candidates"
+            return explanation
+        if len(candidates) == 1:
+            explanation["decision"] = "single_candidate"
+            product_index = candidates[0]
+        else:
+            product_index = self.resolve_ambiguous(candidates, listing.title)
+            if product_index is None:
+                explanation["decision"] = "ambiguous"
+                return explanation
+            explanation["decision"] = "resolved"
+        explanation["product"] = self.products[product_index].name
+        return explanation
+
+    def match_listings(self, listings, stats, metrics=None):
+        cache_info = self.find_title_keys.cache_info()
+        if metrics is not None and metrics.enabled:
+            yield from self.match_listings_timed(listings, stats, metrics)
+        else:
+            for listing in listings:
+                product_index = self.match_listing(listing, stats)
+                if product_index is not None:
+                    yield (product_index, listing)
+        stats.add_title_cache_info(cache_info, self.find_title_keys.cache_info())
+
+    def match_batch(self, batch, stats):
+        """
+        Returns [(product index, row), ...] for the listings of a ListingBatch that match a
+        product, matching each as match_listing() does, and like it leaving the title cache
+        statistics to the caller. The manufacturer names of the batch are looked up once each,
+        rather than once per listing.
+        """
+        if self.dedup_cache is not None:
+            return self.match_batch_deduplicated(batch, stats)
+        buckets = self.buckets
+        lookup = self.manufacturers.lookup
+        manufacturer_postings = [buckets.get(lookup(name)) for name in batch.manufacturer_names]
+        match_title = self.match_title
+        matches = []
+        for (row, (title, manufacturer_code)) in enumerate(
+                zip(batch.titles, batch.manufacturer_codes)):
+            product_index = match_title(title, manufacturer_postings[manufacturer_code], stats)
+            if product_index is not None:
+                matches.append((product_index, row))
+        return matches
+
+    def match_batch_deduplicated(self, batch, stats):
+        match_deduplicated = self.match_deduplicated
+        manufacturer_names = batch.manufacturer_names
+        currency_names = batch.currency_names
+        price_key = batch.price_key
+        matches = []
+        for (row, (title, manufacturer_code, currency_code)) in enumerate(
+                zip(batch.titles, batch.manufacturer_codes, batch.currency_codes)):
+            product_index = match_deduplicated(
+                title, manufacturer_names[manufacturer_code], currency_names[currency_code],
+                price_key(row), stats)
+            if product_index is not None:
+                matches.append((product_index, row))
+        return matches
+
+    def match_listings_timed(self, listings, stats, metrics):
+        perf_counter = time.perf_counter
+        match_time = 0.0
+        try:
+            for listing in listings:
+                start_time = perf_counter()
+                product_index = self.match_listing(listing, stats)
+                match_time += perf_counter() - start_time
+                if product_index is not None:
+                    yield (product_index, listing)
+        finally:
+            metrics.add_time("match", match_time)
+
+
+def create_automaton(keys):
+    """
+    Returns an Aho-Corasick automaton of keys whose iter(text) yields (offset, key) for each
+    occurrence of a key in text, offset being that of its last character, in order of offset.
+
+    Uses the pyahocorasick module if it is installed, and AhoCorasickAutomaton otherwise.
+    """
+    try:
+        import ahocorasick
+    except ImportError:
+        return AhoCorasickAutomaton(keys)
+    if not keys:
+        # pyahocorasick cannot search without keys
+        return AhoCorasickAutomaton(keys)
+    automaton = ahocorasick.Automaton()
+    for key in keys:
+        automaton.add_word(key, key)
+    automaton.make_automaton()
+    return automaton
+
+
+class AhoCorasickAutomaton:
+    """
+    A pure-Python Aho-Corasick automaton, with the iter() interface of pyahocorasick.
+
+    States are numbered; each has a dict of transitions, a failure state (the state of the
+    longest proper suffix of its path that is also a path from the root) and the keys ending
+    there, including those of its failure states, so every occurrence of every key is found
+    in a single pass over the text.
+    """
+
+    def __init__(self, keys):
+        self.transitions = [{}]
+        self.failures = [0]
+        self.outputs = [()]
+        for key in keys:
+            self.add_key(key)
+        self.compute_failures()
+
+    def add_key(self, key):
+        state = 0
+        for c in key:
+            next_state = self.transitions[state].get(c)
+            if next_state is None:
+                next_state = len(self.transitions)
+                self.transitions.append({})
+                self.failures.append(0)
+                self.outputs.append(())
+                self.transitions[state][c] = next_state
+            state = next_state
+        self.outputs[state] = (key,)
+
+    def compute_failures(self):
+        # breadth first, so the failure state of each state is done before its children
+        queue = collections.deque(self.transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for (c, next_state) in self.transitions[state].items():
+                queue.append(next_state)
+                failure = self.failures[state]
+                while failure and c not in self.transitions[failure]:
+                    failure = self.failures[failure]
+                failure = self.transitions[failure].get(c, 0)
+                if failure == next_state:
+                    failure = 0
+                self.failures[next_state] = failure
+                self.outputs[next_state] += self.outputs[failure]
+
+    def iter(self, text):
+        transitions = self.transitions
+        failures = self.failures
+        outputs = self.outputs
+        state = 0
+        for (offset, c) in enumerate(text):
+            next_state = transitions[state].get(c)
+            while next_state is None and state:
+                state = failures[state]
+                next_state = transitions[state].get(c)
+            state = 0 if next_state is None else next_state
+            for key in outputs[state]:
+                yield (offset, key)
+
+
+class ProductIndexCache:
+    """
+    Persists a ProductIndex to a file keyed by the path of the products file.
+
+    The cache file holds two pickles: a small header with the fingerprint (size, modification
+    time and SHA-256 digest) of the products file it was built from, then the index itself, so
+    a stale cache is detected without unpickling the index. If only the modification time
+    differs, the digest decides, so touching the products file does not invalidate the cache.
+    FORMAT_VERSION must be incremented whenever the pickled classes change incompatibly.
+    """
+
+    FORMAT_VERSION = 3
+
+    def __init__(self, cache_dir, products_path):
+        self.cache_dir = cache_dir
+        self.products_path = products_path
+        import hashlib
+        abs_products_path = os.path.abspath(products_path)
+        key = hashlib.sha256(abs_products_path.encode("utf8", "surrogateescape")).hexdigest()
+        self.path = os.path.join(cache_dir, "products-{}.index".format(key[:32]))
+
+    def compute_fingerprint(self):
+        st = os.stat(self.products_path)
+        return self.Fingerprint(st.st_size, st.st_mtime_ns, functools.partial(
+            self.compute_digest, self.products_path))
+
+    @staticmethod
+    def compute_digest(path):
+        import hashlib
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(functools.partial(f.read, 1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def load(self, fingerprint):
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            raise self.Error("unable to open file: {} ({})".format(self.path, e.strerror))
+
+        import pickle
+        with f:
+            try:
+                header = pickle.load(f)
+                if header.get("format_version") != self.FORMAT_VERSION:
+                    return None
+                if not fingerprint.matches(header):
+                    return None
+                return pickle.load(f)
+            except Exception as e:
+                raise self.Error("unable to load file: {} ({})".format(self.path, e))
+
+    def save(self, fingerprint, index):
+        header = {
+            "format_version": self.FORMAT_VERSION,
+            "products_path": os.path.abspath(self.products_path),
+            "size": fingerprint.size,
+            "mtime_ns": fingerprint.mtime_ns,
+            "sha256": fingerprint.digest(),
+        }
+        import pickle
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        try:
+            with open(temp_path, "wb") as f:
+                pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+    class Fingerprint:
+
+        def __init__(self, size, mtime_ns, compute_digest):
+            self.size = size
+            self.mtime_ns = mtime_ns
+            self.compute_digest = compute_digest
+            self._digest = None
+
+        def digest(self):
+            # computed lazily, since it is only needed if the modification time changed
+            if self._digest is None:
+                self._digest = self.compute_digest()
+            return self._digest
+
+        def matches(self, header):
+            if header.get("size") != self.size:
+                return False
+            if header.get("mtime_ns") == self.mtime_ns:
+                return True
+            return header.get("sha256") == self.digest()
+
+    class Error(Exception):
+        pass
+
+
+class IncrementalState:
+    """
+    The state of an incremental run, persisted as JSON between runs.
+
+    Records how far into the listings file matching has got (the byte offset just past the last
+    complete line, and the number of lines up to it), the number of listings matched to each
+    product so far, keyed by product name, and what the offset is valid for: the SHA-256 digest
+    of the products file and the device and inode of the listings file. The state is only saved
+    after the results file has been written, so if a run fails the next run matches the same
+    listings again rather than losing them.
+    """
+
+    FORMAT_VERSION = 1
+
+    def __init__(self):
+        self.products_digest = None
+        self.listings_device = None
+        self.listings_inode = None
+        self.listings_offset = 0
+        self.listings_line_count = 0
+        self.match_counts = {}
+
+    @classmethod
+    def load(cls, path):
+        try:
+            f = open(path, "rt", encoding="utf8")
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            raise cls.Error("unable to open file: {} ({})".format(path, e.strerror))
+
+        with f:
+            try:
+                obj = json.load(f)
+                if obj["format_version"] != cls.FORMAT_VERSION:
+                    raise ValueError("unsupported format version: {}".format(
+                        obj["format_version"]))
+                state = cls()
+                state.products_digest = obj["products_sha256"]
+                state.listings_device = obj["listings_device"]
+                state.listings_inode = obj["listings_inode"]
+                state.listings_offset = int(obj["listings_offset"])
+                state.listings_line_count = int(obj["listings_line_count"])
+                state.match_counts = dict(obj["match_counts"])
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                raise cls.Error("invalid state file: {} ({})".format(path, e))
+        return state
+
+    def save(self, path):
+        obj = {
+            "format_version": self.FORMAT_VERSION,
+            "products_sha256": self.products_digest,
+            "listings_device": self.listings_device,
+            "listings_inode": self.listings_inode,
+            "listings_offset": self.listings_offset,
+            "listings_line_count": self.listings_line_count,
+            "match_counts": self.match_counts,
+        }
+        temp_path = path + ".tmp"
+        with open(temp_path, "wt", encoding="utf8") as f:
+            json.dump(obj, f, indent=2, sort_keys=True, ensure_ascii=False)
+            f.write("\n")
+        os.replace(temp_path, path)
+
+    def check(self, products_digest, listings_stat):
+        """
+        Returns why the recorded offset cannot be resumed from, or None if it can.
+        """
+        if products_digest != self.products_digest:
+            return "the products file has changed"
+        if (listings_stat.st_dev, listings_stat.st_ino) != (
+                self.listings_device, self.listings_inode):
+            return "the listings file has been replaced"
+        if listings_stat.st_size < self.listings_offset:
+            return "the listings file has been truncated"
+        return None
+
+    class Error(Exception):
+        pass
+
+
+class Pipeline:
+    """
+    Runs the stages of matching in threads connected by bounded queues of batches, so that a
+    stage waiting on I/O, such as reading the listings or spilling results to disk, overlaps
+    with the others. The stages are threads, not processes, so the CPU-bound ones still share
+    the GIL; --jobs is the way to spread matching over several CPUs.
+
+    A stage blocks when its output queue is full, so a slow stage holds back the stages before
+    it and at most queue_size batches are queued between two stages whatever their speeds.
+    Each stage records in a Pipeline.Stage the time it was busy, the time it stalled waiting
+    for input from the stage before it and for room in the queue to the stage after it, and
+    the depths of that queue; the stage that stalls the least is the bottleneck.
+    """
+
+    DEFAULT_QUEUE_SIZE = 8
+    DEFAULT_BATCH_SIZE = 1000
+    # the interval at which a blocked stage checks whether the pipeline is being stopped
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, queue_size=None):
+        self.queue_size = self.DEFAULT_QUEUE_SIZE if queue_size is None else queue_size
+        self.stages = []
+        self.threads = []
+        self.stopping = threading.Event()
+
+    def run(self, source_name, batches, functions, consumer_name):
+        """
+        Yields the results of each of the given batches passed through the functions of
+        functions, a list of (stage name, function) in order. Iterating batches is the first
+        stage and each function is a stage of its own, each in its own thread; the consumer
+        of the generator returned is the last stage. An exception raised by a stage is raised
+        again by the generator, and closing the generator stops the stages.
+        """
+        output_queue = queue.Queue(self.queue_size)
+        self.start_stage(source_name, self.produce, iter(batches), output_queue)
+        for (name, function) in functions:
+            input_queue = output_queue
+            output_queue = queue.Queue(self.queue_size)
+            self.start_stage(name, self.transform, function, input_queue, output_queue)
+        stage = self.Stage(consumer_name)
+        self.stages.append(stage)
+        try:
+            yield from self.consume(stage, output_queue)
+        finally:
+            self.stop()
+
+    def start_stage(self, name, target, *args):
+        stage = self.Stage(name)
+        self.stages.append(stage)
+        thread = threading.Thread(
+            target=target, args=(stage,) + args, name="Pipeline-{}".format(name), daemon=True)
+        self.threads.append(thread)
+        thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+
+    def produce(self, stage, iterator, output_queue):
+        perf_counter = time.perf_counter
+        try:
+            while True:
+                start_time = perf_counter()
+                try:
+                    batch = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    stage.busy_seconds += perf_counter() - start_time
+                stage.batch_count += 1
+                if not self.put(stage, output_queue, batch):
+                    return
+            self.put(stage, output_queue, self.END)
+        except BaseException as e:
+            self.put(stage, output_queue, self.Failure(e))
+        finally:
+            # closes the file being read, if the pipeline was stopped early
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    def transform(self, stage, function, input_queue, output_queue):
+        perf_counter = time.perf_counter
+        try:
+            while True:
+                batch = self.get(stage, input_queue)
+                if batch is None:
+                    return
+                if batch is self.END or isinstance(batch, self.Failure):
+                    self.put(stage, output_queue, batch)
+                    return
+                start_time = perf_counter()
+                batch = function(batch)
+                stage.busy_seconds += perf_counter() - start_time
+                stage.batch_count += 1
+                if not self.put(stage, output_queue, batch):
+                    return
+        except BaseException as e:
+            self.put(stage, output_queue, self.Failure(e))
+
+    def consume(self, stage, input_queue):
+        perf_counter = time.perf_counter
+        while True:
+            batch = self.get(stage, input_queue)
+            if batch is self.END:
+                return
+            if isinstance(batch, self.Failure):
+                raise batch.error
+            start_time = perf_counter()
+            yield batch
+            stage.busy_seconds += perf_counter() - start_time
+            stage.batch_count += 1
+
+    def get(self, stage, input_queue):
+        # returns None if the pipeline is stopped while waiting
+        start_time = time.perf_counter()
+        try:
+            while True:
+                try:
+                    return input_queue.get(timeout=self.POLL_INTERVAL)
+                except queue.Empty:
+                    if self.stopping.is_set():
+                        return None
+        finally:
+            stage.input_stall_seconds += time.perf_counter() - start_time
+
+    def put(self, stage, output_queue, batch):
+        # returns False if the pipeline is stopped while waiting
+        stage.add_queue_depth(output_queue.qsize())
+        start_time = time.perf_counter()
+        try:
+            while not self.stopping.is_set():
+                try:
+                    output_queue.put(batch, timeout=self.POLL_INTERVAL)
+                except queue.Full:
+                    pass
+                else:
+                    return True
+            return False
+        finally:
+            stage.output_stall_seconds += time.perf_counter() - start_time
+
+    @staticmethod
+    def iter_batches(items, batch_size):
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    # marks the end of the batches; a stage passes it on, and then exits
+    END = object()
+
+    class Failure:
+
+        def __init__(self, error):
+            self.error = error
+
+    class Stage:
+
+        def __init__(self, name):
+            self.name = name
+            self.batch_count = 0
+            self.busy_seconds = 0.0
+            self.input_stall_seconds = 0.0
+            self.output_stall_seconds = 0.0
+            # the depths of the output queue seen before each put
+            self.queue_depth_total = 0
+            self.queue_depth_count = 0
+            self.max_queue_depth = 0
+
+        def add_queue_depth(self, depth):
+            self.queue_depth_total += depth
+            self.queue_depth_count += 1
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+
+        def average_queue_depth(self):
+            if self.queue_depth_count == 0:
+                return 0.0
+            return self.queue_depth_total / self.queue_depth_count
+
+
+class ParallelMatcher:
+    """
+    Matches listings using a pool of worker processes.
+
+    The main process only reads raw lines; parsing and matching happen in the workers. The
+    product index is handed to each worker once, when the worker starts: with the "fork" start
+    method it is inherited copy-on-write, otherwise it is pickled once per worker. Chunks are
+    submitted through a bounded window and their results consumed in submission order, so the
+    matches come out in the same order as a serial run and memory use stays bounded.
+
+    match_ranges() goes further: the main process does not read the file at all, but divides
+    it into byte ranges ending at newlines. Each worker memory-maps the file, parses and matches
+    the lines of a range through memoryview slices of the mapping, and writes the matches to a
+    sorted run file of the ResultsWriter, numbered by the byte offsets of the listings so that
+    the merged results are in file order. Only the run file path, counts and statistics are
+    sent back, never the listings.
+    """
+
+    DEFAULT_CHUNK_SIZE = 2000
+    DEFAULT_RANGE_SIZE = 32 * 1024 * 1024
+
+    def __init__(self, index, jobs, chunk_size=None, metrics=None, profiler=None,
+                 range_size=None, columnar=False):
+        self.index = index
+        self.jobs = jobs
+        self.chunk_size = self.DEFAULT_CHUNK_SIZE if chunk_size is None else chunk_size
+        self.range_size = self.DEFAULT_RANGE_SIZE if range_size is None else range_size
+        self.metrics = NullMetrics() if metrics is None else metrics
+        self.profiler = profiler
+        self.columnar = columnar
+
+    def create_pool(self, reader):
+        context = self.create_multiprocessing_context()
+        worker_profiler_config = None
+        if self.profiler is not None:
+            worker_profiler_config = self.profiler.worker_config()
+        initargs = (self.index, type(reader), reader.json_backend, reader.dedup_cache_size,
+                    self.index.dedup_cache_size, self.columnar, self.metrics.enabled,
+                    worker_profiler_config)
+        return context.Pool(self.jobs, initializer=_init_match_worker, initargs=initargs)
+
+    def match(self, reader, stats):
+        max_pending_count = self.jobs * 2
+        with self.create_pool(reader) as pool:
+            pending = collections.deque()
+            for chunk in self.iter_chunks(reader.read_lines()):
+                pending.append(pool.apply_async(_match_chunk, (chunk,)))
+                if len(pending) >= max_pending_count:
+                    yield from self.process_result(pending.popleft().get(), reader, stats)
+            while pending:
+                yield from self.process_result(pending.popleft().get(), reader, stats)
+            # let the workers exit normally, rather than being terminated, so that they run
+            # their exit handlers, such as writing their profiles
+            pool.close()
+            pool.join()
+
+    def match_ranges(self, reader, writer, stats):
+        """
+        Matches the listings of reader's file from its start_offset, adding the run files
+        written by the workers to writer and updating reader's line, error and offset counts.
+        """
+        try:
+            size = os.path.getsize(reader.path)
+            range_count = max(self.jobs, math.ceil((size - reader.start_offset) / self.range_size))
+            ranges = split_line_ranges(reader.path, range_count, reader.start_offset,
+                                       reader.complete_lines_only)
+        except OSError as e:
+            raise reader.Error("unable to read file: {} ({})".format(reader.path, e.strerror))
+
+        if reader.progress is not None:
+            reader.progress.start()
+        reader.offset = reader.start_offset
+        with self.create_pool(reader) as pool:
+            pending = collections.deque()
+            for (start, end) in ranges:
+                run_path = writer.create_run_path()
+                pending.append(pool.apply_async(
+                    _match_range, (reader.path, start, end, run_path)))
+            for (start, end) in ranges:
+                self.process_range_result(pending.popleft().get(), reader, writer, stats)
+                reader.offset = end
+                if reader.progress is not None:
+                    reader.progress.check()
+            pool.close()
+            pool.join()
+
+    def process_range_result(self, result, reader, writer, stats):
+        (run_path, line_count, errors, range_stats, range_metrics) = result
+        for (line_number, message) in errors:
+            reader.on_parse_error(reader.line_count + line_number, message)
+        reader.line_count += line_count
+        stats.merge(range_stats)
+        self.metrics.merge(range_metrics)
+        if run_path is not None:
+            writer.add_run(run_path)
+
+    def process_result(self, result, reader, stats):
+        (matches, errors, chunk_stats, chunk_metrics) = result
+        for (line_number, message) in errors:
+            reader.on_parse_error(line_number, message)
+        stats.merge(chunk_stats)
+        self.metrics.merge(chunk_metrics)
+        return matches
+
+    def iter_chunks(self, lines):
+        chunk = []
+        for line in lines:
+            chunk.append(line)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    @staticmethod
+    def create_multiprocessing_context():
+        import multiprocessing
+        if "fork" in multiprocessing.get_all_start_methods():
+            return multiprocessing.get_context("fork")
+        return multiprocessing.get_context()
+
+
+_match_worker_state = None
+
+
+def _init_match_worker(index, reader_class, json_backend, dedup_cache_size,
+                       index_dedup_cache_size, columnar, metrics_enabled, profiler_config):
+    global _match_worker_state
+    reader = reader_class(None, None, json_backend=json_backend)
+    if dedup_cache_size is not None:
+        reader.set_dedup_cache_size(dedup_cache_size)
+    # the dedup cache of the index is not pickled
+    index.set_dedup_cache_size(index_dedup_cache_size)
+    _match_worker_state = (index, reader, columnar, metrics_enabled)
+    if profiler_config is not None:
+        (profiler_class, kwargs) = profiler_config
+        profiler = profiler_class(**kwargs)
+        profiler.start()
+        import multiprocessing.util
+        multiprocessing.util.Finalize(profiler, profiler.stop_and_write, exitpriority=100)
+
+
+def _match_range(path, start, end, run_path):
+    (index, reader, columnar, metrics_enabled) = _match_worker_state
+    stats = MatchStats(collect_histogram=metrics_enabled)
+    metrics = Metrics() if metrics_enabled else NullMetrics()
+    cache_info = index.find_title_keys.cache_info()
+    dedup_cache_info = reader.dedup_cache_info()
+    mapping = _map_worker_file(path)
+    view = memoryview(mapping)
+    find = mapping.find
+    # the dedup cache is keyed by the lines, which must not keep the mapping exported
+    copy_lines = (reader.json_backend not in JSON_BACKENDS_ACCEPTING_MEMORYVIEW
+                  or reader.dedup_cache_size is not None)
+    perf_counter = time.perf_counter
+    parse_time = 0.0
+    match_time = 0.0
+    records = []
+    errors = []
+    # the columnar path collects the lines into batches, and looks up the offset of each
+    # matched listing, for its sequence number, by its line number
+    batch_lines = []
+    line_offsets = array.array("q")
+
+    def on_batch_parse_error(line_number, error):
+        line_offset = line_offsets[line_number - 1]
+        line_end = find(b"\n", line_offset, end)
+        if not mapping[line_offset:end if line_end < 0 else line_end].isspace():
+            errors.append((line_number, "{}".format(error)))
+
+    def match_batch():
+        nonlocal parse_time, match_time
+        start_time = perf_counter()
+        batch = reader.parse_batch(batch_lines, on_batch_parse_error)
+        parse_end_time = perf_counter()
+        for (product_index, row) in index.match_batch(batch, stats):
+            records.append((product_index, line_offsets[batch.line_numbers[row] - 1],
+                            encode_listing(batch.listing(row))))
+        parse_time += parse_end_time - start_time
+        match_time += perf_counter() - parse_end_time
+        batch_lines.clear()
+
+    line_number = 0
+    line_start = start
+    while line_start < end:
+        line_end = find(b"\n", line_start, end)
+        if line_end < 0:
+            line_end = end
+        line = view[line_start:line_end]
+        line_offset = line_start
+        line_start = line_end + 1
+        line_number += 1
+        if columnar:
+            line_offsets.append(line_offset)
+            if line:
+                batch_lines.append((line_number, line.tobytes() if copy_lines else line))
+                if len(batch_lines) >= ListingBatch.DEFAULT_SIZE:
+                    match_batch()
+            continue
+        if not line:
+            continue
+        start_time = perf_counter()
+        try:
+            listing = reader.parse_line(line.tobytes() if copy_lines else line)
+        except reader.ParseError as e:
+            if not line.tobytes().isspace():
+                errors.append((line_number, "{}".format(e)))
+            continue
+        parse_end_time = perf_counter()
+        parse_time += parse_end_time - start_time
+        product_index = index.match_listing(listing, stats)
+        match_time += perf_counter() - parse_end_time
+        if product_index is not None:
+            records.append((product_index, line_offset, encode_listing(listing)))
+    if batch_lines:
+        match_batch()
+
+    if records:
+        records.sort()
+        ResultsWriter.write_run_file(run_path, records)
+    else:
+        run_path = None
+    stats.add_title_cache_info(cache_info, index.find_title_keys.cache_info())
+    stats.add_dedup_cache_info(dedup_cache_info, reader.dedup_cache_info())
+    metrics.add_time("parse", parse_time)
+    metrics.add_time("match", match_time)
+    return (run_path, line_number, errors, stats, metrics)
+
+
+_worker_file_mappings = {}
+
+
+def _map_worker_file(path):
+    # each worker maps the file once and keeps it mapped for all of its ranges
+    mapping = _worker_file_mappings.get(path)
+    if mapping is None:
+        with open(path, "rb") as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        _worker_file_mappings[path] = mapping
+    return mapping
+
+
+def split_line_ranges(path, range_count, start_offset=0, complete_lines_only=False):
+    """
+    Divides the bytes of a file from start_offset to its end into at most range_count
+    (start, end) byte ranges of about equal size, each ending just after a newline, except for
+    the last if the file does not end with one. If complete_lines_only is true then a final
+    line without a trailing newline is left out. Only the pages around the split points are
+    read.
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= start_offset:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+            end_offset = size
+            if complete_lines_only:
+                end_offset = mapping.rfind(b"\n", start_offset) + 1
+                if end_offset <= start_offset:
+                    return []
+            ranges = []
+            range_start = start_offset
+            for i in range(1, range_count):
+                split_offset = start_offset + (end_offset - start_offset) * i // range_count
+                if split_offset <= range_start:
+                    continue
+                newline_offset = mapping.find(b"\n", split_offset - 1, end_offset)
+                if newline_offset < 0:
+                    break
+                ranges.append((range_start, newline_offset + 1))
+                range_start = newline_offset + 1
+            if range_start < end_offset:
+                ranges.append((range_start, end_offset))
+    return ranges
+
+
+def _match_chunk(chunk):
+    (index, reader, columnar, metrics_enabled) = _match_worker_state
+    stats = MatchStats(collect_histogram=metrics_enabled)
+    metrics = Metrics() if metrics_enabled else NullMetrics()
+    cache_info = index.find_title_keys.cache_info()
+    dedup_cache_info = reader.dedup_cache_info()
+    perf_counter = time.perf_counter
+    parse_time = 0.0
+    match_time = 0.0
+    matches = []
+    errors = []
+    if columnar:
+        start_time = perf_counter()
+        batch = reader.parse_batch(chunk, lambda line_number, e: errors.append(
+            (line_number, "{}".format(e))))
+        parse_end_time = perf_counter()
+        for (product_index, row) in index.match_batch(batch, stats):
+            matches.append((product_index, batch.listing(row)))
+        parse_time = parse_end_time - start_time
+        match_time = perf_counter() - parse_end_time
+    else:
+        for (line_number, line) in chunk:
+            start_time = perf_counter()
+            try:
+                listing = reader.parse_line(line)
+            except reader.ParseError as e:
+                errors.append((line_number, "{}".format(e)))
+                continue
+            parse_end_time = perf_counter()
+            parse_time += parse_end_time - start_time
+            product_index = index.match_listing(listing, stats)
+            match_time += perf_counter() - parse_end_time
+            if product_index is not None:
+                matches.append((product_index, listing))
+    stats.add_title_cache_info(cache_info, index.find_title_keys.cache_info())
+    stats.add_dedup_cache_info(dedup_cache_info, reader.dedup_cache_info())
+    metrics.add_time("parse", parse_time)
+    metrics.add_time("match", match_time)
+    return (matches, errors, stats, metrics)
+
+
+class MatchServer:
+    """
+    Matches listings sent as JSON lines, writing back one JSON line per listing.
+
+    Listings are read either from a binary input stream (stdin by default) or from any number
+    of clients of a Unix socket, all sharing the one in-memory index. Each non-blank line gets
+    exactly one response line, written as soon as the listing is matched: {"product_name":
+    NAME}, with NAME null if the listing matched no product, or {"error": MESSAGE} if the line
+    could not be parsed. Matching is cheap enough relative to the I/O that it is done directly
+    on the event loop, which also means the index is only ever used by one thread.
+
+    The products are reloaded on SIGHUP or when a {"command": "reload"} line is received, which
+    is answered once the reload is done. load_index() is called in a worker thread to build the
+    new index while listings continue to be matched against the old one; the new index is then
+    swapped in on the event loop, between two listings, so every listing is matched against
+    exactly one index and none are dropped.
+    """
+
+    MAX_LINE_LENGTH = 1024 * 1024
+    MAX_LOGGED_PRODUCT_NAMES = 10
+
+    def __init__(self, index, logger, socket_path=None, input_stream=None, output_stream=None,
+                 load_index=None, json_backend="auto"):
+        self.index = index
+        self.logger = logger
+        self.socket_path = socket_path
+        self.load_index = load_index
+        self.reload_lock = None
+        self.reload_tasks = set()
+        self.input_stream = sys.stdin.buffer if input_stream is None else input_stream
+        self.output_stream = sys.stdout.buffer if output_stream is None else output_stream
+        self.parser = ListingsReader("<input>", logger, json_backend=json_backend)
+        self.stats = MatchStats()
+        # the title cache statistics are added up per index, when it is replaced or the server
+        # stops, rather than per listing
+        self.title_cache_info = index.find_title_keys.cache_info()
+        self.ready = None
+        self.stop_event = None
+
+    def run(self):
+        import asyncio
+        asyncio.run(self.serve())
+
+    def stop(self):
+        self.stop_event.set()
+
+    async def serve(self):
+        import asyncio
+        self.ready = asyncio.Event()
+        self.stop_event = asyncio.Event()
+        self.reload_lock = asyncio.Lock()
+        loop = asyncio.get_running_loop()
+        signal_handlers = [(signal.SIGINT, self.stop), (signal.SIGTERM, self.stop)]
+        if self.load_index is not None and hasattr(signal, "SIGHUP"):
+            signal_handlers.append((signal.SIGHUP, self.start_reload))
+        for (signal_number, handler) in signal_handlers:
+            try:
+                loop.add_signal_handler(signal_number, handler)
+            except (ValueError, RuntimeError):
+                pass  # not the main thread, or not supported on this platform
+
+        if self.socket_path is None:
+            task = asyncio.ensure_future(self.serve_stream())
+        else:
+            task = asyncio.ensure_future(self.serve_socket())
+        stop_task = asyncio.ensure_future(self.stop_event.wait())
+        try:
+            await asyncio.wait([task, stop_task], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for pending_task in (task, stop_task):
+                pending_task.cancel()
+            await asyncio.gather(task, stop_task, *self.reload_tasks, return_exceptions=True)
+            for (signal_number, handler) in signal_handlers:
+                loop.remove_signal_handler(signal_number)
+            self.add_title_cache_info()
+        if task.done() and not task.cancelled():
+            task.result()
+
+    async def serve_stream(self):
+        readline = await self.create_stream_readline()
+        self.ready.set()
+        while True:
+            try:
+                line = await readline()
+            except ValueError:
+                self.write_output(self.encode_response(
+                    {"error": "line longer than {} bytes".format(self.MAX_LINE_LENGTH)}))
+                break
+            if not line:
+                break
+            response = await self.handle_line(line)
+            if response is not None:
+                self.write_output(response)
+
+    async def create_stream_readline(self):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        if not self.is_pollable(self.input_stream):
+            # e.g. a regular file, whose reads never block for long, so read it in a thread
+            return functools.partial(loop.run_in_executor, None, self.input_stream.readline)
+        reader = asyncio.StreamReader(limit=self.MAX_LINE_LENGTH)
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader),
+                                     self.input_stream)
+        return reader.readline
+
+    @staticmethod
+    def is_pollable(stream):
+        try:
+            mode = os.fstat(stream.fileno()).st_mode
+        except (OSError, ValueError):
+            return False
+        return stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode) or stat.S_ISCHR(mode)
+
+    def write_output(self, response):
+        self.output_stream.write(response)
+        self.output_stream.flush()
+
+    async def serve_socket(self):
+        # remove the socket left behind by a server that was killed, but nothing else
+        try:
+            if stat.S_ISSOCK(os.stat(self.socket_path).st_mode):
+                os.remove(self.socket_path)
+        except FileNotFoundError:
+            pass
+        import asyncio
+        server = await asyncio.start_unix_server(
+            self.handle_client, path=self.socket_path, limit=self.MAX_LINE_LENGTH)
+        try:
+            async with server:
+                self.ready.set()
+                await server.serve_forever()
+        finally:
+            try:
+                os.remove(self.socket_path)
+            except OSError:
+                pass
+
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    writer.write(self.encode_response(
+                        {"error": "line longer than {} bytes".format(self.MAX_LINE_LENGTH)}))
+                    break
+                if not line:
+                    break
+                response = await self.handle_line(line)
+                if response is not None:
+                    writer.write(response)
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def handle_line(self, line):
+        if line.isspace():
+            return None
+        try:
+            obj = self.parser.decode_line(line)
+            if "command" in obj:
+                return self.encode_response(await self.handle_command(obj["command"]))
+            listing = self.parser.parse_object(obj)
+        except self.parser.ParseError as e:
+            return self.encode_response({"error": "{}".format(e)})
+        index = self.index
+        product_index = index.match_listing(listing, self.stats)
+        if product_index is None:
+            product_name = None
         else:
-            return 0
+            product_name = index.products[product_index].name
+        return self.encode_response({"product_name": product_name})
 
+    def add_title_cache_info(self):
+        cache_info = self.index.find_title_keys.cache_info()
+        self.stats.add_title_cache_info(self.title_cache_info, cache_info)
+        self.title_cache_info = cache_info
 
-class ProductListingMatcher:
+    async def handle_command(self, command):
+        if command == "reload" and self.load_index is not None:
+            return await self.reload()
+        return {"error": "unknown command: {}".format(command)}
 
-    def __init__(self, products_path, listings_path, logger):
-        self.products_path = products_path
-        self.listings_path = listings_path
+    def start_reload(self):
+        import asyncio
+        task = asyncio.ensure_future(self.reload())
+        self.reload_tasks.add(task)
+        task.add_done_callback(self.reload_tasks.discard)
+
+    async def reload(self):
+        import asyncio
+        # reloads are serialized, so the last one requested always reads the latest products
+        async with self.reload_lock:
+            self.logger.info("Reloading products")
+            start_time = time.perf_counter()
+            try:
+                index = await asyncio.get_running_loop().run_in_executor(None, self.load_index)
+            except Exception as e:
+                # the server keeps running with the old products whatever went wrong
+                self.logger.error("ERROR: reloading products failed: {}".format(e))
+                return {"error": "reloading products failed: {}".format(e)}
+            (added, removed, changed) = diff_products(self.index.products, index.products)
+            self.add_title_cache_info()
+            self.index = index
+            self.title_cache_info = index.find_title_keys.cache_info()
+            elapsed_time = time.perf_counter() - start_time
+
+        self.logger.info("Reloaded {} products in {:.3f} seconds: {} added, {} removed, "
+                         "{} changed".format(len(index.products), elapsed_time, len(added),
+                                             len(removed), len(changed)))
+        for (description, names) in (("Added", added), ("Removed", removed),
+                                     ("Changed", changed)):
+            if names:
+                self.logger.info("{} products: {}".format(description, self.format_names(names)))
+        return {
+            "reloaded": True,
+            "product_count": len(index.products),
+            "added": len(added),
+            "removed": len(removed),
+            "changed": len(changed),
+            "seconds": round(elapsed_time, 6),
+        }
+
+    @classmethod
+    def format_names(cls, names):
+        text = ", ".join(names[:cls.MAX_LOGGED_PRODUCT_NAMES])
+        if len(names) > cls.MAX_LOGGED_PRODUCT_NAMES:
+            text += " and {} more".format(len(names) - cls.MAX_LOGGED_PRODUCT_NAMES)
+        return text
+
+    @staticmethod
+    def encode_response(obj):
+        return (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf8")
+
+
+def diff_products(old_products, new_products):
+    """
+    Compares two lists of products by name.
+
+    Returns (added, removed, changed): lists of the names of the products only in
+    new_products, only in old_products, and in both but with different fields, in order.
+    """
+    old_products_by_name = {product.name: product for product in old_products}
+    new_names = set()
+    added = []
+    changed = []
+    for product in new_products:
+        new_names.add(product.name)
+        old_product = old_products_by_name.get(product.name)
+        if old_product is None:
+            added.append(product.name)
+        elif old_product != product:
+            changed.append(product.name)
+    removed = [product.name for product in old_products if product.name not in new_names]
+    return (added, removed, changed)
+
+
+class MatchStats:
+
+    def __init__(self, collect_histogram=False):
+        # maps the number of candidates of a listing to the number of such listings
+        self.candidate_histogram = collections.Counter() if collect_histogram else None
+        self.listing_count = 0
+        self.candidate_count = 0
+        self.matched_count = 0
+        # listings that matched several products and were given to the most specific one
+        self.resolved_count = 0
+        self.ambiguous_count = 0
+        self.unknown_manufacturer_count = 0
+        self.title_cache_hit_count = 0
+        self.title_cache_miss_count = 0
+        # listings whose outcome came from the index's dedup cache and the time spent looking
+        # them up, and the distinct listings matched and the time spent matching them
+        self.duplicate_count = 0
+        self.duplicate_seconds = 0.0
+        self.distinct_count = 0
+        self.distinct_match_seconds = 0.0
+        # lines whose listing came from the reader's dedup cache, the distinct lines parsed and
+        # the time spent parsing them
+        self.duplicate_line_count = 0
+        self.distinct_line_count = 0
+        self.distinct_parse_seconds = 0.0
+
+    def merge(self, other):
+        if self.candidate_histogram is not None and other.candidate_histogram is not None:
+            self.candidate_histogram.update(other.candidate_histogram)
+        self.listing_count += other.listing_count
+        self.candidate_count += other.candidate_count
+        self.matched_count += other.matched_count
+        self.resolved_count += other.resolved_count
+        self.ambiguous_count += other.ambiguous_count
+        self.unknown_manufacturer_count += other.unknown_manufacturer_count
+        self.title_cache_hit_count += other.title_cache_hit_count
+        self.title_cache_miss_count += other.title_cache_miss_count
+        self.duplicate_count += other.duplicate_count
+        self.duplicate_seconds += other.duplicate_seconds
+        self.distinct_count += other.distinct_count
+        self.distinct_match_seconds += other.distinct_match_seconds
+        self.duplicate_line_count += other.duplicate_line_count
+        self.distinct_line_count += other.distinct_line_count
+        self.distinct_parse_seconds += other.distinct_parse_seconds
+
+    def add_duplicate(self, outcome):
+        """
+        Counts a listing whose outcome, as cached by ProductIndex.match_deduplicated(), is that
+        of a listing matched before.
+        """
+        (product_index, candidate_count, resolved_count, ambiguous_count,
+         unknown_manufacturer_count) = outcome
+        self.listing_count += 1
+        self.duplicate_count += 1
+        if unknown_manufacturer_count:
+            self.unknown_manufacturer_count += 1
+            return
+        self.candidate_count += candidate_count
+        if self.candidate_histogram is not None:
+            self.candidate_histogram[candidate_count] += 1
+        if product_index is not None:
+            self.matched_count += 1
+        self.resolved_count += resolved_count
+        self.ambiguous_count += ambiguous_count
+
+    def add_title_cache_info(self, start_info, end_info):
+        self.title_cache_hit_count += end_info.hits - start_info.hits
+        self.title_cache_miss_count += end_info.misses - start_info.misses
+
+    def add_dedup_cache_info(self, start_info, end_info):
+        if end_info is None:
+            return
+        (start_hits, start_misses, start_seconds) = start_info
+        (end_hits, end_misses, end_seconds) = end_info
+        self.duplicate_line_count += end_hits - start_hits
+        self.distinct_line_count += end_misses - start_misses
+        self.distinct_parse_seconds += end_seconds - start_seconds
+
+    def title_cache_hit_rate(self):
+        lookup_count = self.title_cache_hit_count + self.title_cache_miss_count
+        if lookup_count == 0:
+            return 0.0
+        return self.title_cache_hit_count / lookup_count
+
+    def average_candidate_count(self):
+        if self.listing_count == 0:
+            return 0.0
+        return self.candidate_count / self.listing_count
+
+    def duplicate_ratio(self):
+        listing_count = self.duplicate_count + self.distinct_count
+        if listing_count == 0:
+            return 0.0
+        return self.duplicate_count / listing_count
+
+    def duplicate_line_ratio(self):
+        line_count = self.duplicate_line_count + self.distinct_line_count
+        if line_count == 0:
+            return 0.0
+        return self.duplicate_line_count / line_count
+
+    def estimated_dedup_saved_seconds(self):
+        # the duplicates times the average time of matching a distinct listing, less the time
+        # spent looking them up, plus the duplicate lines times the average time of parsing a
+        # distinct line, not counting the time of the line cache lookups; negative if the
+        # caches cost more than they saved
+        saved_seconds = 0.0
+        if self.distinct_count:
+            saved_seconds += (self.duplicate_count * self.distinct_match_seconds
+                              / self.distinct_count) - self.duplicate_seconds
+        if self.distinct_line_count:
+            saved_seconds += (self.duplicate_line_count * self.distinct_parse_seconds
+                              / self.distinct_line_count)
+        return saved_seconds
+
+
+class Metrics:
+    """
+    Timers, counters and histograms describing a run, dumped by --stats-json.
+
+    Timers accumulate seconds; with --jobs the "parse" and "match" timers are summed over all
+    worker processes, so they can exceed the wall-clock time of the run. When no statistics
+    are requested a NullMetrics is used instead, and the hot loops take their untimed paths.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.timers = collections.defaultdict(float)
+        self.counters = collections.Counter()
+        self.histograms = {}
+
+    def add_time(self, name, seconds):
+        self.timers[name] += seconds
+
+    def timer(self, name):
+        return self.Timer(self, name)
+
+    def increment(self, name, count=1):
+        self.counters[name] += count
+
+    def set_histogram(self, name, histogram):
+        self.histograms[name] = collections.Counter(histogram)
+
+    def add_match_stats(self, reader, stats):
+        self.increment("lines_read", reader.line_count)
+        self.increment("parse_failures", reader.error_count)
+        self.increment("listings_read", stats.listing_count)
+        self.increment("listings_matched", stats.matched_count)
+        self.increment("rejected_unknown_manufacturer", stats.unknown_manufacturer_count)
+        self.increment("resolved_by_specificity", stats.resolved_count)
+        self.increment("rejected_ambiguous", stats.ambiguous_count)
+        self.increment("candidates_examined", stats.candidate_count)
+        self.increment("title_cache_hits", stats.title_cache_hit_count)
+        self.increment("title_cache_misses", stats.title_cache_miss_count)
+        if stats.duplicate_count or stats.distinct_count:
+            self.increment("dedup_duplicate_listings", stats.duplicate_count)
+            self.increment("dedup_distinct_listings", stats.distinct_count)
+            self.add_time("dedup_estimated_saving", stats.estimated_dedup_saved_seconds())
+        if stats.duplicate_line_count or stats.distinct_line_count:
+            self.increment("dedup_duplicate_lines", stats.duplicate_line_count)
+            self.increment("dedup_distinct_lines", stats.distinct_line_count)
+        if stats.candidate_histogram is not None:
+            self.set_histogram("candidates_per_listing", stats.candidate_histogram)
+
+    def add_pipeline_stats(self, pipeline):
+        # the busy time of the parse, match and write stages is that of the serial path's
+        # "parse", "match" and "output" timers; the read stage's is in "read" already
+        timer_names = {"parse": "parse", "match": "match", "write": "output"}
+        for stage in pipeline.stages:
+            if stage.name in timer_names:
+                self.add_time(timer_names[stage.name], stage.busy_seconds)
+            self.add_time("pipeline_{}_input_stall".format(stage.name),
+                          stage.input_stall_seconds)
+            self.add_time("pipeline_{}_output_stall".format(stage.name),
+                          stage.output_stall_seconds)
+            self.increment("pipeline_{}_max_queue_depth".format(stage.name),
+                           stage.max_queue_depth)
+
+    def merge(self, other):
+        for (name, seconds) in other.timers.items():
+            self.timers[name] += seconds
+        self.counters.update(other.counters)
+        for (name, histogram) in other.histograms.items():
+            self.histograms.setdefault(name, collections.Counter()).update(histogram)
+
+    def to_json_object(self):
+        return {
+            "timers_seconds": dict(self.timers),
+            "counters": dict(self.counters),
+            "histograms": {
+                name: {"{}".format(key): count for (key, count) in sorted(histogram.items())}
+                for (name, histogram) in self.histograms.items()
+            },
+        }
+
+    class Timer:
+
+        def __init__(self, metrics, name):
+            self.metrics = metrics
+            self.name = name
+            self.start_time = None
+
+        def __enter__(self):
+            self.start_time = time.perf_counter()
+
+        def __exit__(self, *args):
+            self.metrics.add_time(self.name, time.perf_counter() - self.start_time)
+
+
+class NullMetrics(Metrics):
+
+    enabled = False
+
+    def add_time(self, name, seconds):
+        pass
+
+    def timer(self, name):
+        return self.NullTimer()
+
+    def increment(self, name, count=1):
+        pass
+
+    def set_histogram(self, name, histogram):
+        pass
+
+    def add_match_stats(self, reader, stats):
+        pass
+
+    def add_pipeline_stats(self, pipeline):
+        pass
+
+    def merge(self, other):
+        pass
+
+    class NullTimer:
+
+        def __enter__(self):
+            pass
+
+        def __exit__(self, *args):
+            pass
+
+
+def timed_iter(iterable, metrics, name):
+    # Yields the items of the given iterable, adding the time spent producing them to a timer
+    perf_counter = time.perf_counter
+    iterator = iter(iterable)
+    elapsed_time = 0.0
+    try:
+        while True:
+            start_time = perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                elapsed_time += perf_counter() - start_time
+            yield item
+    finally:
+        metrics.add_time(name, elapsed_time)
+
+
+class ProgressReporter:
+
+    CHECK_INTERVAL = 4096
+
+    def __init__(self, logger, interval, reader, stats):
         self.logger = logger
+        self.interval = interval
+        self.reader = reader
+        self.stats = stats
+        self.start_time = None
+        self.next_report_time = None
 
-    def run(self):
-        self.log("Reading products from file: {}".format(self.products_path))
-        self.log("Reading listings from file: {}".format(self.listings_path))
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.next_report_time = self.start_time + self.interval
+
+    def track(self, lines):
+        perf_counter = time.perf_counter
+        check_interval = self.CHECK_INTERVAL
+        self.start()
+        for (i, line) in enumerate(lines, 1):
+            if i % check_interval == 0 and perf_counter() >= self.next_report_time:
+                self.report()
+            yield line
+
+    def check(self):
+        if time.perf_counter() >= self.next_report_time:
+            self.report()
+
+    def report(self):
+        now = time.perf_counter()
+        self.next_report_time = now + self.interval
+        elapsed_time = now - self.start_time
+        line_count = self.reader.line_count
+        self.logger.info(
+            "Progress: {} lines read ({:.0f} lines/sec), {} listings matched, "
+            "{} malformed lines".format(
+                line_count, line_count / elapsed_time if elapsed_time > 0 else 0.0,
+                self.stats.matched_count, self.reader.error_count))
+
+
+class Profiler:
+    """
+    Profiles a run and logs a summary of the hottest functions.
+
+    With --jobs, each worker process profiles itself into "<output>.worker-<pid>" when it exits;
+    the summary logged at the end of the run covers the main process and all workers.
+    """
+
+    NAME = None
+    DEFAULT_OUTPUT_PATH = None
+    DEFAULT_TOP_COUNT = 20
+
+    def __init__(self, output_path, logger=None, top_count=None, is_worker=False):
+        self.output_path = output_path
+        self.logger = logger
+        self.top_count = self.DEFAULT_TOP_COUNT if top_count is None else top_count
+        self.is_worker = is_worker
+
+    def run(self, func):
+        for path in self.worker_output_paths():
+            os.remove(path)
+        self.start()
+        try:
+            return func()
+        finally:
+            self.stop_and_write()
+            self.log_summary()
+
+    def start(self):
+        raise NotImplementedError()
+
+    def stop(self):
+        raise NotImplementedError()
+
+    def write(self):
+        raise NotImplementedError()
+
+    def log_summary(self):
+        raise NotImplementedError()
+
+    def stop_and_write(self):
+        self.stop()
+        self.write()
+
+    def worker_config(self):
+        kwargs = {"output_path": self.output_path, "top_count": self.top_count, "is_worker": True}
+        return (type(self), kwargs)
+
+    def current_output_path(self):
+        if self.is_worker:
+            return "{}.worker-{}".format(self.output_path, os.getpid())
+        return self.output_path
+
+    def worker_output_paths(self):
+        return sorted(glob.glob(glob.escape(self.output_path) + ".worker-*"))
 
     def log(self, message):
         self.logger.info(message)
 
-    class Error(Exception):
-        pass
 
+class CProfileProfiler(Profiler):
 
-class ArgumentParser(argparse.ArgumentParser):
+    NAME = "cProfile"
+    DEFAULT_OUTPUT_PATH = "ProductListingMatcher.prof"
 
-    def __init__(self):
-        super().__init__()
-        self.add_arguments()
+    def __init__(self, output_path, logger=None, top_count=None, is_worker=False):
+        super().__init__(output_path, logger=logger, top_count=top_count, is_worker=is_worker)
+        self.profile = None
 
-    def add_arguments(self):
-        self.add_argument(
-            "-p", "--products-file",
-            default="products.txt",
-            help="""The path of the file containing the products, one per line
-            (default: %(default)s)"""
-        )
+    def start(self):
+        import cProfile
+        self.profile = cProfile.Profile()
+        self.profile.enable()
 
-        self.add_argument(
-            "-l", "--listings-file",
-            default="listings.txt",
-            help="""The path of the file containing the listings, one per line
-            (default: %(default)s)"""
-        )
+    def stop(self):
+        self.profile.disable()
 
-    def parse_args(self, args=None, namespace=None):
-        namespace = self.Namespace(self)
-        super().parse_args(args=args, namespace=namespace)
-        app = namespace.create_application()
-        return app
+    def write(self):
+        self.profile.dump_stats(self.current_output_path())
 
-    def exit(self, status=0, message=None):
-        raise self.Error(message, status)
+    def log_summary(self):
+        import pstats
+        stats = pstats.Stats(self.output_path)
+        worker_output_paths = self.worker_output_paths()
+        for path in worker_output_paths:
+            stats.add(path)
+        self.log("Wrote profile: {} ({} worker profile(s))".format(
+            self.output_path, len(worker_output_paths)))
+        stream = io.StringIO()
+        stats.stream = stream
+        stats.sort_stats("cumulative").print_stats(self.top_count)
+        for line in stream.getvalue().splitlines():
+            if line.strip():
+                self.log(line)
 
-    def error(self, message):
-        self.exit(2, message)
 
-    class Namespace(argparse.Namespace):
+class SamplingProfiler(Profiler):
+    """
+    A low-overhead statistical profiler: a SIGPROF timer interrupts the process every few
+    milliseconds of CPU time and the current call stack is counted. The output is in the
+    "collapsed stacks" format ("outer;inner;leaf count" per line) understood by flame graph
+    tools; the output of the worker processes can be merged by concatenating the files.
+    """
 
-        def __init__(self, parser):
-            self.parser = parser
+    NAME = "sampling profiler"
+    DEFAULT_OUTPUT_PATH = "ProductListingMatcher.stacks"
+    DEFAULT_INTERVAL = 0.005
 
-        def create_application(self):
-            products_path = self.products_file
-            listings_path = self.listings_file
+    def __init__(self, output_path, logger=None, top_count=None, is_worker=False,
+                 interval=None):
+        super().__init__(output_path, logger=logger, top_count=top_count, is_worker=is_worker)
+        self.interval = self.DEFAULT_INTERVAL if interval is None else interval
+        self.samples = collections.Counter()
+        self.previous_handler = None
 
-            logger = logging.Logger(name=__name__)
-            handler = logging.StreamHandler(sys.stdout)
-            logger.addHandler(handler)
+    @classmethod
+    def is_supported(cls):
+        return hasattr(signal, "setitimer") and hasattr(signal, "SIGPROF")
+
+    def start(self):
+        self.previous_handler = signal.signal(signal.SIGPROF, self.on_signal)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self.previous_handler)
+
+    def on_signal(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("{}:{}:{}".format(
+                os.path.basename(code.co_filename), code.co_firstlineno, code.co_name))
+            frame = frame.f_back
+        stack.reverse()
+        self.samples[";".join(stack)] += 1
+
+    def worker_config(self):
+        (profiler_class, kwargs) = super().worker_config()
+        kwargs["interval"] = self.interval
+        return (profiler_class, kwargs)
+
+    def write(self):
+        with open(self.current_output_path(), "wt", encoding="utf8") as f:
+            for (stack, count) in sorted(self.samples.items()):
+                f.write("{} {}\n".format(stack, count))
+
+    def log_summary(self):
+        self_counts = collections.Counter()
+        total_count = 0
+        worker_output_paths = self.worker_output_paths()
+        for path in [self.output_path] + worker_output_paths:
+            with open(path, "rt", encoding="utf8") as f:
+                for line in f:
+                    (stack, count) = line.rsplit(" ", 1)
+                    self_counts[stack.rsplit(";", 1)[-1]] += int(count)
+                    total_count += int(count)
+
+        self.log("Wrote profile: {} ({} worker profile(s), {} samples)".format(
+            self.output_path, len(worker_output_paths), total_count))
+        self.log("Functions with the most samples:")
+        for (function, count) in self_counts.most_common(self.top_count):
+            self.log("{:8} {:6.1%}  {}".format(count, count / total_count, function))
+
+
+class ResultsWriter:
+    """
+    Writes the matched listings grouped by product, one JSON object per product per line.
+
+    Matches are buffered as (product index, sequence number, listing JSON) tuples; whenever the
+    buffer is full it is sorted and spilled to a temporary "run" file. write() then does a k-way
+    merge of the runs, so memory use is bounded by the buffer size no matter how many listings
+    match. Products are written in the order they were read and the listings of each product
+    in the order they were added. If skip_unmatched is true then products without listings are
+    left out. After write(), listing_counts holds the number of listings written per product.
+    If a PriceFilter is given, every listing added is also added to it, by sequence number, and
+    the listings it rejects are left out.
+    """
+
+    DEFAULT_MAX_BUFFERED_COUNT = 100000
+    MAX_RUN_COUNT = 64
+
+    def __init__(self, path, products, max_buffered_count=None, skip_unmatched=False,
+                 price_filter=None):
+        self.path = path
+        self.products = products
+        self.skip_unmatched = skip_unmatched
+        self.price_filter = price_filter
+        self.listing_counts = None
+        if max_buffered_count is None:
+            max_buffered_count = self.DEFAULT_MAX_BUFFERED_COUNT
+        self.max_buffered_count = max_buffered_count
+        self.buffer = []
+        self.run_paths = []
+        self.run_count = 0
+        self.sequence = 0
+        self.temp_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.buffer = []
+        self.run_paths = []
+        if self.temp_dir is not None:
+            self.temp_dir.cleanup()
+            self.temp_dir = None
+
+    def add(self, product_index, listing):
+        if self.price_filter is not None:
+            self.price_filter.add(product_index, listing)
+        self.buffer.append((product_index, self.sequence, encode_listing(listing)))
+        self.sequence += 1
+        if len(self.buffer) >= self.max_buffered_count:
+            self.spill()
+
+    def spill(self):
+        self.buffer.sort()
+        self.write_run(self.buffer)
+        self.buffer = []
+        self.compact_runs()
+
+    def compact_runs(self):
+        if len(self.run_paths) >= self.MAX_RUN_COUNT:
+            run_paths = self.run_paths
+            self.run_paths = []
+            self.write_run(self.merge_runs(run_paths))
+            for run_path in run_paths:
+                os.remove(run_path)
+
+    def write_run(self, records):
+        run_path = self.create_run_path()
+        self.write_run_file(run_path, records)
+        self.run_paths.append(run_path)
+
+    def create_run_path(self):
+        if self.temp_dir is None:
+            self.temp_dir = tempfile.TemporaryDirectory(prefix="ProductListingMatcher-")
+        run_path = os.path.join(self.temp_dir.name, "run{}.txt".format(self.run_count))
+        self.run_count += 1
+        return run_path
+
+    def add_run(self, run_path):
+        """
+        Adds a run file written elsewhere, e.g. by a worker process, with write_run_file() to
+        a path from create_run_path(). Its sequence numbers must not clash with those of the
+        other runs, or of the listings added with add().
+        """
+        self.run_paths.append(run_path)
+        self.compact_runs()
+
+    @staticmethod
+    def write_run_file(run_path, records):
+        with open(run_path, "wt", encoding="utf8") as f:
+            for (product_index, sequence, listing_json) in records:
+                f.write("{}\t{}\t{}\n".format(product_index, sequence, listing_json))
+
+    @staticmethod
+    def read_run(path):
+        with open(path, "rt", encoding="utf8") as f:
+            for line in f:
+                (product_index, sequence, listing_json) = line.rstrip("\n").split("\t", 2)
+                yield (int(product_index), int(sequence), listing_json)
+
+    def merge_runs(self, run_paths):
+        return heapq.merge(*[self.read_run(run_path) for run_path in run_paths])
 
-            return ProductListingMatcher(products_path, listings_path, logger)
+    def write(self):
+        self.buffer.sort()
+        if self.run_paths:
+            if self.buffer:
+                self.spill()
+            records = self.merge_runs(self.run_paths)
+        else:
+            records = iter(self.buffer)
+        if self.price_filter is not None:
+            if self.price_filter.rejected is None:
+                self.price_filter.apply(len(self.products))
+            rejected = self.price_filter.rejected
+            if rejected:
+                records = (record for record in records if record[1] not in rejected)
+
+        matched_product_count = 0
+        listing_counts = [0] * len(self.products)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wt", encoding="utf8") as f:
+            record = next(records, None)
+            for (product_index, product) in enumerate(self.products):
+                if self.skip_unmatched and (record is None or record[0] != product_index):
+                    continue
+                f.write('{"product_name": ')
+                f.write(json.dumps(product.name, ensure_ascii=False))
+                f.write(', "listings": [')
+                listing_count = 0
+                while record is not None and record[0] == product_index:
+                    if listing_count > 0:
+                        f.write(", ")
+                    f.write(record[2])
+                    listing_count += 1
+                    record = next(records, None)
+                f.write("]}\n")
+                if listing_count > 0:
+                    matched_product_count += 1
+                    listing_counts[product_index] = listing_count
+        os.replace(temp_path, self.path)
+        self.listing_counts = listing_counts
+        return matched_product_count
+
+
+def is_numpy_installed():
+    # without importing NumPy, which is only needed by the PriceFilter and slow to import
+    return importlib.util.find_spec("numpy") is not None
+
+
+class PriceFilter:
+    """
+    Rejects matched listings priced far below the other listings of the same product.
+
+    Accessories such as batteries, cases and lenses often name the camera they fit, so they
+    match it, but they cost a fraction of what the camera does. add() records the product
+    index, price and currency of each matched listing in compact arrays, indexed by sequence
+    number; apply() then converts every price to the base currency, computes the median price
+    of each product and compares each listing to it in a handful of NumPy operations over all
+    products at once. Prices in currencies missing from exchange_rates are neither used for the
+    medians nor rejected. The exchange rates only need to be roughly right, since the ratio is
+    so far below one.
+    """
+
+    DEFAULT_MIN_RATIO = 0.25
+
+    # units of each currency per US dollar
+    DEFAULT_EXCHANGE_RATES = {"USD": 1.0, "CAD": 1.03, "EUR": 0.74, "GBP": 0.64}
+
+    def __init__(self, min_ratio=None, exchange_rates=None):
+        if min_ratio is None:
+            min_ratio = self.DEFAULT_MIN_RATIO
+        self.min_ratio = min_ratio
+        if exchange_rates is None:
+            exchange_rates = self.DEFAULT_EXCHANGE_RATES
+        self.exchange_rates = exchange_rates
+        self.currency_codes = {}
+        self.product_indexes = array.array("q")
+        self.prices = array.array("d")
+        self.currencies = array.array("h")
+        self.medians = None
+        self.rejected = None
+        self.rejected_count = 0
+
+    def listing_count(self):
+        return len(self.prices)
+
+    def add(self, product_index, listing):
+        currency_code = self.currency_codes.get(listing.currency)
+        if currency_code is None:
+            currency_code = self.currency_codes[listing.currency] = len(self.currency_codes)
+        self.product_indexes.append(product_index)
+        self.prices.append(float(listing.price))
+        self.currencies.append(currency_code)
+
+    def apply(self, product_count):
+        """
+        Computes the set of sequence numbers of the rejected listings.
+        """
+        import numpy
+        product_indexes = numpy.frombuffer(self.product_indexes, dtype=numpy.int64)
+        currencies = numpy.frombuffer(self.currencies, dtype=numpy.int16)
+        rates = numpy.full(len(self.currency_codes), numpy.nan)
+        for (currency, currency_code) in self.currency_codes.items():
+            rates[currency_code] = self.exchange_rates.get(currency, numpy.nan)
+        prices = numpy.frombuffer(self.prices, dtype=numpy.float64) / rates[currencies]
+
+        medians = self.medians = self.compute_medians(product_indexes, prices, product_count)
+        with numpy.errstate(invalid="ignore"):
+            rejected = prices < medians[product_indexes] * self.min_ratio
+        rejected_sequences = numpy.flatnonzero(rejected)
+        self.rejected = set(rejected_sequences.tolist())
+        self.rejected_count = len(rejected_sequences)
+        return self.rejected
+
+    @staticmethod
+    def compute_medians(product_indexes, prices, product_count):
+        """
+        Returns the median price of each product, NaN for products without a valid price.
+        """
+        import numpy
+        valid = numpy.isfinite(prices)
+        product_indexes = product_indexes[valid]
+        prices = prices[valid]
+        # sorted by product, then price, so each product's prices form one sorted slice
+        order = numpy.lexsort((prices, product_indexes))
+        sorted_prices = prices[order]
+        counts = numpy.bincount(product_indexes, minlength=product_count)
+        starts = numpy.cumsum(counts) - counts
+        medians = numpy.full(product_count, numpy.nan)
+        has_prices = counts > 0
+        starts = starts[has_prices]
+        counts = counts[has_prices]
+        medians[has_prices] = (sorted_prices[starts + (counts - 1) // 2]
+                               + sorted_prices[starts + counts // 2]) / 2
+        return medians
+
+    def explain(self, sequence):
+        """
+        Returns a dict describing the outcome for the listing with a sequence number, after
+        apply(): its price and its product's median price in the base currency, None if its
+        currency has no exchange rate or its product no valid price, and whether it was
+        rejected.
+        """
+        currency_code = self.currencies[sequence]
+        currency = next(currency for (currency, code) in self.currency_codes.items()
+                        if code == currency_code)
+        rate = self.exchange_rates.get(currency)
+        price = None if rate is None else self.prices[sequence] / rate
+        median = float(self.medians[self.product_indexes[sequence]])
+        return {
+            "price": price,
+            "median_price": None if math.isnan(median) else median,
+            "min_ratio": self.min_ratio,
+            "rejected": sequence in self.rejected,
+        }
+
+
+class MatchAuditor:
+    """
+    Writes explanations of how a sample of the listings were matched to a JSON lines file, to
+    find out why a listing matched the wrong product: the model keys found in its title, the
+    candidate products and their scores, how ties between candidates were decided and, if a
+    PriceFilter is used, the price filter outcome.
+
+    A listing is audited if its manufacturer is one of manufacturers and one of products is
+    among its candidates, if they are given, and then with probability sample_rate. Instead of
+    drawing a random number for each listing, the number of listings to skip until the next
+    sampled one is drawn from a geometric distribution. Listings that are not audited are only
+    counted, and when no audit file is given the matching does not go through the auditor at
+    all. The records of matched listings need the price filter outcome, which is only known
+    once every listing has been matched, so with a PriceFilter all the records are kept until
+    close(); otherwise they are written as they are made.
+    """
+
+    DEFAULT_SAMPLE_RATE = 1.0
+
+    def __init__(self, path, index, sample_rate=None, products=None, manufacturers=None,
+                 price_filter=None):
+        import random
+        self.path = path
+        self.index = index
+        if sample_rate is None:
+            sample_rate = self.DEFAULT_SAMPLE_RATE
+        self.sample_rate = sample_rate
+        self.random = random.Random()
+        self.skip_count = self.next_skip_count()
+        self.price_filter = price_filter
+        self.pending = None if price_filter is None else []
+        self.record_count = 0
+        self.unknown_names = []
+
+        self.product_names = None
+        self.manufacturer_ids = None
+        if manufacturers:
+            self.manufacturer_ids = set()
+            for name in manufacturers:
+                manufacturer_id = index.manufacturers.lookup(name)
+                if manufacturer_id is None:
+                    self.unknown_names.append(name)
+                else:
+                    self.manufacturer_ids.add(manufacturer_id)
+        if products:
+            # only the listings of the products' manufacturers can have them as candidates
+            products_by_name = {product.name: product for product in index.products}
+            self.product_names = set()
+            product_manufacturer_ids = set()
+            for name in products:
+                product = products_by_name.get(name)
+                if product is None:
+                    self.unknown_names.append(name)
+                else:
+                    self.product_names.add(name)
+                    product_manufacturer_ids.add(index.manufacturers.lookup(product.manufacturer))
+            if self.manufacturer_ids is None:
+                self.manufacturer_ids = product_manufacturer_ids
+            else:
+                self.manufacturer_ids &= product_manufacturer_ids
+
+        try:
+            self.f = open(path, "wt", encoding="utf8")
+        except OSError as e:
+            raise self.Error("unable to write audit file: {} ({})".format(path, e.strerror))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def next_skip_count(self):
+        if self.sample_rate >= 1.0:
+            return 0
+        return int(math.log(1.0 - self.random.random()) / math.log(1.0 - self.sample_rate))
+
+    def is_sampled(self):
+        if self.skip_count > 0:
+            self.skip_count -= 1
+            return False
+        self.skip_count = self.next_skip_count()
+        return True
+
+    def audit(self, line_number, listing, sequence=None):
+        """
+        Audits a listing, if it is selected, given its sequence number in the ResultsWriter
+        if it matched a product.
+        """
+        if (self.manufacturer_ids is not None
+                and self.index.manufacturers.lookup(listing.manufacturer)
+                not in self.manufacturer_ids):
+            return
+        if self.product_names is None:
+            if not self.is_sampled():
+                return
+            explanation = self.index.explain_listing(listing)
+        else:
+            explanation = self.index.explain_listing(listing)
+            if not any(candidate["product"] in self.product_names
+                       for candidate in explanation["candidates"]):
+                return
+            if not self.is_sampled():
+                return
+
+        record = {
+            "line_number": line_number,
+            "title": listing.title,
+            "manufacturer": listing.manufacturer,
+            "currency": listing.currency,
+            "price": str(listing.price),
+        }
+        record.update(explanation)
+        self.record_count += 1
+        if self.pending is None:
+            self.write(record)
+        else:
+            self.pending.append((sequence, record))
+
+    def write(self, record):
+        try:
+            self.f.write(json.dumps(record, ensure_ascii=False))
+            self.f.write("\n")
+        except OSError as e:
+            raise self.Error("unable to write audit file: {} ({})".format(
+                self.path, e.strerror))
+
+    def close(self):
+        """
+        Writes the records kept for the price filter outcome, which must have been applied
+        unless matching failed, and closes the file.
+        """
+        try:
+            if self.pending and self.price_filter.rejected is not None:
+                for (sequence, record) in self.pending:
+                    if sequence is None:
+                        record["price_filter"] = None
+                    else:
+                        record["price_filter"] = self.price_filter.explain(sequence)
+                    self.write(record)
+            self.pending = None
+        finally:
+            try:
+                self.f.close()
+            except OSError as e:
+                raise self.Error("unable to write audit file: {} ({})".format(
+                    self.path, e.strerror))
 
     class Error(Exception):
+        pass
 
-        def __init__(self, message, exit_code):
-            super().__init__(message)
-            self.exit_code = exit_code
+
+def encode_listing(listing):
+    return json.dumps({
+        "title": listing.title,
+        "manufacturer": listing.manufacturer,
+        "currency": listing.currency,
+        "price": "{}".format(listing.price),
+    }, ensure_ascii=False)
 
 
 class Product:
 
+    __slots__ = ("name", "manufacturer", "model", "family", "announced_date")
+
     def __init__(self, name, manufacturer, model, family, announced_date):
         self.name = name
         self.manufacturer = manufacturer
@@ -162,9 +3803,14 @@ class Product:
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    def __hash__(self):
+        return hash((self.name, self.manufacturer, self.model, self.family, self.announced_date))
+
 
 class Listing:
 
+    __slots__ = ("title", "manufacturer", "currency", "price")
+
     def __init__(self, title, manufacturer, currency, price):
         self.title = title
         self.manufacturer = manufacturer
@@ -203,6 +3849,128 @@ class Listing:
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    def __hash__(self):
+        return hash((self.title, self.manufacturer, self.currency, self.price))
+
+
+class ListingBatch:
+    """
+    Listings held as parallel columns rather than as one Listing object each, so that parsing
+    and matching them allocates no objects per listing beyond the title strings decoded from
+    the JSON. listing() creates the Listing of a row, which is only needed for the listings
+    written to the results.
+
+    The manufacturers and currencies are codes into manufacturer_names and currency_names,
+    which hold each distinct name of the batch once. Prices are fixed-point: price_units times
+    ten to the power of price_exponents, which gives back exactly the Decimal that parsing the
+    price would, trailing zeros included. Prices that do not fit, such as those in exponent
+    notation or with more than MAX_PRICE_DIGITS digits, are kept as Decimals in decimal_prices
+    instead, by row. line_numbers holds the line each listing was read from.
+    """
+
+    DEFAULT_SIZE = 1000
+    MAX_PRICE_DIGITS = 18
+    PRICE_REGEX = re.compile(r"(-?)([0-9]+)(?:\.([0-9]+))?")
+
+    def __init__(self):
+        self.titles = []
+        self.manufacturer_codes = array.array("i")
+        self.currency_codes = array.array("i")
+        self.price_units = array.array("q")
+        self.price_exponents = array.array("b")
+        self.decimal_prices = {}
+        self.line_numbers = array.array("q")
+        self.manufacturer_names = []
+        self.currency_names = []
+        self.manufacturer_codes_by_name = {}
+        self.currency_codes_by_name = {}
+
+    def __len__(self):
+        return len(self.titles)
+
+    def append(self, line_number, title, manufacturer, currency, price_str):
+        """
+        Appends a listing whose price is a plain decimal number, such as "129.99", and returns
+        True; returns False, appending nothing, if the price is in any other form, which the
+        caller then parses into a Listing for append_listing().
+        """
+        match = self.PRICE_REGEX.fullmatch(price_str)
+        if match is None:
+            return False
+        (sign, integer_digits, fraction_digits) = match.groups()
+        if fraction_digits is None:
+            digits = integer_digits
+            exponent = 0
+        else:
+            digits = integer_digits + fraction_digits
+            exponent = -len(fraction_digits)
+        if len(digits) > self.MAX_PRICE_DIGITS:
+            return False
+        units = int(digits)
+        if sign:
+            if units == 0:
+                return False  # a negative zero, which only a Decimal keeps
+            units = -units
+
+        # inlined, rather than shared with append_listing(), since this is the common path
+        manufacturer_code = self.manufacturer_codes_by_name.get(manufacturer)
+        if manufacturer_code is None:
+            manufacturer_code = self.add_name(
+                manufacturer, self.manufacturer_names, self.manufacturer_codes_by_name)
+        currency_code = self.currency_codes_by_name.get(currency)
+        if currency_code is None:
+            currency_code = self.add_name(
+                currency, self.currency_names, self.currency_codes_by_name)
+        self.titles.append(title)
+        self.manufacturer_codes.append(manufacturer_code)
+        self.currency_codes.append(currency_code)
+        self.price_units.append(units)
+        self.price_exponents.append(exponent)
+        self.line_numbers.append(line_number)
+        return True
+
+    def append_listing(self, line_number, listing):
+        self.decimal_prices[len(self.titles)] = listing.price
+        manufacturer_code = self.manufacturer_codes_by_name.get(listing.manufacturer)
+        if manufacturer_code is None:
+            manufacturer_code = self.add_name(
+                listing.manufacturer, self.manufacturer_names, self.manufacturer_codes_by_name)
+        currency_code = self.currency_codes_by_name.get(listing.currency)
+        if currency_code is None:
+            currency_code = self.add_name(
+                listing.currency, self.currency_names, self.currency_codes_by_name)
+        self.titles.append(listing.title)
+        self.manufacturer_codes.append(manufacturer_code)
+        self.currency_codes.append(currency_code)
+        self.price_units.append(0)
+        self.price_exponents.append(0)
+        self.line_numbers.append(line_number)
+
+    @staticmethod
+    def add_name(name, names, codes_by_name):
+        code = codes_by_name[name] = len(names)
+        names.append(sys.intern(name))
+        return code
+
+    def price_key(self, row):
+        """
+        Returns the price of a row in a form that compares and hashes like it, without creating
+        a Decimal for it.
+        """
+        if self.decimal_prices and row in self.decimal_prices:
+            return self.decimal_prices[row]
+        return (self.price_units[row], self.price_exponents[row])
+
+    def listing(self, row):
+        if self.decimal_prices and row in self.decimal_prices:
+            price = self.decimal_prices[row]
+        else:
+            price = decimal.Decimal(self.price_units[row]).scaleb(self.price_exponents[row])
+        return Listing(self.titles[row],
+                       self.manufacturer_names[self.manufacturer_codes[row]],
+                       self.currency_names[self.currency_codes[row]],
+                       price)
+
 
 if __name__ == "__main__":
     try:
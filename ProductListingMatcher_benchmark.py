@@ -0,0 +1,824 @@
+#!/usr/bin/env python3
+
+"""
+ProductListingMatcher_benchmark.py
+By: Denver Coneybeare <denver@sleepydragon.org>
+Oct 18, 2026
+
+Benchmarks for ProductListingMatcher.py; run with --help for the available benchmarks.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import collections
+import datetime
+import decimal
+import gc
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+from ProductListingMatcher import AhoCorasickAutomaton
+from ProductListingMatcher import JSON_BACKENDS
+from ProductListingMatcher import Listing
+from ProductListingMatcher import ListingBatch
+from ProductListingMatcher import ListingsReader
+from ProductListingMatcher import MatchAuditor
+from ProductListingMatcher import MatchStats
+from ProductListingMatcher import Product
+from ProductListingMatcher import Pipeline
+from ProductListingMatcher import ProductIndex
+from ProductListingMatcher import ProductListingMatcher
+from ProductListingMatcher import ResultsWriter
+from ProductListingMatcher import load_json_backend
+
+
+SCALES = {
+    "small": (1000, 20000),
+    "medium": (5000, 1000000),
+    "large": (10000, 10000000),
+}
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument(
+        "-r", "--report-file",
+        default=None,
+        help="""The path of the file to which to write the JSON report
+        (default: standard output)""",
+    )
+    subparsers = arg_parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    memory_parser = subparsers.add_parser(
+        "memory",
+        help="""Measure the number of bytes allocated per Product and Listing object""",
+    )
+    memory_parser.add_argument(
+        "-n", "--count",
+        type=int,
+        default=100000,
+        help="""The number of objects to create of each type (default: %(default)s)""",
+    )
+
+    generate_parser = subparsers.add_parser(
+        "generate",
+        help="""Generate synthetic products and listings files""",
+    )
+    add_data_arguments(generate_parser)
+
+    pipeline_parser = subparsers.add_parser(
+        "pipeline",
+        help="""Time each phase of ProductListingMatcher on synthetic data, generating it
+        first if it does not already exist in the data directory""",
+    )
+    add_data_arguments(pipeline_parser)
+    pipeline_parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=1,
+        help="""The number of processes to use to match listings (default: %(default)s)""",
+    )
+
+    pipeline_parser.add_argument(
+        "--json-backend",
+        choices=["auto"] + list(JSON_BACKENDS),
+        default="auto",
+        help="""The library with which to decode JSON (default: %(default)s)""",
+    )
+
+    pipeline_parser.add_argument(
+        "--dedup",
+        nargs="?",
+        type=int,
+        const=ProductIndex.DEFAULT_DEDUP_CACHE_SIZE,
+        default=None,
+        metavar="ENTRIES",
+        help="""Match each distinct listing once, caching the outcomes of the last ENTRIES
+        listings (default if specified without a value: %(const)s)""",
+    )
+
+    pipeline_parser.add_argument(
+        "--dedup-parse",
+        action="store_true",
+        default=False,
+        help="""With --dedup, also parse each distinct line once""",
+    )
+
+    pipeline_parser.add_argument(
+        "--pipeline",
+        nargs="?",
+        type=int,
+        const=Pipeline.DEFAULT_QUEUE_SIZE,
+        default=None,
+        metavar="BATCHES",
+        help="""Match in a pipeline of threads with up to BATCHES batches queued between
+        stages (default if specified without a value: %(const)s)""",
+    )
+
+    pipeline_parser.add_argument(
+        "--columnar",
+        action="store_true",
+        default=False,
+        help="""Parse and match the listings in columnar batches""",
+    )
+
+    pipeline_parser.add_argument(
+        "--engine",
+        choices=list(ProductIndex.ENGINES),
+        default="token",
+        help="""The engine with which to find the models in titles (default: %(default)s)""",
+    )
+
+    engines_parser = subparsers.add_parser(
+        "engines",
+        help="""Compare the matching throughput and results of the matching engines, generating
+        the data first if it does not already exist in the data directory""",
+    )
+    add_data_arguments(engines_parser)
+
+    batches_parser = subparsers.add_parser(
+        "batches",
+        help="""Compare the throughput, garbage collections and peak memory of parsing and
+        matching the listings as one Listing object each and as columnar ListingBatches,
+        generating the data first if it does not already exist in the data directory""",
+    )
+    add_data_arguments(batches_parser)
+
+    audit_parser = subparsers.add_parser(
+        "audit",
+        help="""Compare the time to match the listings without an audit file and with audit
+        files sampling several fractions of the listings, generating the data first if it does
+        not already exist in the data directory""",
+    )
+    add_data_arguments(audit_parser)
+
+    json_parser = subparsers.add_parser(
+        "json",
+        help="""Measure the throughput of reading and parsing the listings file with each
+        installed JSON backend, generating it first if it does not already exist in the data
+        directory""",
+    )
+    add_data_arguments(json_parser)
+
+    args = arg_parser.parse_args()
+    if args.benchmark == "memory":
+        report = run_memory_benchmark(args.count)
+    elif args.benchmark == "generate":
+        (products_path, listings_path) = generate_data(args)
+        report = {"products_path": products_path, "listings_path": listings_path}
+    elif args.benchmark == "pipeline":
+        report = run_pipeline_benchmark(args)
+    elif args.benchmark == "json":
+        report = run_json_benchmark(args)
+    elif args.benchmark == "engines":
+        report = run_engines_benchmark(args)
+    elif args.benchmark == "batches":
+        report = run_batches_benchmark(args)
+    elif args.benchmark == "audit":
+        report = run_audit_benchmark(args)
+
+    report["environment"] = environment_info()
+    if args.report_file is None:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        with open(args.report_file, "wt", encoding="utf8") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            print(file=f)
+    return 0
+
+
+def add_data_arguments(parser):
+    parser.add_argument(
+        "-s", "--scale",
+        choices=sorted(SCALES),
+        default="small",
+        help="""The number of products and listings to generate: {}
+        (default: %(default)s)""".format(", ".join(
+            "{}={}x{}".format(name, *SCALES[name]) for name in sorted(SCALES))),
+    )
+    parser.add_argument(
+        "--products",
+        type=int,
+        default=None,
+        help="""The number of products to generate; overrides --scale""",
+    )
+    parser.add_argument(
+        "--listings",
+        type=int,
+        default=None,
+        help="""The number of listings to generate; overrides --scale""",
+    )
+    parser.add_argument(
+        "--duplicates",
+        type=float,
+        default=0.0,
+        metavar="FRACTION",
+        help="""The fraction of listings that repeat a recent listing, some with the case and
+        spacing of the title changed (default: %(default)s)""",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=1,
+        help="""The seed of the random number generator (default: %(default)s)""",
+    )
+    parser.add_argument(
+        "-d", "--data-dir",
+        default=os.path.join(tempfile.gettempdir(), "ProductListingMatcher_benchmark"),
+        help="""The directory in which to store the generated files (default: %(default)s)""",
+    )
+
+
+def generate_data(args):
+    (product_count, listing_count) = SCALES[args.scale]
+    if args.products is not None:
+        product_count = args.products
+    if args.listings is not None:
+        listing_count = args.listings
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    suffix = "{}x{}-{}".format(product_count, listing_count, args.seed)
+    if args.duplicates:
+        suffix += "-dup{}".format(args.duplicates)
+    products_path = os.path.join(args.data_dir, "products-{}.txt".format(suffix))
+    listings_path = os.path.join(args.data_dir, "listings-{}.txt".format(suffix))
+    if not (os.path.exists(products_path) and os.path.exists(listings_path)):
+        generator = SyntheticDataGenerator(args.seed)
+        products = generator.generate_products(product_count)
+        write_lines(products_path, (json.dumps(product) for product in products))
+        listings = generator.generate_listings(products, listing_count, args.duplicates)
+        write_lines(listings_path, (json.dumps(listing) for listing in listings))
+    return (products_path, listings_path)
+
+
+def write_lines(path, lines):
+    temp_path = path + ".tmp"
+    with open(temp_path, "wt", encoding="utf8") as f:
+        for line in lines:
+            f.write(line)
+            f.write("\n")
+    os.replace(temp_path, path)
+
+
+class SyntheticDataGenerator:
+    """
+    Generates products and listings resembling the challenge data.
+
+    Manufacturers, and products within the catalogue, are drawn from a Zipf-like distribution
+    so a few of them dominate. Listing titles spell the model with random noise (case changes,
+    hyphens dropped or replaced by spaces, letters split from digits), a share of listings are
+    accessories that mention a model, and the rest are for unknown products or manufacturers.
+    Prices are in one of several currencies. Optionally, a fraction of the listings repeat one
+    of the last RECENT_LISTING_COUNT listings, like the same item listed by several sellers.
+    """
+
+    MANUFACTURERS = [
+        ("Canon", ["Canon", "Canon Canada", "CANON", "Canon USA"],
+         ["PowerShot", "EOS", "IXUS"], ["A", "SX", "G", "D"]),
+        ("Sony", ["Sony", "Sony Electronics", "SONY"],
+         ["Cyber-shot", "Alpha"], ["DSC-W", "DSC-H", "DSLR-A", "NEX-"]),
+        ("Nikon", ["Nikon", "Nikon Canada", "NIKON"], ["Coolpix", None], ["S", "L", "P", "D"]),
+        ("Samsung", ["Samsung", "SAMSUNG"], [None, "Digimax"], ["TL", "ST", "PL", "WB"]),
+        ("Fujifilm", ["Fujifilm", "FUJI PHOTO", "Fuji", "FUJIFILM Canada"],
+         ["FinePix"], ["XP", "S", "Z", "JX"]),
+        ("Panasonic", ["Panasonic", "PANASONIC"], ["Lumix"], ["DMC-FX", "DMC-TZ", "DMC-G"]),
+        ("Olympus", ["Olympus", "OLYMPUS"], ["Stylus", "PEN", None], ["E-P", "SP-", "FE-"]),
+        ("Kodak", ["Kodak", "Eastman Kodak"], ["EasyShare", None], ["M", "C", "Z"]),
+        ("Pentax", ["Pentax", "PENTAX"], ["Optio", None], ["WG-", "RS", "K-"]),
+        ("Casio", ["Casio", "CASIO"], ["Exilim"], ["EX-Z", "EX-H", "EX-G"]),
+    ]
+    UNKNOWN_MANUFACTURERS = ["Generic", "Neewer", "Lowepro", "SanDisk", ""]
+    MODEL_SUFFIXES = ["", "", "", " IS", " HS", " GPS"]
+    CURRENCIES = [("USD", 1.0, 5), ("CAD", 1.03, 3), ("EUR", 0.74, 2), ("GBP", 0.64, 1)]
+    EXTRA_WORDS = [
+        "Digital Camera", "12.1MP", "14MP", "(Black)", "(Silver)", "Red", "Kit", "with 3x Zoom",
+        "HD Video", "- Refurbished", "Bundle", "2.7\" LCD",
+    ]
+    ACCESSORY_TEMPLATES = [
+        "Battery for {manufacturer} {model}", "Case for {manufacturer} {model}",
+        "{manufacturer} {model} Replacement Charger", "Screen protector {model}",
+    ]
+
+    RECENT_LISTING_COUNT = 10000
+
+    def __init__(self, seed):
+        self.random = random.Random(seed)
+        self.manufacturer_weights = zipf_weights(len(self.MANUFACTURERS), 1.1)
+
+    def generate_products(self, count):
+        products = []
+        names = set()
+        while len(products) < count:
+            (manufacturer, _, families, prefixes) = self.random.choices(
+                self.MANUFACTURERS, self.manufacturer_weights)[0]
+            family = self.random.choice(families)
+            model = "{}{}{}".format(
+                self.random.choice(prefixes),
+                self.random.randint(10, 9999),
+                self.random.choice(self.MODEL_SUFFIXES),
+            )
+            name = "_".join(part.replace(" ", "_") for part in (manufacturer, family, model)
+                            if part is not None)
+            if name in names:
+                continue
+            names.add(name)
+
+            product = {
+                "product_name": name,
+                "manufacturer": manufacturer,
+                "model": model,
+                "announced-date": "{}-{:02}-{:02}T19:00:00.000-05:00".format(
+                    self.random.randint(2007, 2012), self.random.randint(1, 12),
+                    self.random.randint(1, 28)),
+            }
+            if family is not None:
+                product["family"] = family
+            products.append(product)
+        return products
+
+    def generate_listings(self, products, count, duplicates=0.0):
+        manufacturers = {info[0]: info for info in self.MANUFACTURERS}
+        product_weights = zipf_weights(len(products), 0.8)
+        product_prices = [round(self.random.lognormvariate(5.5, 0.8), 2) for _ in products]
+        currency_weights = [weight for (_, _, weight) in self.CURRENCIES]
+        recent_listings = collections.deque(maxlen=self.RECENT_LISTING_COUNT)
+
+        for _ in range(count):
+            if duplicates and recent_listings and self.random.random() < duplicates:
+                listing = dict(self.random.choice(recent_listings))
+                if self.random.random() < 0.3:
+                    listing["title"] = listing["title"].upper().replace(" ", "  ")
+                yield listing
+                continue
+
+            product_index = self.random.choices(range(len(products)), product_weights)[0]
+            product = products[product_index]
+            (_, manufacturer_spellings, _, prefixes) = manufacturers[product["manufacturer"]]
+            (currency, rate, _) = self.random.choices(self.CURRENCIES, currency_weights)[0]
+            manufacturer = self.random.choice(manufacturer_spellings)
+            model = self.add_model_noise(product["model"])
+
+            kind = self.random.random()
+            if kind < 0.65:
+                words = [product["manufacturer"]]
+                if "family" in product and self.random.random() < 0.7:
+                    words.append(product["family"])
+                words.append(model)
+                words.extend(self.random.sample(self.EXTRA_WORDS, self.random.randint(0, 3)))
+                title = " ".join(words)
+                price = product_prices[product_index] * self.random.uniform(0.85, 1.15)
+            elif kind < 0.8:
+                template = self.random.choice(self.ACCESSORY_TEMPLATES)
+                title = template.format(manufacturer=product["manufacturer"], model=model)
+                price = self.random.uniform(5, 40)
+            elif kind < 0.9:
+                title = "{} {}{} {}".format(
+                    product["manufacturer"], self.random.choice(prefixes),
+                    self.random.randint(10000, 99999), self.random.choice(self.EXTRA_WORDS))
+                price = self.random.lognormvariate(5.5, 0.8)
+            else:
+                manufacturer = self.random.choice(self.UNKNOWN_MANUFACTURERS)
+                title = "{} {} {}".format(
+                    manufacturer, model, self.random.choice(self.EXTRA_WORDS)).strip()
+                price = self.random.uniform(5, 100)
+
+            listing = {
+                "title": title,
+                "manufacturer": manufacturer,
+                "currency": currency,
+                "price": "{:.2f}".format(price * rate),
+            }
+            if duplicates:
+                recent_listings.append(listing)
+            yield listing
+
+    def add_model_noise(self, model):
+        kind = self.random.random()
+        if kind < 0.5:
+            return model
+        elif kind < 0.6:
+            return model.replace("-", "")
+        elif kind < 0.7:
+            return model.replace("-", " ")
+        elif kind < 0.8:
+            return model.lower()
+        elif kind < 0.9:
+            return model.upper().replace(" ", "")
+        else:
+            for i in range(1, len(model)):
+                if model[i - 1].isalpha() and model[i].isdigit():
+                    return model[:i] + " " + model[i:]
+            return model
+
+
+def zipf_weights(count, exponent):
+    return [1.0 / ((rank + 1) ** exponent) for rank in range(count)]
+
+
+def run_pipeline_benchmark(args):
+    start_time = time.perf_counter()
+    (products_path, listings_path) = generate_data(args)
+    generate_seconds = time.perf_counter() - start_time
+
+    logger = logging.Logger(name=__name__)
+    logger.addHandler(logging.NullHandler())
+    with tempfile.TemporaryDirectory(prefix="ProductListingMatcher_benchmark-") as temp_dir:
+        output_path = os.path.join(temp_dir, "results.txt")
+        app = ProductListingMatcher(
+            products_path, listings_path, logger, jobs=args.jobs, output_path=output_path,
+            json_backend=args.json_backend, engine=args.engine, dedup_cache_size=args.dedup,
+            dedup_parse=args.dedup_parse, pipeline_queue_size=args.pipeline,
+            columnar=args.columnar)
+        phases = PhaseTimer()
+
+        with phases.time("parse_products"):
+            products = app.load_products()
+        with phases.time("parse_listings"):
+            listing_count = sum(1 for _ in app.create_listings_reader())
+        with phases.time("index"):
+            index = app.build_index(products)
+        with ResultsWriter(output_path, products) as writer:
+            with phases.time("match_pass"):
+                stats = app.match_listings(index, writer)
+            with phases.time("write"):
+                writer.write()
+        output_size = os.path.getsize(output_path)
+
+    # The match pass has to read and parse the listings again, so the time spent matching is
+    # estimated by subtracting the time of the parse-only pass.
+    match_seconds = max(0.0, phases.seconds["match_pass"] - phases.seconds["parse_listings"])
+    phases.seconds["match"] = match_seconds
+    listings_file_size = os.path.getsize(listings_path)
+    return {
+        "benchmark": "pipeline",
+        "generate_seconds": generate_seconds,
+        "json_backend": app.create_listings_reader().json_backend,
+        "engine": args.engine,
+        "product_count": len(products),
+        "listing_count": listing_count,
+        "listings_file_size": listings_file_size,
+        "parse_megabytes_per_second": rate(
+            listings_file_size / 1e6, phases.seconds["parse_listings"]),
+        "output_file_size": output_size,
+        "jobs": args.jobs,
+        "phase_seconds": phases.seconds,
+        "listings_per_second": {
+            "parse": rate(listing_count, phases.seconds["parse_listings"]),
+            "match": rate(listing_count, match_seconds),
+            "match_pass": rate(listing_count, phases.seconds["match_pass"]),
+        },
+        "matched_count": stats.matched_count,
+        "ambiguous_count": stats.ambiguous_count,
+        "unknown_manufacturer_count": stats.unknown_manufacturer_count,
+        "pipeline_queue_size": args.pipeline,
+        "columnar": args.columnar,
+        "dedup_cache_size": args.dedup,
+        "dedup_parse": args.dedup_parse,
+        "duplicate_count": stats.duplicate_count,
+        "duplicate_ratio": stats.duplicate_ratio(),
+        "duplicate_line_count": stats.duplicate_line_count,
+        "duplicate_line_ratio": stats.duplicate_line_ratio(),
+        "dedup_estimated_saved_seconds": stats.estimated_dedup_saved_seconds(),
+        "peak_rss_bytes": peak_rss_bytes(),
+    }
+
+
+def run_engines_benchmark(args):
+    (products_path, listings_path) = generate_data(args)
+    logger = logging.Logger(name=__name__)
+    logger.addHandler(logging.NullHandler())
+    app = ProductListingMatcher(products_path, listings_path, logger)
+    products = app.load_products()
+    listings = list(app.create_listings_reader())
+
+    # the automaton engine uses pyahocorasick if it is installed; the pure-Python automaton is
+    # measured separately
+    engines = [("token", "token", None), ("automaton", "automaton", None),
+               ("automaton_python", "automaton", AhoCorasickAutomaton)]
+    report_engines = {}
+    expected = None
+    for (name, engine, automaton_class) in engines:
+        index = ProductIndex(products, engine=engine)
+        if automaton_class is not None:
+            if type(index.automaton) is automaton_class:
+                continue  # the same as the "automaton" engine
+            index.automaton = automaton_class(index.model_keys)
+        stats = MatchStats()
+        start_time = time.perf_counter()
+        actual = [index.match_listing(listing, stats) for listing in listings]
+        match_seconds = time.perf_counter() - start_time
+        if expected is None:
+            expected = actual
+        report_engines[name] = {
+            "automaton_class": None if index.automaton is None else "{}.{}".format(
+                type(index.automaton).__module__, type(index.automaton).__name__),
+            "match_seconds": match_seconds,
+            "listings_per_second": rate(len(listings), match_seconds),
+            "matched_count": stats.matched_count,
+            "same_results_as_token": actual == expected,
+        }
+
+    return {
+        "benchmark": "engines",
+        "product_count": len(products),
+        "listing_count": len(listings),
+        "engines": report_engines,
+    }
+
+
+def run_batches_benchmark(args):
+    (products_path, listings_path) = generate_data(args)
+    logger = logging.Logger(name=__name__)
+    logger.addHandler(logging.NullHandler())
+    app = ProductListingMatcher(products_path, listings_path, logger)
+    products = app.load_products()
+    reader = app.create_listings_reader()
+    # the lines are read up front, so that only parsing and matching them is measured
+    line_batches = list(Pipeline.iter_batches(reader.read_raw_lines(),
+                                              ListingBatch.DEFAULT_SIZE))
+    line_count = sum(len(lines) for lines in line_batches)
+
+    def match_objects(index, stats, product_indexes):
+        for lines in line_batches:
+            for (product_index, listing) in index.match_listings(reader.parse_lines(lines),
+                                                                 stats):
+                product_indexes.append(product_index)
+
+    def match_batches(index, stats, product_indexes):
+        for lines in line_batches:
+            batch = reader.parse_batch(lines)
+            for (product_index, row) in index.match_batch(batch, stats):
+                batch.listing(row)
+                product_indexes.append(product_index)
+
+    report_paths = {}
+    expected = None
+    for (name, match) in [("objects", match_objects), ("batches", match_batches)]:
+        # each run gets its own index, so that both start with an empty title cache
+        product_indexes = []
+        stats = MatchStats()
+        gc.collect()
+        gc_collections = sum(generation["collections"] for generation in gc.get_stats())
+        start_time = time.perf_counter()
+        match(ProductIndex(products), stats, product_indexes)
+        seconds = time.perf_counter() - start_time
+        gc_collections = sum(
+            generation["collections"] for generation in gc.get_stats()) - gc_collections
+
+        # measured in a second run, since tracing the allocations slows it down a lot
+        tracemalloc.start()
+        try:
+            match(ProductIndex(products), MatchStats(), [])
+            (_, peak_traced_bytes) = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        if expected is None:
+            expected = product_indexes
+        report_paths[name] = {
+            "seconds": seconds,
+            "listings_per_second": rate(line_count, seconds),
+            "gc_collections": gc_collections,
+            "peak_traced_bytes": peak_traced_bytes,
+            "matched_count": stats.matched_count,
+            "same_results_as_objects": product_indexes == expected,
+        }
+
+    return {
+        "benchmark": "batches",
+        "product_count": len(products),
+        "line_count": line_count,
+        "batch_size": ListingBatch.DEFAULT_SIZE,
+        "paths": report_paths,
+    }
+
+
+def run_audit_benchmark(args):
+    (products_path, listings_path) = generate_data(args)
+    logger = logging.Logger(name=__name__)
+    logger.addHandler(logging.NullHandler())
+    app = ProductListingMatcher(products_path, listings_path, logger)
+    products = app.load_products()
+
+    report_sample_rates = {}
+    baseline_seconds = None
+    with tempfile.TemporaryDirectory(prefix="ProductListingMatcher_benchmark-") as temp_dir:
+        output_path = os.path.join(temp_dir, "results.txt")
+        audit_path = os.path.join(temp_dir, "audit.txt")
+        for sample_rate in [None, 0.001, 0.01, 1.0]:
+            # each run gets its own index, so that all start with an empty title cache
+            index = ProductIndex(products)
+            with ResultsWriter(output_path, products) as writer:
+                start_time = time.perf_counter()
+                if sample_rate is None:
+                    stats = app.match_listings(index, writer)
+                    record_count = 0
+                else:
+                    with MatchAuditor(audit_path, index, sample_rate=sample_rate) as auditor:
+                        stats = app.match_listings(index, writer, auditor=auditor)
+                    record_count = auditor.record_count
+                seconds = time.perf_counter() - start_time
+            if baseline_seconds is None:
+                baseline_seconds = seconds
+            report_sample_rates["off" if sample_rate is None else "{:g}".format(sample_rate)] = {
+                "seconds": seconds,
+                "listings_per_second": rate(stats.listing_count, seconds),
+                "overhead_ratio": seconds / baseline_seconds - 1.0,
+                "record_count": record_count,
+                "matched_count": stats.matched_count,
+            }
+
+    return {
+        "benchmark": "audit",
+        "product_count": len(products),
+        "sample_rates": report_sample_rates,
+    }
+
+
+def run_json_benchmark(args):
+    (products_path, listings_path) = generate_data(args)
+    listings_file_size = os.path.getsize(listings_path)
+    logger = logging.Logger(name=__name__)
+    logger.addHandler(logging.NullHandler())
+
+    # reading the raw lines without decoding them is the baseline for all the backends
+    reader = ListingsReader(listings_path, logger, json_backend="json")
+    start_time = time.perf_counter()
+    line_count = sum(1 for _ in reader.read_raw_lines())
+    read_seconds = time.perf_counter() - start_time
+
+    backends = {}
+    for json_backend in JSON_BACKENDS:
+        try:
+            load_json_backend(json_backend)
+        except ImportError:
+            backends[json_backend] = None
+            continue
+        reader = ListingsReader(listings_path, logger, json_backend=json_backend)
+        start_time = time.perf_counter()
+        listing_count = sum(1 for _ in reader)
+        parse_seconds = time.perf_counter() - start_time
+        backends[json_backend] = {
+            "parse_seconds": parse_seconds,
+            "listing_count": listing_count,
+            "megabytes_per_second": rate(listings_file_size / 1e6, parse_seconds),
+            "listings_per_second": rate(listing_count, parse_seconds),
+        }
+
+    return {
+        "benchmark": "json",
+        "listings_file_size": listings_file_size,
+        "line_count": line_count,
+        "read_seconds": read_seconds,
+        "read_megabytes_per_second": rate(listings_file_size / 1e6, read_seconds),
+        "backends": backends,
+    }
+
+
+class PhaseTimer:
+
+    def __init__(self):
+        self.seconds = {}
+
+    def time(self, name):
+        return self.Timer(self, name)
+
+    class Timer:
+
+        def __init__(self, phase_timer, name):
+            self.phase_timer = phase_timer
+            self.name = name
+            self.start_time = None
+
+        def __enter__(self):
+            self.start_time = time.perf_counter()
+
+        def __exit__(self, *args):
+            elapsed_time = time.perf_counter() - self.start_time
+            self.phase_timer.seconds[self.name] = elapsed_time
+
+
+def rate(count, seconds):
+    if seconds <= 0:
+        return None
+    return count / seconds
+
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux but in bytes on macOS
+    multiplier = 1 if sys.platform == "darwin" else 1024
+    usage = {}
+    for (name, who) in [("self", resource.RUSAGE_SELF), ("children", resource.RUSAGE_CHILDREN)]:
+        usage[name] = resource.getrusage(who).ru_maxrss * multiplier
+    return usage
+
+
+def environment_info():
+    try:
+        git_revision = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        git_revision = None
+    return {
+        "git_revision": git_revision,
+        "python_version": platform.python_version(),
+        "python_implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+class DictProduct:
+    # The layout of Product before it used __slots__, for comparison
+
+    def __init__(self, name, manufacturer, model, family, announced_date):
+        self.name = name
+        self.manufacturer = manufacturer
+        self.model = model
+        self.family = family
+        self.announced_date = announced_date
+
+
+class DictListing:
+    # The layout of Listing before it used __slots__, for comparison
+
+    def __init__(self, title, manufacturer, currency, price):
+        self.title = title
+        self.manufacturer = manufacturer
+        self.currency = currency
+        self.price = price
+
+
+def run_memory_benchmark(count):
+    # The field values are created before measuring so that only the objects themselves, and
+    # not the strings they refer to, are counted.
+    announced_date = datetime.datetime(2010, 1, 7)
+    price = decimal.Decimal("129.99")
+    product_args = [
+        ("Product_{}".format(i), "Canon", "M{}".format(i), "PowerShot", announced_date)
+        for i in range(count)
+    ]
+    listing_args = [
+        ("Canon PowerShot M{} (Black)".format(i), "Canon Canada", "CAD", price)
+        for i in range(count)
+    ]
+
+    report = {"count": count}
+    for (name, cls, args_list) in [
+        ("Product", Product, product_args),
+        ("Product.dict", DictProduct, product_args),
+        ("Listing", Listing, listing_args),
+        ("Listing.dict", DictListing, listing_args),
+    ]:
+        report[name] = {"bytes_per_object": measure_bytes_per_object(cls, args_list)}
+    return report
+
+
+def measure_bytes_per_object(cls, args_list):
+    objects = [None] * len(args_list)
+    tracemalloc.start()
+    try:
+        (start_size, _) = tracemalloc.get_traced_memory()
+        for (i, args) in enumerate(args_list):
+            objects[i] = cls(*args)
+        (end_size, _) = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return (end_size - start_size) / len(objects)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
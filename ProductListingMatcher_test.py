@@ -19,13 +19,64 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import asyncio
+import bz2
 import datetime
 import decimal
+import glob
+import gzip
+import io
+import json
+import logging
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import time
 import unittest.mock
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from ProductListingMatcher import AhoCorasickAutomaton
+from ProductListingMatcher import BackgroundReader
 from ProductListingMatcher import ArgumentParser
+from ProductListingMatcher import CProfileProfiler
+from ProductListingMatcher import IncrementalState
+from ProductListingMatcher import JSON_BACKENDS
 from ProductListingMatcher import Listing
+from ProductListingMatcher import ListingBatch
+from ProductListingMatcher import ListingsReader
+from ProductListingMatcher import ManufacturerTable
+from ProductListingMatcher import MatchAuditor
+from ProductListingMatcher import MatchServer
+from ProductListingMatcher import MatchStats
+from ProductListingMatcher import Metrics
+from ProductListingMatcher import NullMetrics
+from ProductListingMatcher import ParallelMatcher
+from ProductListingMatcher import Pipeline
+from ProductListingMatcher import PriceFilter
 from ProductListingMatcher import Product
+from ProductListingMatcher import ProductIndex
+from ProductListingMatcher import ProductIndexCache
+from ProductListingMatcher import ProductListingMatcher
+from ProductListingMatcher import ProductMatcher
+from ProductListingMatcher import ProductsReader
+from ProductListingMatcher import ProgressReporter
+from ProductListingMatcher import ResultsWriter
+from ProductListingMatcher import SamplingProfiler
+from ProductListingMatcher import create_automaton
+from ProductListingMatcher import detect_compression
+from ProductListingMatcher import diff_products
+from ProductListingMatcher import is_plain_file
+from ProductListingMatcher import load_json_backend
+from ProductListingMatcher import split_line_ranges
+from ProductListingMatcher import parse_announced_date
+from ProductListingMatcher import timed_iter
+from ProductListingMatcher import tokenize
 
 
 class Test_ArgumentParser(unittest.TestCase):
@@ -109,6 +160,291 @@ class Test_ArgumentParser(unittest.TestCase):
             expected_exit_code=2,
         )
 
+    def test_OutputFile_Default(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=[])
+        self.assertEqual(result.output_path, "results.txt")
+
+    def test_OutputFile_short(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=["-o", "test_results.txt"])
+        self.assertEqual(result.output_path, "test_results.txt")
+
+    def test_OutputFile_long(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=["--output-file", "test_results.txt"])
+        self.assertEqual(result.output_path, "test_results.txt")
+
+    def test_StatsJson_Default(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=[])
+        self.assertIsNone(result.stats_json_path)
+        self.assertFalse(result.metrics.enabled)
+
+    def test_StatsJson(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=["--stats-json", "stats.json"])
+        self.assertEqual(result.stats_json_path, "stats.json")
+        self.assertTrue(result.metrics.enabled)
+
+    def test_ProgressInterval(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=["--progress-interval", "2.5"])
+        self.assertEqual(result.progress_interval, 2.5)
+
+    def test_ProgressInterval_Zero(self):
+        self.assert_exception_raised(
+            args=["--progress-interval", "0"],
+            expected_message="argument --progress-interval: must be greater than zero: 0",
+            expected_exit_code=2,
+        )
+
+    def test_Profile_Default(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=[])
+        self.assertIsNone(result.profiler)
+
+    def test_Profile_NoValue(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=["--profile"])
+        self.assertIsInstance(result.profiler, CProfileProfiler)
+        self.assertEqual(result.profiler.output_path, "ProductListingMatcher.prof")
+
+    @unittest.skipUnless(SamplingProfiler.is_supported(), "sampling profiler not supported")
+    def test_Profile_Sample(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=["--profile", "sample"])
+        self.assertIsInstance(result.profiler, SamplingProfiler)
+        self.assertEqual(result.profiler.output_path, "ProductListingMatcher.stacks")
+
+    def test_Profile_Invalid(self):
+        self.assert_exception_raised(
+            args=["--profile", "perf"],
+            expected_message="argument --profile: invalid choice: 'perf' "
+                             "(choose from 'cprofile', 'sample')",
+            expected_exit_code=2,
+        )
+
+    def test_ProfileOutput_ImpliesProfile(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=["--profile-output", "test.prof"])
+        self.assertIsInstance(result.profiler, CProfileProfiler)
+        self.assertEqual(result.profiler.output_path, "test.prof")
+
+    def test_StateFile(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=["--state-file", "state.json"])
+        self.assertEqual(result.state_path, "state.json")
+
+    def test_StateFile_Default(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=[])
+        self.assertIsNone(result.state_path)
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_PriceFilter(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=["--price-filter", "0.1"])
+        self.assertEqual(result.price_filter_ratio, 0.1)
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_PriceFilter_DefaultRatio(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=["--price-filter"])
+        self.assertEqual(result.price_filter_ratio, PriceFilter.DEFAULT_MIN_RATIO)
+
+    def test_PriceFilter_NumPyMissing(self):
+        x = ArgumentParser()
+        with unittest.mock.patch("ProductListingMatcher.is_numpy_installed",
+                                 return_value=False):
+            with self.assertRaises(x.Error) as cm:
+                x.parse_args(args=["--price-filter"])
+        self.assertEqual(cm.exception.exit_code, 2)
+
+    def test_Engine(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=["--engine", "automaton"])
+        self.assertEqual(result.engine, "automaton")
+
+    def test_Engine_Default(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=[])
+        self.assertEqual(result.engine, "token")
+
+    def test_JsonBackend(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=["--json-backend", "json"])
+        self.assertEqual(result.json_backend, "json")
+
+    def test_JsonBackend_Default(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=[])
+        self.assertEqual(result.json_backend, "auto")
+
+    def test_JsonBackend_NotInstalled(self):
+        x = ArgumentParser()
+        with unittest.mock.patch.dict(sys.modules, {"orjson": None}):
+            with self.assertRaises(x.Error) as cm:
+                x.parse_args(args=["--json-backend", "orjson"])
+        self.assertEqual(cm.exception.exit_code, 2)
+
+    def test_Serve(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=["--serve"])
+        self.assertTrue(result.serve)
+        self.assertIsNone(result.socket_path)
+
+    def test_Socket_ImpliesServe(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=["--socket", "test.sock"])
+        self.assertTrue(result.serve)
+        self.assertEqual(result.socket_path, "test.sock")
+
+    def test_Serve_Default(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=[])
+        self.assertFalse(result.serve)
+
+    def test_Stdin(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=["-l", "-"])
+        self.assertEqual(result.listings_path, "-")
+
+    def test_Stdin_Both(self):
+        self.assert_stdin_error(["-p", "-", "-l", "-"])
+
+    def test_Stdin_ProductsWithIndexCache(self):
+        self.assert_stdin_error(["-p", "-", "--index-cache", "cache_dir"])
+
+    def test_Stdin_ProductsWithServe(self):
+        self.assert_stdin_error(["-p", "-", "--serve"])
+
+    def test_Stdin_ListingsWithStateFile(self):
+        self.assert_stdin_error(["-l", "-", "--state-file", "state.json"])
+
+    def assert_stdin_error(self, args):
+        x = ArgumentParser()
+        with self.assertRaises(x.Error) as cm:
+            x.parse_args(args=args)
+        self.assertEqual(cm.exception.exit_code, 2)
+
+    def test_Dedup(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=["--dedup", "100"])
+        self.assertEqual(result.dedup_cache_size, 100)
+
+    def test_Dedup_DefaultSize(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=["--dedup"])
+        self.assertEqual(result.dedup_cache_size, ProductIndex.DEFAULT_DEDUP_CACHE_SIZE)
+
+    def test_Dedup_Default(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=[])
+        self.assertIsNone(result.dedup_cache_size)
+        self.assertFalse(result.dedup_parse)
+
+    def test_DedupParse(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=["--dedup", "--dedup-parse"])
+        self.assertTrue(result.dedup_parse)
+
+    def test_DedupParse_WithoutDedup(self):
+        x = ArgumentParser()
+        with self.assertRaises(x.Error) as cm:
+            x.parse_args(args=["--dedup-parse"])
+        self.assertEqual(cm.exception.exit_code, 2)
+
+    def test_Columnar(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=["--columnar"])
+        self.assertTrue(result.columnar)
+
+    def test_Columnar_Default(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=[])
+        self.assertFalse(result.columnar)
+
+    def test_AuditFile(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=[
+            "--audit-file", "audit.txt", "--audit-sample-rate", "0.5", "--audit-product", "A",
+            "--audit-product", "B", "--audit-manufacturer", "C"])
+        self.assertEqual(result.audit_path, "audit.txt")
+        self.assertEqual(result.audit_sample_rate, 0.5)
+        self.assertEqual(result.audit_products, ["A", "B"])
+        self.assertEqual(result.audit_manufacturers, ["C"])
+
+    def test_AuditFile_Default(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=[])
+        self.assertIsNone(result.audit_path)
+        self.assertIsNone(result.audit_sample_rate)
+
+    def test_AuditFile_Invalid(self):
+        for args in [
+            ["--audit-sample-rate", "0.5"],
+            ["--audit-product", "A"],
+            ["--audit-manufacturer", "A"],
+            ["--audit-file", "audit.txt", "--audit-sample-rate", "1.5"],
+            ["--audit-file", "audit.txt", "--audit-sample-rate", "0"],
+            ["--audit-file", "audit.txt", "--serve"],
+        ]:
+            with self.subTest(args=args):
+                x = ArgumentParser()
+                with self.assertRaises(x.Error) as cm:
+                    x.parse_args(args=args)
+                self.assertEqual(cm.exception.exit_code, 2)
+
+    def test_Pipeline(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=["--pipeline", "3"])
+        self.assertEqual(result.pipeline_queue_size, 3)
+
+    def test_Pipeline_DefaultSize(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=["--pipeline"])
+        self.assertEqual(result.pipeline_queue_size, Pipeline.DEFAULT_QUEUE_SIZE)
+
+    def test_Pipeline_Default(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=[])
+        self.assertIsNone(result.pipeline_queue_size)
+
+    def test_IndexCache(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=["--index-cache", "cache_dir"])
+        self.assertEqual(result.index_cache_dir, "cache_dir")
+
+    def test_Jobs_Default(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=[])
+        self.assertEqual(result.jobs, 1)
+
+    def test_Jobs_short(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=["-j", "4"])
+        self.assertEqual(result.jobs, 4)
+
+    def test_Jobs_long(self):
+        x = ArgumentParser()
+        result = x.parse_args(args=["--jobs", "4"])
+        self.assertEqual(result.jobs, 4)
+
+    def test_Jobs_Zero(self):
+        self.assert_exception_raised(
+            args=["--jobs", "0"],
+            expected_message="argument -j/--jobs: must be greater than zero: 0",
+            expected_exit_code=2,
+        )
+
+    def test_Jobs_NotAnInteger(self):
+        self.assert_exception_raised(
+            args=["--jobs", "many"],
+            expected_message="argument -j/--jobs: invalid integer: many",
+            expected_exit_code=2,
+        )
+
     def assert_exception_raised(self, args, expected_message, expected_exit_code):
         x = ArgumentParser()
         x._print_message = unittest.mock.Mock()  # silence messages
@@ -296,6 +632,21 @@ class Test_Product(unittest.TestCase):
         del o2.announced_date
         self.assertTrue(o1 != o2)
 
+    def test___hash___Equal(self):
+        o1 = self.sample_object()
+        o2 = self.sample_object()
+        self.assertEqual(hash(o1), hash(o2))
+
+    def test___hash___SetMembership(self):
+        o1 = self.sample_object()
+        o2 = self.sample_object()
+        self.assertEqual(len({o1, o2}), 1)
+
+    def test___slots__(self):
+        x = self.sample_object()
+        with self.assertRaises(AttributeError):
+            x.unknown_attribute = None
+
     def sample_object(self):
         return Product(
             name="Kodak_EasyShare_M320",
@@ -456,6 +807,21 @@ class Test_Listing(unittest.TestCase):
         del o2.price
         self.assertTrue(o1 != o2)
 
+    def test___hash___Equal(self):
+        o1 = self.sample_object()
+        o2 = self.sample_object()
+        self.assertEqual(hash(o1), hash(o2))
+
+    def test___hash___SetMembership(self):
+        o1 = self.sample_object()
+        o2 = self.sample_object()
+        self.assertEqual(len({o1, o2}), 1)
+
+    def test___slots__(self):
+        x = self.sample_object()
+        with self.assertRaises(AttributeError):
+            x.unknown_attribute = None
+
     def sample_object(self):
         return Listing(
             title="Canon PowerShot A1200 (Black)",
@@ -465,5 +831,2032 @@ class Test_Listing(unittest.TestCase):
         )
 
 
+class Test_ListingBatch(unittest.TestCase):
+
+    def test_append(self):
+        x = ListingBatch()
+        for (price_str, expected) in [
+            ("129.90", True),
+            ("-5", True),
+            ("0.00000001", True),
+            ("1.5E+3", False),
+            ("-0.00", False),
+            ("1234567890.123456789", False),
+            (" 1.00", False),
+            ("1.", False),
+        ]:
+            with self.subTest(price_str=price_str):
+                self.assertEqual(x.append(10, "A", "B", "CAD", price_str), expected)
+        self.assertEqual(len(x), 3)
+
+    def test_listing(self):
+        x = ListingBatch()
+        x.append(1, "A", "Canon Canada", "CAD", "129.90")
+        x.append(2, "B", "Sony", "USD", "-5")
+        x.append_listing(3, Listing("C", "Canon Canada", "CAD", decimal.Decimal("1.5E+3")))
+        x.append(4, "D", "Sony", "CAD", "0.00000001")
+        self.assertEqual([x.listing(row) for row in range(len(x))], [
+            Listing("A", "Canon Canada", "CAD", decimal.Decimal("129.90")),
+            Listing("B", "Sony", "USD", decimal.Decimal("-5")),
+            Listing("C", "Canon Canada", "CAD", decimal.Decimal("1.5E+3")),
+            Listing("D", "Sony", "CAD", decimal.Decimal("0.00000001")),
+        ])
+        # the trailing zeros are kept, as in the Decimal parsed from the price
+        self.assertEqual("{}".format(x.listing(0).price), "129.90")
+        self.assertEqual(x.manufacturer_names, ["Canon Canada", "Sony"])
+        self.assertEqual(list(x.manufacturer_codes), [0, 1, 0, 1])
+        self.assertEqual(x.currency_names, ["CAD", "USD"])
+        self.assertEqual(list(x.line_numbers), [1, 2, 3, 4])
+
+
+class TempFileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def create_file(self, lines, name="test.txt"):
+        path = os.path.join(self.temp_dir.name, name)
+        with open(path, "wt", encoding="utf8") as f:
+            for line in lines:
+                print(line, file=f)
+        return path
+
+    def create_logger(self):
+        logger = logging.Logger(name=__name__)
+        logger.addHandler(logging.NullHandler())
+        return logger
+
+
+class Test_ProductsReader(TempFileTestCase):
+
+    def test_ValidLines(self):
+        path = self.create_file([
+            '{"product_name":"Sony_Cyber-shot_DSC-W310","manufacturer":"Sony","model":"DSC-W310",'
+            '"family":"Cyber-shot","announced-date":"2010-01-06T19:00:00.000-05:00"}',
+            '{"product_name":"Kodak_EasyShare_M320","manufacturer":"Kodak","model":"M320",'
+            '"family":"EasyShare","announced-date":"2009-01-06T19:00:00.000-05:00"}',
+        ])
+        x = ProductsReader(path, self.create_logger())
+        actual = list(x)
+        self.assertEqual(actual, [
+            Product("Sony_Cyber-shot_DSC-W310", "Sony", "DSC-W310", "Cyber-shot",
+                    datetime.datetime(2010, 1, 7)),
+            Product("Kodak_EasyShare_M320", "Kodak", "M320", "EasyShare",
+                    datetime.datetime(2009, 1, 7)),
+        ])
+        self.assertEqual(x.line_count, 2)
+        self.assertEqual(x.error_count, 0)
+
+    def test_FamilyMissing(self):
+        path = self.create_file([
+            '{"product_name":"Samsung_TL240","manufacturer":"Samsung","model":"TL240",'
+            '"announced-date":"2010-01-05T19:00:00.000-05:00"}',
+        ])
+        actual = list(ProductsReader(path, self.create_logger()))
+        self.assertEqual(len(actual), 1)
+        self.assertIsNone(actual[0].family)
+
+    def test_MalformedLinesSkipped(self):
+        path = self.create_file([
+            'this is not json',
+            '["not", "an", "object"]',
+            '{"product_name":"A","manufacturer":"B","model":"C"}',
+            '{"product_name":"A","manufacturer":"B","model":"C","announced-date":"yesterday"}',
+            '{"product_name":1,"manufacturer":"B","model":"C",'
+            '"announced-date":"2010-01-05T19:00:00.000-05:00"}',
+            '',
+            '{"product_name":"A","manufacturer":"B","model":"C",'
+            '"announced-date":"2010-01-05T19:00:00.000-05:00"}',
+        ])
+        x = ProductsReader(path, self.create_logger())
+        actual = list(x)
+        self.assertEqual(len(actual), 1)
+        self.assertEqual(actual[0].name, "A")
+        self.assertEqual(x.line_count, 7)
+        self.assertEqual(x.error_count, 5)
+
+    def test_FileNotFound(self):
+        path = os.path.join(self.temp_dir.name, "does_not_exist.txt")
+        x = ProductsReader(path, self.create_logger())
+        with self.assertRaises(x.Error):
+            list(x)
+
+
+class Test_ListingsReader(TempFileTestCase):
+
+    def test_ValidLines(self):
+        path = self.create_file([
+            '{"title":"Canon PowerShot A1200 (Black)","manufacturer":"Canon Canada",'
+            '"currency":"CAD","price":"129.99"}',
+        ])
+        x = ListingsReader(path, self.create_logger())
+        actual = list(x)
+        self.assertEqual(actual, [
+            Listing("Canon PowerShot A1200 (Black)", "Canon Canada", "CAD",
+                    decimal.Decimal("129.99")),
+        ])
+        self.assertEqual(x.error_count, 0)
+
+    def test_StringsInterned(self):
+        path = self.create_file([
+            '{"title":"A","manufacturer":"Canon Canada","currency":"CAD","price":"1.00"}',
+            '{"title":"B","manufacturer":"Canon Canada","currency":"CAD","price":"2.00"}',
+        ])
+        (listing1, listing2) = ListingsReader(path, self.create_logger())
+        self.assertIs(listing1.manufacturer, listing2.manufacturer)
+        self.assertIs(listing1.currency, listing2.currency)
+
+    def test_IsGenerator(self):
+        path = self.create_file([
+            '{"title":"A","manufacturer":"B","currency":"CAD","price":"1.00"}',
+            'this is not json',
+        ])
+        x = ListingsReader(path, self.create_logger())
+        it = iter(x)
+        next(it)
+        self.assertEqual(x.line_count, 1)
+        self.assertEqual(x.error_count, 0)
+
+    def test_InvalidPrice(self):
+        path = self.create_file([
+            '{"title":"A","manufacturer":"B","currency":"CAD","price":"cheap"}',
+            '{"title":"A","manufacturer":"B","currency":"CAD","price":"NaN"}',
+            '{"title":"A","manufacturer":"B","currency":"CAD","price":12.5}',
+        ])
+        x = ListingsReader(path, self.create_logger())
+        self.assertEqual(list(x), [])
+        self.assertEqual(x.error_count, 3)
+
+    def test_InvalidUtf8(self):
+        path = os.path.join(self.temp_dir.name, "test.txt")
+        with open(path, "wb") as f:
+            f.write(b'{"title":"\xff","manufacturer":"B","currency":"CAD","price":"1.00"}\n')
+            f.write(b'{"title":"A","manufacturer":"B","currency":"CAD","price":"1.00"}\n')
+        x = ListingsReader(path, self.create_logger())
+        self.assertEqual([listing.title for listing in x], ["A"])
+        self.assertEqual(x.error_count, 1)
+
+    def test_DeeplyNested(self):
+        path = self.create_file([
+            "[" * 100000,
+            '{"title":"A","manufacturer":"B","currency":"CAD","price":"1.00"}',
+        ])
+        for json_backend in JSON_BACKENDS:
+            try:
+                load_json_backend(json_backend)
+            except ImportError:
+                continue
+            with self.subTest(json_backend=json_backend):
+                x = ListingsReader(path, self.create_logger(), json_backend=json_backend)
+                with self.assertLogs(x.logger, logging.WARNING) as cm:
+                    self.assertEqual([listing.title for listing in x], ["A"])
+                self.assertEqual(x.error_count, 1)
+                self.assertIn("{}:1: invalid JSON".format(path), cm.output[0])
+
+    def test_StartOffset(self):
+        first_line = '{"title":"A","manufacturer":"B","currency":"CAD","price":"1.00"}'
+        path = self.create_file([
+            first_line,
+            '{"title":"B","manufacturer":"B","currency":"CAD","price":"2.00"}',
+        ])
+        x = ListingsReader(path, self.create_logger())
+        x.start_offset = len(first_line) + 1
+        self.assertEqual([listing.title for listing in x], ["B"])
+        self.assertEqual(x.offset, os.path.getsize(path))
+
+    def test_parse_batch(self):
+        path = self.create_file([
+            '{"title":"A","manufacturer":"Canon Canada","currency":"CAD","price":"129.90"}',
+            '{"title":"B","manufacturer":"Sony","currency":"USD","price":"1.5E+3"}',
+            '{"title":"C","manufacturer":"Sony","currency":"USD","price":"cheap"}',
+            '{"title":"D","manufacturer":"Sony","currency":"USD"}',
+            '{"title":"E","manufacturer":["Sony"],"currency":"USD","price":"1.00"}',
+            'not json',
+            '{"title":"F","manufacturer":"Canon Canada","currency":"CAD","price":"-0.00"}',
+        ])
+        x = ListingsReader(path, self.create_logger())
+        expected = list(x)
+        x = ListingsReader(path, self.create_logger())
+        batch = x.parse_batch(list(x.read_lines()))
+        self.assertEqual([batch.listing(row) for row in range(len(batch))], expected)
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(list(batch.line_numbers), [1, 2, 7])
+        self.assertEqual(x.error_count, 4)
+
+    def test_parse_batch_OnParseError(self):
+        x = ListingsReader(None, self.create_logger())
+        errors = []
+        batch = x.parse_batch([(7, b'{"title":"A"}'), (8, b"[]")],
+                              lambda line_number, e: errors.append((line_number, str(e))))
+        self.assertEqual(len(batch), 0)
+        self.assertEqual(errors, [(7, "missing key: manufacturer"), (8, "JSON object expected")])
+        self.assertEqual(x.error_count, 0)
+
+    def test_parse_batch_Dedup(self):
+        line = b'{"title":"A","manufacturer":"B","currency":"CAD","price":"1.00"}'
+        x = ListingsReader(None, self.create_logger())
+        x.set_dedup_cache_size(10)
+        batch = x.parse_batch([(1, line), (2, line)])
+        expected = Listing("A", "B", "CAD", decimal.Decimal("1.00"))
+        self.assertEqual([batch.listing(0), batch.listing(1)], [expected, expected])
+        self.assertEqual(x.dedup_cache_info()[:2], (1, 1))
+
+    def test_CompleteLinesOnly(self):
+        path = self.create_file([
+            '{"title":"A","manufacturer":"B","currency":"CAD","price":"1.00"}',
+        ])
+        complete_size = os.path.getsize(path)
+        with open(path, "at", encoding="utf8") as f:
+            f.write('{"title":"B","manufacturer":"B","curr')
+        x = ListingsReader(path, self.create_logger())
+        x.complete_lines_only = True
+        self.assertEqual([listing.title for listing in x], ["A"])
+        self.assertEqual(x.offset, complete_size)
+        self.assertEqual(x.line_count, 1)
+        self.assertEqual(x.error_count, 0)
+
+
+class Test_JsonLinesReader_Chunks(TempFileTestCase):
+
+    LINES = [
+        '{"title":"A","manufacturer":"B","currency":"CAD","price":"1.00"}',
+        '',
+        'not json',
+        '{"title":"\u00c9","manufacturer":"B","currency":"CAD","price":"2.00"}',
+    ]
+
+    def test_ChunkBoundaries(self):
+        path = self.create_file(self.LINES)
+        with open(path, "ab") as f:
+            f.write(b'{"title":"C","manufacturer":"B","currency":"CAD","price":"3.00"}')
+        for chunk_size in (1, 7, 64, 65, 1024 * 1024):
+            with self.subTest(chunk_size=chunk_size):
+                x = ListingsReader(path, self.create_logger())
+                x.CHUNK_SIZE = chunk_size
+                self.assertEqual([listing.title for listing in x], ["A", "\u00c9", "C"])
+                self.assertEqual(x.line_count, 5)
+                self.assertEqual(x.error_count, 1)
+                self.assertEqual(x.offset, os.path.getsize(path))
+
+    def test_ChunkBoundaries_CompleteLinesOnly(self):
+        path = self.create_file(self.LINES)
+        complete_size = os.path.getsize(path)
+        with open(path, "ab") as f:
+            f.write(b'{"title":"C","manufacturer":"B",')
+        for chunk_size in (1, 7, 64, 1024 * 1024):
+            with self.subTest(chunk_size=chunk_size):
+                x = ListingsReader(path, self.create_logger())
+                x.CHUNK_SIZE = chunk_size
+                x.complete_lines_only = True
+                self.assertEqual([listing.title for listing in x], ["A", "\u00c9"])
+                self.assertEqual(x.line_count, 4)
+                self.assertEqual(x.offset, complete_size)
+
+    def test_JsonBackends(self):
+        path = self.create_file(self.LINES)
+        for json_backend in JSON_BACKENDS:
+            try:
+                load_json_backend(json_backend)
+            except ImportError:
+                continue
+            with self.subTest(json_backend=json_backend):
+                x = ListingsReader(path, self.create_logger(), json_backend=json_backend)
+                self.assertEqual(x.json_backend, json_backend)
+                self.assertEqual([listing.title for listing in x], ["A", "\u00c9"])
+                self.assertEqual(x.error_count, 1)
+
+
+class Test_JsonLinesReader_Compressed(TempFileTestCase):
+
+    LINES = [
+        '{"title":"A","manufacturer":"B","currency":"CAD","price":"1.00"}',
+        'not json',
+        '{"title":"C","manufacturer":"B","currency":"CAD","price":"3.00"}',
+    ]
+
+    def test_Compressed(self):
+        for (name, compress) in self.compressors():
+            for chunk_size in (5, 1024 * 1024):
+                with self.subTest(name=name, chunk_size=chunk_size):
+                    path = self.create_compressed_file(name, compress)
+                    x = ListingsReader(path, self.create_logger())
+                    x.CHUNK_SIZE = chunk_size
+                    self.assertEqual([listing.title for listing in x], ["A", "C"])
+                    self.assertEqual(x.line_count, 3)
+                    self.assertEqual(x.error_count, 1)
+                    self.assertEqual(x.compression, detect_compression(name, b""))
+
+    def test_Compressed_DetectedByMagicNumber(self):
+        for (name, compress) in self.compressors():
+            with self.subTest(name=name):
+                path = self.create_compressed_file("listings.txt", compress)
+                x = ListingsReader(path, self.create_logger())
+                self.assertEqual([listing.title for listing in x], ["A", "C"])
+                self.assertEqual(x.compression, detect_compression(name, b""))
+
+    def test_Compressed_Truncated(self):
+        path = os.path.join(self.temp_dir.name, "listings.txt.gz")
+        with open(path, "wb") as f:
+            f.write(gzip.compress("\n".join(self.LINES * 100).encode("utf8"))[:-20])
+        x = ListingsReader(path, self.create_logger())
+        with self.assertRaises(x.Error):
+            list(x)
+
+    def test_Compressed_StartOffset(self):
+        path = self.create_compressed_file("listings.txt.gz", gzip.compress)
+        x = ListingsReader(path, self.create_logger())
+        x.start_offset = 1
+        with self.assertRaises(x.Error):
+            list(x)
+
+    def test_Stdin(self):
+        for (name, compress) in [("listings.txt", None)] + self.compressors():
+            with self.subTest(name=name):
+                path = self.create_compressed_file(name, compress)
+                with open(path, "rb") as f:
+                    with unittest.mock.patch("sys.stdin", f):
+                        x = ListingsReader("-", self.create_logger())
+                        self.assertEqual([listing.title for listing in x], ["A", "C"])
+                    self.assertFalse(f.closed)
+
+    def create_compressed_file(self, name, compress):
+        path = os.path.join(self.temp_dir.name, name)
+        data = "".join(line + "\n" for line in self.LINES).encode("utf8")
+        with open(path, "wb") as f:
+            f.write(data if compress is None else compress(data))
+        return path
+
+    @staticmethod
+    def compressors():
+        compressors = [("listings.txt.gz", gzip.compress), ("listings.txt.bz2", bz2.compress)]
+        try:
+            import zstandard
+        except ImportError:
+            pass
+        else:
+            compressors.append(("listings.txt.zst", zstandard.ZstdCompressor().compress))
+        return compressors
+
+
+class Test_detect_compression(unittest.TestCase):
+
+    def test_Extension(self):
+        self.assertEqual(detect_compression("a.jsonl.gz", b""), "gzip")
+        self.assertEqual(detect_compression("a.jsonl.BZ2", b""), "bz2")
+        self.assertEqual(detect_compression("a.jsonl.zst", b""), "zstd")
+
+    def test_MagicNumber(self):
+        self.assertEqual(detect_compression("-", gzip.compress(b"{}")), "gzip")
+        self.assertEqual(detect_compression("a.txt", bz2.compress(b"{}")), "bz2")
+        self.assertEqual(detect_compression("a.txt", b"\x28\xb5\x2f\xfd"), "zstd")
+
+    def test_Uncompressed(self):
+        self.assertIsNone(detect_compression("a.txt", b'{"title"'))
+        self.assertIsNone(detect_compression("a.txt", b""))
+
+
+class Test_is_plain_file(TempFileTestCase):
+
+    def test_is_plain_file(self):
+        self.assertTrue(is_plain_file(self.create_file(["{}"])))
+        self.assertFalse(is_plain_file(self.create_file(["{}"], name="test.txt.gz")))
+        self.assertFalse(is_plain_file("-"))
+        self.assertFalse(is_plain_file(self.temp_dir.name))
+        self.assertFalse(is_plain_file(os.path.join(self.temp_dir.name, "does_not_exist")))
+
+
+class Test_BackgroundReader(unittest.TestCase):
+
+    def test_read(self):
+        raw = io.BytesIO(b"abcdefg")
+        x = BackgroundReader(raw, raw, 3)
+        self.assertEqual(list(iter(x.read, b"")), [b"abc", b"def", b"g"])
+        self.assertEqual(x.read(), b"")
+        x.close()
+        self.assertTrue(raw.closed)
+
+    def test_read_Error(self):
+        f = unittest.mock.Mock()
+        f.read.side_effect = EOFError("stream ended early")
+        x = BackgroundReader(f, io.BytesIO(), 3)
+        with self.assertRaises(OSError) as cm:
+            x.read()
+        self.assertEqual(str(cm.exception), "stream ended early")
+        x.close()
+
+    def test_close_BeforeEndOfFile(self):
+        raw = io.BytesIO(b"x" * 1000)
+        with BackgroundReader(raw, raw, 1) as x:
+            self.assertEqual(x.read(), b"x")
+        self.assertFalse(x.thread.is_alive())
+
+
+class Test_JsonLinesReader_Dedup(TempFileTestCase):
+
+    LINES = [
+        '{"title":"A","manufacturer":"B","currency":"CAD","price":"1.00"}',
+        'not json',
+        '{"title":"A","manufacturer":"B","currency":"CAD","price":"1.00"}',
+        '{"title":"C","manufacturer":"B","currency":"CAD","price":"3.00"}',
+        'not json',
+        '{"title":"A","manufacturer":"B","currency":"CAD","price":"1.00"}',
+    ]
+
+    def test_Duplicates(self):
+        path = self.create_file(self.LINES)
+        x = ListingsReader(path, self.create_logger())
+        x.set_dedup_cache_size(10)
+        actual = list(x)
+        self.assertEqual([listing.title for listing in actual], ["A", "A", "C", "A"])
+        self.assertIs(actual[0], actual[1])
+        self.assertIs(actual[0], actual[3])
+        self.assertEqual(x.line_count, 6)
+        self.assertEqual(x.error_count, 2)
+        (hits, misses, seconds) = x.dedup_cache_info()
+        self.assertEqual((hits, misses), (2, 4))
+        self.assertGreater(seconds, 0.0)
+
+    def test_Evicted(self):
+        path = self.create_file(self.LINES)
+        x = ListingsReader(path, self.create_logger())
+        x.set_dedup_cache_size(1)
+        actual = list(x)
+        self.assertEqual([listing.title for listing in actual], ["A", "A", "C", "A"])
+        self.assertIs(actual[0], actual[1])
+        self.assertIsNot(actual[0], actual[3])
+
+    def test_Disabled(self):
+        path = self.create_file(self.LINES)
+        x = ListingsReader(path, self.create_logger())
+        x.set_dedup_cache_size(10)
+        x.set_dedup_cache_size(None)
+        actual = list(x)
+        self.assertIsNot(actual[0], actual[1])
+        self.assertIsNone(x.dedup_cache_info())
+
+
+class Test_load_json_backend(unittest.TestCase):
+
+    def test_Json(self):
+        self.assertEqual(load_json_backend("json"), ("json", json.loads))
+
+    def test_Auto(self):
+        (name, loads) = load_json_backend("auto")
+        self.assertIn(name, JSON_BACKENDS)
+        self.assertEqual(loads(b'{"a": "b"}'), {"a": "b"})
+
+    def test_Auto_NothingOptionalInstalled(self):
+        with unittest.mock.patch.dict(sys.modules, {"orjson": None, "simdjson": None}):
+            self.assertEqual(load_json_backend("auto"), ("json", json.loads))
+
+    def test_NotInstalled(self):
+        with unittest.mock.patch.dict(sys.modules, {"orjson": None}):
+            with self.assertRaises(ImportError):
+                load_json_backend("orjson")
+
+    def test_Unknown(self):
+        with self.assertRaises(ValueError):
+            load_json_backend("yaml")
+
+
+class Test_parse_announced_date(unittest.TestCase):
+
+    def test_ConvertedToUtc(self):
+        actual = parse_announced_date("2009-01-06T19:00:00.000-05:00")
+        self.assertEqual(actual, datetime.datetime(2009, 1, 7, 0, 0))
+
+    def test_Invalid(self):
+        with self.assertRaises(ValueError):
+            parse_announced_date("2009-01-06")
+
+
+class Test_tokenize(unittest.TestCase):
+
+    def test_Empty(self):
+        self.assertEqual(tokenize(""), [])
+
+    def test_SeparatorsAndCase(self):
+        actual = tokenize("Sony DSC-W310 (Black)_12.1MP")
+        self.assertEqual(actual, ["sony", "dsc", "w310", "black", "12", "1mp"])
+
+
+class Test_ManufacturerTable(unittest.TestCase):
+
+    def test_add_SameCanonicalName(self):
+        x = ManufacturerTable()
+        id1 = x.add("Fujifilm")
+        id2 = x.add("FUJI PHOTO")
+        id3 = x.add("Canon")
+        self.assertEqual(id1, id2)
+        self.assertNotEqual(id1, id3)
+        self.assertEqual(len(x), 2)
+
+    def test_lookup_Exact(self):
+        x = ManufacturerTable()
+        manufacturer_id = x.add("Canon")
+        self.assertEqual(x.lookup("Canon"), manufacturer_id)
+        self.assertEqual(x.lookup("CANON"), manufacturer_id)
+
+    def test_lookup_Prefix(self):
+        x = ManufacturerTable()
+        manufacturer_id = x.add("Canon")
+        self.assertEqual(x.lookup("Canon Canada"), manufacturer_id)
+
+    def test_lookup_Alias(self):
+        x = ManufacturerTable()
+        manufacturer_id = x.add("Fujifilm")
+        self.assertEqual(x.lookup("FUJI PHOTO FILM CO., LTD."), manufacturer_id)
+        self.assertEqual(x.lookup("Fuji"), manufacturer_id)
+
+    def test_lookup_AliasOfUnknownManufacturer(self):
+        x = ManufacturerTable()
+        x.add("Canon")
+        self.assertIsNone(x.lookup("Fujifilm"))
+
+    def test_lookup_Unknown(self):
+        x = ManufacturerTable()
+        x.add("Canon")
+        self.assertIsNone(x.lookup("Nikon"))
+        self.assertIsNone(x.lookup(""))
+
+    def test_lookup_CacheInvalidatedByAdd(self):
+        x = ManufacturerTable()
+        x.add("Canon")
+        self.assertIsNone(x.lookup("Nikon"))
+        manufacturer_id = x.add("Nikon")
+        self.assertEqual(x.lookup("Nikon"), manufacturer_id)
+
+
+class Test_ProductMatcher(unittest.TestCase):
+
+    def test___init__(self):
+        product = Product("Pentax_Optio_WG-1_GPS", "Pentax", "WG-1 GPS", "Optio", None)
+        x = ProductMatcher(5, product)
+        self.assertEqual(x.product_index, 5)
+        self.assertEqual(x.model_tokens, ("wg", "1", "gps"))
+        self.assertEqual(x.model_key, "wg1gps")
+        self.assertEqual(x.family_tokens, ("optio",))
+        self.assertEqual(x.specificity, (3, 6))
+
+    def test___init___SpecificityIgnoresPunctuation(self):
+        x1 = ProductMatcher(0, Product("Canon_A1200", "Canon", "A1200", None, None))
+        x2 = ProductMatcher(1, Product("Canon_A-1200", "Canon", "A-1200", None, None))
+        self.assertEqual(x1.specificity, (2, 5))
+        self.assertEqual(x2.specificity, x1.specificity)
+
+    def test___init___NoFamily(self):
+        product = Product("Samsung_TL240", "Samsung", "TL240", None, None)
+        x = ProductMatcher(0, product)
+        self.assertEqual(x.family_tokens, ())
+
+    def test_score(self):
+        product = Product("Pentax_Optio_WG-1_GPS", "Pentax", "WG-1 GPS", "Optio", None)
+        x = ProductMatcher(0, product)
+        self.assertEqual(x.score({"pentax", "optio", "wg", "1", "gps"}), (4, 6))
+        self.assertEqual(x.score({"pentax", "wg1gps"}), (3, 6))
+
+
+class Test_ProductIndex(unittest.TestCase):
+
+    def test_find_candidates_ModelSpellings(self):
+        x = self.create_index()
+        postings = x.buckets[x.manufacturers.lookup("Sony")]
+        for title in ["Sony DSC-W310", "Sony DSC W310 Black", "Sony DSCW310"]:
+            with self.subTest(title=title):
+                actual = x.find_candidates(postings, x.find_title_keys(title))
+                self.assertEqual(actual, [0])
+
+    def test_find_candidates_NoCandidates(self):
+        x = self.create_index()
+        postings = x.buckets[x.manufacturers.lookup("Sony")]
+        self.assertEqual(x.find_candidates(postings, x.find_title_keys("Sony A1200")), [])
+
+    def test_find_title_keys(self):
+        x = self.create_index()
+        actual = x.find_title_keys("Sony DSC W310 and Canon A-1200 bundle")
+        self.assertEqual(actual, ("dscw310", "a1200"))
+
+    def test_find_title_keys_Automaton(self):
+        x = ProductIndex([
+            Product("Sony_Cyber-shot_DSC-W310", "Sony", "DSC-W310", "Cyber-shot", None),
+            Product("Canon_PowerShot_A1200", "Canon", "A1200", "PowerShot", None),
+            Product("Canon_EOS_550D", "Canon", "550D", "EOS", None),
+            Product("Canon_EOS_550D_Kit", "Canon", "550D Kit", "EOS", None),
+            Product("Olympus_E_5", "Olympus", "E-5", None, None),
+        ])
+        token_keys = x.find_title_keys
+        x.set_engine("automaton")
+        for title in [
+            "Sony DSC W310 and Canon A-1200 bundle",
+            "Sony DSCW310 DSC-W310",
+            "XDSC W310 dscw3100",
+            "Canon EOS 550D Kit",
+            "Canon EOS 550 D Kit e 5",
+            "D S C W 3 1 0",
+            "",
+        ]:
+            with self.subTest(title=title):
+                self.assertEqual(x.find_title_keys(title), token_keys(title))
+
+    def test_set_engine_Unknown(self):
+        x = self.create_index()
+        with self.assertRaises(ValueError):
+            x.set_engine("regex")
+
+    def test_pickle_Automaton(self):
+        x = ProductIndex(self.create_index().products, engine="automaton")
+        actual = pickle.loads(pickle.dumps(x))
+        self.assertEqual(actual.engine, "automaton")
+        self.assertEqual(actual.find_title_keys("Canon A1200"), ("a1200",))
+
+    def test_find_title_keys_Cached(self):
+        x = self.create_index()
+        with unittest.mock.patch("ProductListingMatcher.tokenize", wraps=tokenize) as mock:
+            x.find_title_keys("Sony DSC-W310")
+            x.find_title_keys("Sony DSC-W310")
+        self.assertEqual(mock.call_count, 1)
+
+    def test_match_listings_TitleCacheStats(self):
+        x = self.create_index()
+        stats = MatchStats()
+        listings = [Listing("Sony DSC-W310", "Sony", "CAD", None)] * 4
+        self.assertEqual(len(list(x.match_listings(listings, stats))), 4)
+        self.assertEqual(stats.title_cache_hit_count, 3)
+        self.assertEqual(stats.title_cache_miss_count, 1)
+        self.assertEqual(stats.title_cache_hit_rate(), 0.75)
+
+    def test_Pickle(self):
+        x = self.create_index()
+        actual = pickle.loads(pickle.dumps(x))
+        self.assertEqual(actual.buckets, x.buckets)
+        self.assertEqual(actual.find_title_keys("Sony DSC-W310"), ("dscw310",))
+
+    def test_Pickle_Dedup(self):
+        x = self.create_index()
+        x.set_dedup_cache_size(10)
+        x.match_listing(Listing("Sony DSC-W310", "Sony", "CAD", None), MatchStats())
+        state = x.__getstate__()
+        self.assertNotIn("dedup_cache", state)
+        self.assertNotIn("match_listing", state)
+        actual = pickle.loads(pickle.dumps(x))
+        self.assertIsNone(actual.dedup_cache)
+        self.assertEqual(actual.match_listing.__func__, ProductIndex.match_listing)
+
+    def test_match_listing_Dedup(self):
+        listings = [
+            Listing("Sony DSC-W310", "Sony", "CAD", decimal.Decimal("1.00")),
+            Listing("Canon PowerShot A1200", "Canon", "CAD", decimal.Decimal("2.00")),
+            Listing("  SONY dsc-w310 ", "Sony", "CAD", decimal.Decimal("1.00")),
+            Listing("Sony DSC-W310", "Sony", "USD", decimal.Decimal("1.00")),
+            Listing("Nikon D90", "Nikon", "CAD", decimal.Decimal("3.00")),
+            Listing("Sony\tDSC-W310", "Sony", "CAD", decimal.Decimal("1.00")),
+            Listing("nikon d90", "Nikon", "CAD", decimal.Decimal("3.00")),
+            Listing("Canon  PowerShot A1200", "Canon", "CAD", decimal.Decimal("2.00")),
+        ]
+        expected_stats = MatchStats(collect_histogram=True)
+        x = self.create_index()
+        expected = [x.match_listing(listing, expected_stats) for listing in listings]
+
+        stats = MatchStats(collect_histogram=True)
+        x = self.create_index()
+        x.set_dedup_cache_size(10)
+        with unittest.mock.patch.object(x, "match_title", wraps=x.match_title) as mock:
+            actual = [x.match_listing(listing, stats) for listing in listings]
+        self.assertEqual(actual, expected)
+        self.assertEqual(mock.call_count, 4)
+        self.assertEqual((stats.duplicate_count, stats.distinct_count), (4, 4))
+        self.assertGreater(stats.distinct_match_seconds, 0.0)
+        self.assertGreater(stats.duplicate_seconds, 0.0)
+        self.assertGreater(stats.distinct_match_seconds, 0.0)
+        for name in ("listing_count", "candidate_count", "matched_count", "resolved_count",
+                     "ambiguous_count", "unknown_manufacturer_count", "candidate_histogram"):
+            self.assertEqual(getattr(stats, name), getattr(expected_stats, name), name)
+
+    def test_match_listing_Dedup_Resolved(self):
+        x = ProductIndex([
+            Product("Olympus_Stylus_T100", "Olympus", "T100", "Stylus", None),
+            Product("Olympus_Mju_T100", "Olympus", "T100", "Mju", None),
+        ])
+        x.set_dedup_cache_size(10)
+        stats = MatchStats()
+        for title in ["Olympus Mju T100", "OLYMPUS MJU T100", "Olympus T100", "olympus t100"]:
+            x.match_listing(Listing(title, "Olympus", "USD", None), stats)
+        self.assertEqual((stats.matched_count, stats.resolved_count, stats.ambiguous_count),
+                         (2, 2, 2))
+        self.assertEqual(stats.candidate_count, 8)
+
+    def test_match_listing_Dedup_Evicted(self):
+        x = self.create_index()
+        x.set_dedup_cache_size(1)
+        stats = MatchStats()
+        for title in ["Sony DSC-W310", "Canon A1200", "Sony DSC-W310", "Sony DSC-W310"]:
+            x.match_listing(Listing(title, "Sony", "USD", None), stats)
+        self.assertEqual((stats.duplicate_count, stats.distinct_count), (1, 3))
+        self.assertEqual(len(x.dedup_cache), 1)
+
+    def test_match_batch_Dedup(self):
+        x = self.create_index()
+        x.set_dedup_cache_size(10)
+        batch = ListingBatch()
+        for (title, manufacturer, price_str) in [
+            ("Sony DSC-W310", "Sony", "1.00"),
+            ("SONY  DSC-W310", "Sony", "1.00"),
+            ("Sony DSC-W310", "Sony", "1.0"),
+            ("Canon PowerShot A1200", "Canon", "2.00"),
+            ("Canon PowerShot A1200", "Nikon", "2.00"),
+        ]:
+            batch.append(len(batch) + 1, title, manufacturer, "CAD", price_str)
+        batch.append_listing(6, Listing("sony dsc-w310", "Sony", "CAD", decimal.Decimal("1E+2")))
+        batch.append_listing(7, Listing("Sony DSC-W310", "Sony", "CAD", decimal.Decimal("1E+2")))
+        stats = MatchStats()
+        self.assertEqual(x.match_batch(batch, stats), [(0, 0), (0, 1), (0, 2), (1, 3), (0, 5),
+                                                       (0, 6)])
+        self.assertEqual((stats.duplicate_count, stats.distinct_count), (2, 5))
+        self.assertEqual(stats.matched_count, 6)
+        self.assertEqual(stats.unknown_manufacturer_count, 1)
+
+    def test_match_listing_Matched(self):
+        x = self.create_index()
+        stats = MatchStats()
+        listing = Listing("Canon PowerShot A1200 (Black)", "Canon Canada", "CAD", None)
+        actual = x.match_listing(listing, stats)
+        self.assertEqual(actual, 1)
+        self.assertEqual(stats.matched_count, 1)
+        self.assertEqual(stats.candidate_count, 1)
+
+    def test_match_listing_OtherManufacturersModel(self):
+        x = self.create_index()
+        stats = MatchStats()
+        listing = Listing("Canon PowerShot A1200 (Black)", "Sony", "CAD", None)
+        self.assertIsNone(x.match_listing(listing, stats))
+        self.assertEqual(stats.matched_count, 0)
+        self.assertEqual(stats.candidate_count, 0)
+
+    def test_match_listing_UnknownManufacturer(self):
+        x = self.create_index()
+        stats = MatchStats()
+        listing = Listing("Canon PowerShot A1200 (Black)", "Nikon", "CAD", None)
+        with unittest.mock.patch("ProductListingMatcher.tokenize", wraps=tokenize) as mock:
+            self.assertIsNone(x.match_listing(listing, stats))
+        self.assertNotIn(unittest.mock.call(listing.title), mock.call_args_list)
+        self.assertEqual(stats.unknown_manufacturer_count, 1)
+
+    def test_match_listing_Ambiguous(self):
+        x = ProductIndex([
+            Product("Canon_PowerShot_A1200", "Canon", "A1200", "PowerShot", None),
+            Product("Canon_A1200", "Canon", "A-1200", None, None),
+        ])
+        stats = MatchStats()
+        listing = Listing("Canon A1200", "Canon", "CAD", None)
+        self.assertIsNone(x.match_listing(listing, stats))
+        self.assertEqual(stats.ambiguous_count, 1)
+        self.assertEqual(stats.resolved_count, 0)
+
+    def test_match_listing_ResolvedByModel(self):
+        x = ProductIndex([
+            Product("Canon_EOS_550D", "Canon", "550D", "EOS", None),
+            Product("Canon_EOS_550D_Kit", "Canon", "550D Kit", "EOS", None),
+        ])
+        stats = MatchStats()
+        for (title, expected) in [
+            ("Canon EOS 550D Kit with 18-55mm lens", 1),
+            ("Canon 550D Kit", 1),
+            ("Canon EOS 550D body", 0),
+        ]:
+            with self.subTest(title=title):
+                listing = Listing(title, "Canon", "CAD", None)
+                self.assertEqual(x.match_listing(listing, stats), expected)
+        self.assertEqual(stats.matched_count, 3)
+        self.assertEqual(stats.resolved_count, 2)
+        self.assertEqual(stats.ambiguous_count, 0)
+
+    def test_match_batch(self):
+        x = self.create_index()
+        batch = ListingBatch()
+        for (title, manufacturer) in [
+            ("Sony DSC-W310", "Sony"),
+            ("Canon PowerShot A1200 (Black)", "Canon Canada"),
+            ("Nikon D90", "Nikon"),
+            ("Sony DSC-W310 (Pink)", "Sony"),
+            ("Canon PowerShot A1200 (Black)", "Sony"),
+        ]:
+            batch.append(len(batch) + 1, title, manufacturer, "CAD", "1.00")
+        stats = MatchStats()
+        self.assertEqual(x.match_batch(batch, stats), [(0, 0), (1, 1), (0, 3)])
+        self.assertEqual(stats.listing_count, 5)
+        self.assertEqual(stats.matched_count, 3)
+        self.assertEqual(stats.unknown_manufacturer_count, 1)
+
+    def test_match_listing_ResolvedByFamily(self):
+        x = ProductIndex([
+            Product("Olympus_Stylus_T100", "Olympus", "T100", "Stylus", None),
+            Product("Olympus_Mju_T100", "Olympus", "T100", "Mju", None),
+        ])
+        stats = MatchStats()
+        listing = Listing("Olympus Mju T100 12MP", "Olympus", "USD", None)
+        self.assertEqual(x.match_listing(listing, stats), 1)
+        listing = Listing("Olympus T100 12MP", "Olympus", "USD", None)
+        self.assertIsNone(x.match_listing(listing, stats))
+        self.assertEqual(stats.resolved_count, 1)
+        self.assertEqual(stats.ambiguous_count, 1)
+
+    def test_explain_listing(self):
+        x = ProductIndex([
+            Product("Olympus_Stylus_T100", "Olympus", "T100", "Stylus", None),
+            Product("Olympus_Mju_T100", "Olympus", "T100", "Mju", None),
+            Product("Olympus_Mju_T100_Kit", "Olympus", "T100 Kit", "Mju", None),
+        ])
+        for (title, manufacturer, decision, product, candidate_scores) in [
+            ("Olympus Mju T100 12MP", "Olympus", "resolved", "Olympus_Mju_T100",
+             {"Olympus_Stylus_T100": [2, 4], "Olympus_Mju_T100": [3, 4]}),
+            ("Olympus T100 Kit", "Olympus", "resolved", "Olympus_Mju_T100_Kit",
+             {"Olympus_Stylus_T100": [2, 4], "Olympus_Mju_T100": [2, 4],
+              "Olympus_Mju_T100_Kit": [3, 7]}),
+            ("Olympus T100 12MP", "Olympus", "ambiguous", None,
+             {"Olympus_Stylus_T100": [2, 4], "Olympus_Mju_T100": [2, 4]}),
+            ("Olympus Stylus T200", "Olympus", "no_candidates", None, {}),
+            ("Olympus T100", "Nikon", "unknown_manufacturer", None, {}),
+        ]:
+            with self.subTest(title=title, manufacturer=manufacturer):
+                listing = Listing(title, manufacturer, "USD", None)
+                actual = x.explain_listing(listing)
+                self.assertEqual(actual["decision"], decision)
+                self.assertEqual(actual["product"], product)
+                self.assertEqual({candidate["product"]: candidate["score"]
+                                  for candidate in actual["candidates"]}, candidate_scores)
+                expected_index = x.match_listing(listing, MatchStats())
+                self.assertEqual(product, None if expected_index is None
+                                 else x.products[expected_index].name)
+
+    def test_explain_listing_TitleKeys(self):
+        x = self.create_index()
+        cache_info = x.find_title_keys.cache_info()
+        actual = x.explain_listing(Listing("Sony DSC W310 Black", "Sony", "USD", None))
+        self.assertEqual(actual, {
+            "title_keys": ["dscw310"],
+            "candidates": [
+                {"product": "Sony_Cyber-shot_DSC-W310", "model_key": "dscw310",
+                 "score": [2, 7]},
+            ],
+            "decision": "single_candidate",
+            "product": "Sony_Cyber-shot_DSC-W310",
+        })
+        self.assertEqual(x.find_title_keys.cache_info(), cache_info)
+
+    def create_index(self):
+        return ProductIndex([
+            Product("Sony_Cyber-shot_DSC-W310", "Sony", "DSC-W310", "Cyber-shot", None),
+            Product("Canon_PowerShot_A1200", "Canon", "A1200", "PowerShot", None),
+        ])
+
+
+class Test_AhoCorasickAutomaton(unittest.TestCase):
+
+    def test_iter(self):
+        x = AhoCorasickAutomaton(["he", "she", "his", "hers"])
+        actual = list(x.iter("ushers"))
+        self.assertEqual(actual, [(3, "she"), (3, "he"), (5, "hers")])
+
+    def test_iter_Overlapping(self):
+        x = AhoCorasickAutomaton(["a", "aa", "aaa"])
+        actual = sorted(x.iter("aaa"))
+        self.assertEqual(actual, [(0, "a"), (1, "a"), (1, "aa"), (2, "a"), (2, "aa"),
+                                  (2, "aaa")])
+
+    def test_iter_NoKeys(self):
+        x = AhoCorasickAutomaton([])
+        self.assertEqual(list(x.iter("abc")), [])
+
+    def test_create_automaton_SameAsPurePython(self):
+        keys = ["dscw310", "w310", "a1200", "a12", "550d", "550dkit"]
+        text = "sonydscw310canona1200canon550dkit"
+        expected = sorted(AhoCorasickAutomaton(keys).iter(text))
+        self.assertEqual(sorted(create_automaton(keys).iter(text)), expected)
+        self.assertEqual(list(create_automaton([]).iter(text)), [])
+
+
+class Test_ProductIndexCache(TempFileTestCase):
+
+    def test_load_NoCacheFile(self):
+        x = self.create_cache()
+        self.assertIsNone(x.load(x.compute_fingerprint()))
+
+    def test_load_Unchanged(self):
+        x = self.create_cache()
+        self.save(x)
+        actual = x.load(x.compute_fingerprint())
+        self.assertEqual(actual.products, self.products())
+        self.assertEqual(actual.find_title_keys("Canon A1200"), ("a1200",))
+
+    def test_load_Touched(self):
+        x = self.create_cache()
+        self.save(x)
+        st = os.stat(x.products_path)
+        os.utime(x.products_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+        fingerprint = x.compute_fingerprint()
+        self.assertIsNotNone(x.load(fingerprint))
+
+    def test_load_ContentChanged(self):
+        x = self.create_cache()
+        self.save(x)
+        with open(x.products_path, "r+b") as f:
+            f.write(b"X")
+        self.assertIsNone(x.load(x.compute_fingerprint()))
+
+    def test_load_FormatVersionChanged(self):
+        x = self.create_cache()
+        self.save(x)
+        with unittest.mock.patch.object(ProductIndexCache, "FORMAT_VERSION", -1):
+            self.assertIsNone(x.load(x.compute_fingerprint()))
+
+    def test_load_Corrupt(self):
+        x = self.create_cache()
+        os.makedirs(x.cache_dir)
+        with open(x.path, "wb") as f:
+            f.write(b"not a pickle")
+        with self.assertRaises(x.Error):
+            x.load(x.compute_fingerprint())
+
+    def test_path_DependsOnProductsPath(self):
+        x1 = ProductIndexCache(self.temp_dir.name, "products1.txt")
+        x2 = ProductIndexCache(self.temp_dir.name, "products2.txt")
+        self.assertNotEqual(x1.path, x2.path)
+
+    def create_cache(self):
+        products_path = self.create_file(["product data"], name="products.txt")
+        return ProductIndexCache(os.path.join(self.temp_dir.name, "cache"), products_path)
+
+    def save(self, cache):
+        cache.save(cache.compute_fingerprint(), ProductIndex(self.products()))
+
+    def products(self):
+        return [Product("Canon_PowerShot_A1200", "Canon", "A1200", "PowerShot", None)]
+
+
+class Test_ParallelMatcher(TempFileTestCase):
+
+    def test_match_SameAsSerial(self):
+        lines = []
+        for i in range(50):
+            lines.append('{"title":"Sony DSC-W310 #%d","manufacturer":"Sony",'
+                         '"currency":"USD","price":"99.99"}' % i)
+            lines.append('{"title":"Canon EOS 550D #%d","manufacturer":"Canon Canada",'
+                         '"currency":"CAD","price":"799.99"}' % i)
+            lines.append('{"title":"Nikon D90 #%d","manufacturer":"Nikon",'
+                         '"currency":"CAD","price":"799.99"}' % i)
+            lines.append('not json')
+        path = self.create_file(lines)
+
+        serial_stats = MatchStats()
+        serial_reader = ListingsReader(path, self.create_logger())
+        expected = list(self.create_index().match_listings(serial_reader, serial_stats))
+
+        parallel_stats = MatchStats()
+        parallel_reader = ListingsReader(path, self.create_logger())
+        x = ParallelMatcher(self.create_index(), jobs=3, chunk_size=7)
+        actual = list(x.match(parallel_reader, parallel_stats))
+
+        self.assertEqual(len(expected), 100)
+        self.assertEqual(actual, expected)
+        self.assertEqual(vars(parallel_stats), vars(serial_stats))
+        self.assertEqual(parallel_reader.error_count, 50)
+        self.assertEqual(parallel_reader.line_count, 200)
+
+    def test_match_ranges_SameAsSerial(self):
+        lines = []
+        for i in range(50):
+            lines.append('{"title":"Sony DSC-W310 #%d","manufacturer":"Sony",'
+                         '"currency":"USD","price":"99.99"}' % i)
+            lines.append('{"title":"Canon EOS 550D #%d","manufacturer":"Canon Canada",'
+                         '"currency":"CAD","price":"799.99"}' % i)
+            lines.append('  ')
+            lines.append('not json %d' % i)
+        path = self.create_file(lines)
+
+        for json_backend in ("json", "auto"):
+            with self.subTest(json_backend=json_backend):
+                serial_stats = MatchStats()
+                serial_reader = ListingsReader(path, self.create_logger(), json_backend)
+                expected_path = os.path.join(self.temp_dir.name, "expected.txt")
+                with ResultsWriter(expected_path, self.create_index().products) as writer:
+                    for (product_index, listing) in self.create_index().match_listings(
+                            serial_reader, serial_stats):
+                        writer.add(product_index, listing)
+                    writer.write()
+
+                parallel_stats = MatchStats()
+                logger = self.create_logger()
+                parallel_reader = ListingsReader(path, logger, json_backend)
+                actual_path = os.path.join(self.temp_dir.name, "actual.txt")
+                x = ParallelMatcher(self.create_index(), jobs=3, range_size=500)
+                with ResultsWriter(actual_path, self.create_index().products) as writer:
+                    with self.assertLogs(logger) as cm:
+                        x.match_ranges(parallel_reader, writer, parallel_stats)
+                    self.assertGreater(len(writer.run_paths), 3)
+                    writer.write()
+
+                with open(expected_path, "rt", encoding="utf8") as f:
+                    expected = f.read()
+                with open(actual_path, "rt", encoding="utf8") as f:
+                    self.assertEqual(f.read(), expected)
+                self.assertEqual(vars(parallel_stats), vars(serial_stats))
+                self.assertEqual(parallel_reader.error_count, 50)
+                self.assertEqual(parallel_reader.line_count, 200)
+                self.assertEqual(parallel_reader.offset, os.path.getsize(path))
+                self.assertIn("{}:8: invalid JSON".format(path), cm.output[1])
+
+    def create_index(self):
+        return ProductIndex([
+            Product("Sony_Cyber-shot_DSC-W310", "Sony", "DSC-W310", "Cyber-shot", None),
+            Product("Canon_PowerShot_A1200", "Canon", "A1200", "PowerShot", None),
+            Product("Canon_EOS_550D", "Canon", "550D", "EOS", None),
+        ])
+
+
+class Test_Pipeline(unittest.TestCase):
+
+    def test_run(self):
+        x = Pipeline(queue_size=2)
+        batches = x.run("read", x.iter_batches(range(10), 3),
+                        [("double", lambda batch: [i * 2 for i in batch]), ("sum", sum)],
+                        "write")
+        self.assertEqual(list(batches), [6, 24, 42, 18])
+        self.assertEqual([stage.name for stage in x.stages], ["read", "double", "sum", "write"])
+        for stage in x.stages:
+            self.assertEqual(stage.batch_count, 4)
+            self.assertLessEqual(stage.max_queue_depth, 2)
+        self.assertFalse(any(thread.is_alive() for thread in x.threads))
+
+    def test_run_Backpressure(self):
+        x = Pipeline(queue_size=1)
+        read_count = 0
+
+        def read():
+            nonlocal read_count
+            for i in range(100):
+                read_count += 1
+                yield [i]
+
+        batches = x.run("read", read(), [("match", list)], "write")
+        self.assertEqual(next(batches), [0])
+        # wait for the stages to fill the queues
+        time.sleep(0.5)
+        # a batch in each queue, one being put into each and the one yielded
+        self.assertLessEqual(read_count, 5)
+        batches.close()
+        self.assertFalse(any(thread.is_alive() for thread in x.threads))
+        self.assertGreater(x.stages[0].output_stall_seconds, 0.0)
+
+    def test_run_Error(self):
+        def fail(batch):
+            raise ValueError("bad batch: {}".format(batch))
+
+        x = Pipeline()
+        batches = x.run("read", [[1], [2]], [("parse", fail), ("match", list)], "write")
+        with self.assertRaises(ValueError) as cm:
+            list(batches)
+        self.assertEqual(str(cm.exception), "bad batch: [1]")
+        self.assertFalse(any(thread.is_alive() for thread in x.threads))
+
+    def test_iter_batches(self):
+        self.assertEqual(list(Pipeline.iter_batches("abcde", 2)), [["a", "b"], ["c", "d"], ["e"]])
+        self.assertEqual(list(Pipeline.iter_batches("", 2)), [])
+
+
+class Test_split_line_ranges(TempFileTestCase):
+
+    def test_split_line_ranges(self):
+        path = self.create_file(["line {}".format(i) for i in range(100)])
+        for range_count in (1, 2, 3, 7, 100, 1000):
+            with self.subTest(range_count=range_count):
+                ranges = split_line_ranges(path, range_count)
+                self.assert_ranges(path, ranges, 0, os.path.getsize(path))
+                self.assertLessEqual(len(ranges), range_count)
+                if range_count <= 7:
+                    self.assertEqual(len(ranges), range_count)
+
+    def test_split_line_ranges_StartOffset(self):
+        path = self.create_file(["line {}".format(i) for i in range(100)])
+        ranges = split_line_ranges(path, 4, start_offset=7)
+        self.assert_ranges(path, ranges, 7, os.path.getsize(path))
+
+    def test_split_line_ranges_CompleteLinesOnly(self):
+        path = self.create_file(["line {}".format(i) for i in range(100)])
+        complete_size = os.path.getsize(path)
+        with open(path, "ab") as f:
+            f.write(b"partial")
+        ranges = split_line_ranges(path, 4, complete_lines_only=True)
+        self.assert_ranges(path, ranges, 0, complete_size)
+        ranges = split_line_ranges(path, 4)
+        self.assert_ranges(path, ranges, 0, complete_size + 7)
+
+    def test_split_line_ranges_Empty(self):
+        path = self.create_file([])
+        self.assertEqual(split_line_ranges(path, 4), [])
+        path = self.create_file(["line"])
+        self.assertEqual(split_line_ranges(path, 4, start_offset=5), [])
+
+    def assert_ranges(self, path, ranges, start_offset, end_offset):
+        with open(path, "rb") as f:
+            data = f.read()
+        self.assertEqual(ranges[0][0], start_offset)
+        self.assertEqual(ranges[-1][1], end_offset)
+        for ((_, end), (start, _)) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(data[end - 1:end], b"\n")
+
+
+class Test_MatchServer(TempFileTestCase):
+
+    LINES = [
+        b'{"title":"Sony DSC-W310","manufacturer":"Sony","currency":"USD","price":"99.99"}\n',
+        b'not json\n',
+        b'\n',
+        b'{"title":"Nikon D90","manufacturer":"Nikon","currency":"CAD","price":"899.99"}\n',
+    ]
+
+    EXPECTED_RESPONSES = [
+        {"product_name": "Sony_Cyber-shot_DSC-W310"},
+        {"error": "invalid JSON: Expecting value: line 1 column 1 (char 0)"},
+        {"product_name": None},
+    ]
+
+    def test_serve_Stream(self):
+        output_stream = io.BytesIO()
+        x = MatchServer(self.create_index(), self.create_logger(),
+                        input_stream=io.BytesIO(b"".join(self.LINES)),
+                        output_stream=output_stream, json_backend="json")
+        x.run()
+        actual = [json.loads(line) for line in output_stream.getvalue().splitlines()]
+        self.assertEqual(actual, self.EXPECTED_RESPONSES)
+        self.assertEqual(x.stats.listing_count, 2)
+        self.assertEqual(x.stats.matched_count, 1)
+
+    def test_serve_Socket(self):
+        socket_path = os.path.join(self.temp_dir.name, "test.sock")
+        x = MatchServer(self.create_index(), self.create_logger(), socket_path=socket_path,
+                        json_backend="json")
+
+        async def run_client():
+            (reader, writer) = await asyncio.open_unix_connection(socket_path)
+            responses = []
+            for line in self.LINES:
+                writer.write(line)
+                if not line.isspace():
+                    responses.append(json.loads(await reader.readline()))
+            writer.close()
+            await writer.wait_closed()
+            return responses
+
+        async def run():
+            server_task = asyncio.ensure_future(x.serve())
+            while x.ready is None or not x.ready.is_set():
+                await asyncio.sleep(0.01)
+            responses = await asyncio.gather(run_client(), run_client())
+            x.stop()
+            await server_task
+            return responses
+
+        actual = asyncio.run(run())
+        self.assertEqual(actual, [self.EXPECTED_RESPONSES, self.EXPECTED_RESPONSES])
+        self.assertEqual(x.stats.listing_count, 4)
+        self.assertFalse(os.path.exists(socket_path))
+
+    def test_serve_ReloadCommand(self):
+        nikon_line = self.LINES[3]
+        (actual, x) = self.serve_lines([
+            nikon_line, b'{"command": "reload"}\n', nikon_line,
+        ], load_index=self.create_reloaded_index)
+        self.assertEqual(actual[0], {"product_name": None})
+        self.assertEqual(actual[1]["reloaded"], True)
+        self.assertEqual(actual[1]["product_count"], 2)
+        self.assertEqual((actual[1]["added"], actual[1]["removed"], actual[1]["changed"]),
+                         (1, 0, 0))
+        self.assertEqual(actual[2], {"product_name": "Nikon_D90"})
+        self.assertEqual(len(x.index.products), 2)
+
+    def test_serve_TitleCacheStats(self):
+        (sony_line, nikon_line) = (self.LINES[0], self.LINES[3])
+        (actual, x) = self.serve_lines([
+            sony_line, sony_line, b'{"command": "reload"}\n', sony_line, sony_line, nikon_line,
+        ], load_index=self.create_reloaded_index)
+        self.assertEqual(actual[2]["reloaded"], True)
+        # each index's title cache starts empty
+        self.assertEqual(x.stats.title_cache_hit_count, 2)
+        self.assertEqual(x.stats.title_cache_miss_count, 3)
+
+    def test_serve_ReloadFailed(self):
+        def load_index():
+            raise ValueError("no products")
+
+        (actual, x) = self.serve_lines([b'{"command": "reload"}\n', self.LINES[0]],
+                                       load_index=load_index)
+        self.assertEqual(actual, [
+            {"error": "reloading products failed: no products"},
+            {"product_name": "Sony_Cyber-shot_DSC-W310"},
+        ])
+
+    def test_serve_UnknownCommand(self):
+        (actual, x) = self.serve_lines([b'{"command": "reload"}\n'])
+        self.assertEqual(actual, [{"error": "unknown command: reload"}])
+
+    def test_start_reload(self):
+        logger = self.create_logger()
+        x = MatchServer(self.create_index(), logger, input_stream=io.BytesIO(),
+                        output_stream=io.BytesIO(), load_index=self.create_reloaded_index)
+
+        async def run():
+            x.reload_lock = asyncio.Lock()
+            x.start_reload()
+            await asyncio.gather(*x.reload_tasks)
+
+        with self.assertLogs(logger) as cm:
+            asyncio.run(run())
+        self.assertEqual(len(x.index.products), 2)
+        self.assertIn("INFO:{}:Added products: Nikon_D90".format(logger.name), cm.output)
+
+    def serve_lines(self, lines, load_index=None):
+        output_stream = io.BytesIO()
+        x = MatchServer(self.create_index(), self.create_logger(),
+                        input_stream=io.BytesIO(b"".join(lines)),
+                        output_stream=output_stream, load_index=load_index)
+        x.run()
+        return ([json.loads(line) for line in output_stream.getvalue().splitlines()], x)
+
+    def create_index(self):
+        return ProductIndex([
+            Product("Sony_Cyber-shot_DSC-W310", "Sony", "DSC-W310", "Cyber-shot", None),
+        ])
+
+    def create_reloaded_index(self):
+        return ProductIndex([
+            Product("Sony_Cyber-shot_DSC-W310", "Sony", "DSC-W310", "Cyber-shot", None),
+            Product("Nikon_D90", "Nikon", "D90", None, None),
+        ])
+
+
+class Test_diff_products(unittest.TestCase):
+
+    def test_diff_products(self):
+        old_products = [
+            Product("A", "M", "1", None, None),
+            Product("B", "M", "2", None, None),
+            Product("C", "M", "3", None, None),
+        ]
+        new_products = [
+            Product("D", "M", "4", None, None),
+            Product("C", "M", "3", None, None),
+            Product("A", "M", "1", "F", None),
+        ]
+        actual = diff_products(old_products, new_products)
+        self.assertEqual(actual, (["D"], ["B"], ["A"]))
+
+
+class Test_ResultsWriter(TempFileTestCase):
+
+    def test_write_NoSpill(self):
+        self.assert_results(max_buffered_count=1000, expected_run_count=0)
+
+    def test_write_Spill(self):
+        self.assert_results(max_buffered_count=2, expected_run_count=2)
+
+    def test_write_SpillWithRunCompaction(self):
+        with unittest.mock.patch.object(ResultsWriter, "MAX_RUN_COUNT", 2):
+            self.assert_results(max_buffered_count=1, expected_run_count=1)
+
+    def test_close_RemovesRunFiles(self):
+        path = os.path.join(self.temp_dir.name, "results.txt")
+        x = ResultsWriter(path, self.products(), max_buffered_count=1)
+        for (product_index, listing) in self.matches():
+            x.add(product_index, listing)
+        run_paths = list(x.run_paths)
+        x.close()
+        self.assertTrue(run_paths)
+        for run_path in run_paths:
+            self.assertFalse(os.path.exists(run_path))
+
+    def assert_results(self, max_buffered_count, expected_run_count):
+        path = os.path.join(self.temp_dir.name, "results.txt")
+        with ResultsWriter(path, self.products(), max_buffered_count) as x:
+            for (product_index, listing) in self.matches():
+                x.add(product_index, listing)
+            self.assertEqual(len(x.run_paths), expected_run_count)
+            matched_product_count = x.write()
+
+        self.assertEqual(matched_product_count, 2)
+        with open(path, "rt", encoding="utf8") as f:
+            actual = [json.loads(line) for line in f]
+        self.assertEqual(actual, [
+            {"product_name": "A", "listings": [
+                {"title": "A 1", "manufacturer": "M", "currency": "CAD", "price": "1.00"},
+                {"title": "A 2", "manufacturer": "M", "currency": "CAD", "price": "2.00"},
+                {"title": "A 3", "manufacturer": "M", "currency": "CAD", "price": "3.00"},
+            ]},
+            {"product_name": "B", "listings": []},
+            {"product_name": "C", "listings": [
+                {"title": "C 1", "manufacturer": "M", "currency": "USD", "price": "1.50"},
+                {"title": "C 2", "manufacturer": "M", "currency": "USD", "price": "2.50"},
+            ]},
+        ])
+
+    def test_write_SkipUnmatched(self):
+        path = os.path.join(self.temp_dir.name, "results.txt")
+        with ResultsWriter(path, self.products(), skip_unmatched=True) as x:
+            for (product_index, listing) in self.matches():
+                x.add(product_index, listing)
+            x.write()
+        with open(path, "rt", encoding="utf8") as f:
+            actual = [json.loads(line)["product_name"] for line in f]
+        self.assertEqual(actual, ["A", "C"])
+        self.assertEqual(x.listing_counts, [3, 0, 2])
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_write_PriceFilter(self):
+        path = os.path.join(self.temp_dir.name, "results.txt")
+        with ResultsWriter(path, self.products(), max_buffered_count=2,
+                           price_filter=PriceFilter(0.6)) as x:
+            for (product_index, listing) in self.matches():
+                x.add(product_index, listing)
+            x.write()
+        with open(path, "rt", encoding="utf8") as f:
+            actual = [[listing["title"] for listing in json.loads(line)["listings"]]
+                      for line in f]
+        self.assertEqual(actual, [["A 2", "A 3"], [], ["C 1", "C 2"]])
+
+    def products(self):
+        return [Product(name, "M", name, None, None) for name in ("A", "B", "C")]
+
+    def matches(self):
+        return [
+            (2, Listing("C 1", "M", "USD", decimal.Decimal("1.50"))),
+            (0, Listing("A 1", "M", "CAD", decimal.Decimal("1.00"))),
+            (0, Listing("A 2", "M", "CAD", decimal.Decimal("2.00"))),
+            (2, Listing("C 2", "M", "USD", decimal.Decimal("2.50"))),
+            (0, Listing("A 3", "M", "CAD", decimal.Decimal("3.00"))),
+        ]
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class Test_PriceFilter(unittest.TestCase):
+
+    def test_apply(self):
+        x = PriceFilter(0.25)
+        for (product_index, price, currency) in [
+            (0, "500.00", "USD"),
+            (0, "20.00", "USD"),
+            (0, "530.00", "CAD"),
+            (1, "15.00", "GBP"),
+            (0, "100.00", "EUR"),
+            (1, "14.00", "GBP"),
+            (0, "1.00", "XYZ"),
+        ]:
+            x.add(product_index, Listing("T", "M", currency, decimal.Decimal(price)))
+        self.assertEqual(x.apply(3), {1})
+        self.assertEqual(x.rejected_count, 1)
+        self.assertEqual(x.listing_count(), 7)
+
+    def test_apply_Empty(self):
+        x = PriceFilter()
+        self.assertEqual(x.apply(2), set())
+
+    def test_compute_medians(self):
+        product_indexes = numpy.array([2, 0, 2, 0, 2, 0, 0])
+        prices = numpy.array([3.0, 4.0, 1.0, 1.0, 2.0, numpy.nan, 2.0])
+        actual = PriceFilter.compute_medians(product_indexes, prices, 4)
+        numpy.testing.assert_array_equal(actual, [2.0, numpy.nan, 2.0, numpy.nan])
+
+    def test_explain(self):
+        x = PriceFilter(0.25, exchange_rates={"USD": 1.0, "CAD": 2.0})
+        for (price, currency) in [("100.00", "USD"), ("20.00", "CAD"), ("1.00", "XYZ")]:
+            x.add(0, Listing("T", "M", currency, decimal.Decimal(price)))
+        x.add(1, Listing("T", "M", "XYZ", decimal.Decimal("1.00")))
+        x.apply(2)
+        self.assertEqual(x.explain(0), {
+            "price": 100.0, "median_price": 55.0, "min_ratio": 0.25, "rejected": False})
+        self.assertEqual(x.explain(1), {
+            "price": 10.0, "median_price": 55.0, "min_ratio": 0.25, "rejected": True})
+        self.assertEqual(x.explain(2), {
+            "price": None, "median_price": 55.0, "min_ratio": 0.25, "rejected": False})
+        self.assertEqual(x.explain(3), {
+            "price": None, "median_price": None, "min_ratio": 0.25, "rejected": False})
+
+
+class Test_MatchAuditor(TempFileTestCase):
+
+    def test_audit(self):
+        x = self.create_auditor()
+        with x:
+            x.audit(1, Listing("Sony DSC-W310", "Sony", "USD", decimal.Decimal("99.99")), 0)
+            x.audit(2, Listing("Nikon D90", "Nikon", "USD", decimal.Decimal("1.00")))
+        self.assertEqual(x.record_count, 2)
+        self.assertEqual(self.read_records(x), [
+            {"line_number": 1, "title": "Sony DSC-W310", "manufacturer": "Sony",
+             "currency": "USD", "price": "99.99", "title_keys": ["dscw310"],
+             "candidates": [{"product": "Sony_Cyber-shot_DSC-W310", "model_key": "dscw310",
+                             "score": [2, 7]}],
+             "decision": "single_candidate", "product": "Sony_Cyber-shot_DSC-W310"},
+            {"line_number": 2, "title": "Nikon D90", "manufacturer": "Nikon",
+             "currency": "USD", "price": "1.00", "title_keys": [], "candidates": [],
+             "decision": "unknown_manufacturer", "product": None},
+        ])
+
+    def test_audit_SampleRate(self):
+        x = self.create_auditor(sample_rate=0.1)
+        with x:
+            for line_number in range(10000):
+                x.audit(line_number, Listing("Nikon D90", "Nikon", "USD", None))
+        self.assertGreater(x.record_count, 800)
+        self.assertLess(x.record_count, 1200)
+        self.assertEqual(len(self.read_records(x)), x.record_count)
+
+    def test_audit_Products(self):
+        x = self.create_auditor(products=["Canon_PowerShot_A1200", "Unknown"],
+                                manufacturers=["Canon"])
+        self.assertEqual(x.unknown_names, ["Unknown"])
+        with x:
+            for (line_number, title, manufacturer) in [
+                (1, "Sony DSC-W310", "Sony"),
+                (2, "Canon A1200", "Canon Canada"),
+                (3, "Canon PowerShot", "Canon"),
+                (4, "Canon A1200", "Sony"),
+            ]:
+                x.audit(line_number, Listing(title, manufacturer, "USD", None))
+        self.assertEqual([record["line_number"] for record in self.read_records(x)], [2])
+
+    def test_audit_Manufacturers(self):
+        x = self.create_auditor(manufacturers=["Sony", "Nikon"])
+        self.assertEqual(x.unknown_names, ["Nikon"])
+        with x:
+            for (line_number, manufacturer) in [(1, "Sony"), (2, "Canon"), (3, "Nikon")]:
+                x.audit(line_number, Listing("D90", manufacturer, "USD", None))
+        self.assertEqual([record["line_number"] for record in self.read_records(x)], [1])
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_audit_PriceFilter(self):
+        price_filter = PriceFilter(0.5)
+        x = self.create_auditor(price_filter=price_filter)
+        with x:
+            for (sequence, price) in enumerate(["100.00", "10.00"]):
+                listing = Listing("Sony DSC-W310", "Sony", "USD", decimal.Decimal(price))
+                price_filter.add(0, listing)
+                x.audit(sequence + 1, listing, sequence)
+            x.audit(3, Listing("Nikon D90", "Nikon", "USD", decimal.Decimal("1.00")))
+            # the records wait for the price filter outcome
+            self.assertEqual(self.read_records(x), [])
+            price_filter.apply(2)
+        self.assertEqual([record["price_filter"] for record in self.read_records(x)], [
+            {"price": 100.0, "median_price": 55.0, "min_ratio": 0.5, "rejected": False},
+            {"price": 10.0, "median_price": 55.0, "min_ratio": 0.5, "rejected": True},
+            None,
+        ])
+
+    def test___init___Error(self):
+        with self.assertRaises(MatchAuditor.Error):
+            self.create_auditor(path=self.temp_dir.name)
+
+    def test_close_Error(self):
+        x = self.create_auditor()
+        x.f.close()
+        x.f = unittest.mock.Mock(close=unittest.mock.Mock(side_effect=OSError(28, "No space")))
+        with self.assertRaises(MatchAuditor.Error) as cm:
+            x.close()
+        self.assertIn("unable to write audit file", str(cm.exception))
+
+    def create_auditor(self, path=None, **kwargs):
+        if path is None:
+            path = os.path.join(self.temp_dir.name, "audit.txt")
+        index = ProductIndex([
+            Product("Sony_Cyber-shot_DSC-W310", "Sony", "DSC-W310", "Cyber-shot", None),
+            Product("Canon_PowerShot_A1200", "Canon", "A1200", "PowerShot", None),
+        ])
+        return MatchAuditor(path, index, **kwargs)
+
+    def read_records(self, auditor):
+        with open(auditor.path, "rt", encoding="utf8") as f:
+            return [json.loads(line) for line in f]
+
+
+class Test_MatchStats(unittest.TestCase):
+
+    def test_add_dedup_cache_info(self):
+        x = MatchStats()
+        x.add_dedup_cache_info((1, 2, 0.5), (4, 4, 1.5))
+        x.add_dedup_cache_info(None, None)
+        self.assertEqual(x.duplicate_line_count, 3)
+        self.assertEqual(x.distinct_line_count, 2)
+        self.assertEqual(x.distinct_parse_seconds, 1.0)
+        self.assertEqual(x.duplicate_line_ratio(), 0.6)
+        self.assertEqual(x.estimated_dedup_saved_seconds(), 1.5)
+
+    def test_add_duplicate(self):
+        x = MatchStats(collect_histogram=True)
+        x.add_duplicate((3, 2, 1, 0, 0))
+        x.add_duplicate((None, 2, 0, 1, 0))
+        x.add_duplicate((None, 0, 0, 0, 1))
+        self.assertEqual(x.listing_count, 3)
+        self.assertEqual(x.duplicate_count, 3)
+        self.assertEqual(x.matched_count, 1)
+        self.assertEqual((x.resolved_count, x.ambiguous_count), (1, 1))
+        self.assertEqual(x.unknown_manufacturer_count, 1)
+        self.assertEqual(x.candidate_count, 4)
+        self.assertEqual(x.candidate_histogram, {2: 2})
+
+    def test_estimated_dedup_saved_seconds(self):
+        x = MatchStats()
+        (x.duplicate_count, x.distinct_count, x.distinct_match_seconds) = (6, 2, 1.0)
+        x.duplicate_seconds = 0.5
+        (x.duplicate_line_count, x.distinct_line_count, x.distinct_parse_seconds) = (2, 4, 2.0)
+        self.assertEqual(x.duplicate_ratio(), 0.75)
+        self.assertEqual(x.estimated_dedup_saved_seconds(), 3.5)
+
+    def test_duplicate_ratio_NoLines(self):
+        x = MatchStats()
+        self.assertEqual(x.duplicate_ratio(), 0.0)
+        self.assertEqual(x.duplicate_line_ratio(), 0.0)
+        self.assertEqual(x.estimated_dedup_saved_seconds(), 0.0)
+
+
+class Test_Metrics(unittest.TestCase):
+
+    def test_to_json_object(self):
+        x = Metrics()
+        x.add_time("match", 1.5)
+        x.add_time("match", 0.5)
+        x.increment("lines_read")
+        x.increment("lines_read", 2)
+        x.set_histogram("candidates_per_listing", {2: 1, 0: 3})
+        self.assertEqual(x.to_json_object(), {
+            "timers_seconds": {"match": 2.0},
+            "counters": {"lines_read": 3},
+            "histograms": {"candidates_per_listing": {"0": 3, "2": 1}},
+        })
+
+    def test_merge(self):
+        x = Metrics()
+        x.add_time("parse", 1.0)
+        x.increment("a")
+        other = Metrics()
+        other.add_time("parse", 2.0)
+        other.increment("a", 4)
+        other.set_histogram("h", {1: 1})
+        x.merge(other)
+        self.assertEqual(x.timers["parse"], 3.0)
+        self.assertEqual(x.counters["a"], 5)
+        self.assertEqual(x.histograms["h"], {1: 1})
+
+    def test_timer(self):
+        x = Metrics()
+        with x.timer("index"):
+            pass
+        self.assertIn("index", x.timers)
+
+    def test_NullMetrics(self):
+        x = NullMetrics()
+        x.add_time("match", 1.0)
+        x.increment("lines_read")
+        with x.timer("index"):
+            pass
+        self.assertFalse(x.enabled)
+        self.assertEqual(x.to_json_object(), {
+            "timers_seconds": {},
+            "counters": {},
+            "histograms": {},
+        })
+
+
+class Test_timed_iter(unittest.TestCase):
+
+    def test_ItemsAndTimer(self):
+        metrics = Metrics()
+        actual = list(timed_iter([1, 2, 3], metrics, "read"))
+        self.assertEqual(actual, [1, 2, 3])
+        self.assertIn("read", metrics.timers)
+
+
+class Test_ProductListingMatcher(TempFileTestCase):
+
+    def test_run(self):
+        app = self.create_application()
+        app.run()
+        with open(app.output_path, "rt", encoding="utf8") as f:
+            actual = [json.loads(line) for line in f]
+        self.assertEqual(actual, [
+            {"product_name": "Sony_Cyber-shot_DSC-W310", "listings": [
+                {"title": "Sony DSC-W310", "manufacturer": "Sony", "currency": "USD",
+                 "price": "99.99"},
+            ]},
+            {"product_name": "Canon_PowerShot_A1200", "listings": [
+                {"title": "Canon PowerShot A1200 (Black)", "manufacturer": "Canon Canada",
+                 "currency": "CAD", "price": "129.99"},
+            ]},
+        ])
+
+    def test_run_StatsJson(self):
+        stats_json_path = os.path.join(self.temp_dir.name, "stats.json")
+        app = self.create_application(stats_json_path=stats_json_path)
+        app.run()
+        with open(stats_json_path, "rt", encoding="utf8") as f:
+            actual = json.load(f)
+        self.assertEqual(actual["counters"]["lines_read"], 4)
+        self.assertEqual(actual["counters"]["parse_failures"], 1)
+        self.assertEqual(actual["counters"]["listings_matched"], 2)
+        self.assertEqual(actual["counters"]["rejected_unknown_manufacturer"], 1)
+        self.assertEqual(actual["histograms"]["candidates_per_listing"], {"1": 2})
+        for name in ["load_products", "index", "read", "parse", "match", "output"]:
+            self.assertIn(name, actual["timers_seconds"])
+
+    def test_run_ProgressInterval(self):
+        app = self.create_application(progress_interval=1e-9)
+        with unittest.mock.patch.object(ProgressReporter, "CHECK_INTERVAL", 1):
+            with self.assertLogs(app.logger) as cm:
+                app.run()
+        progress_lines = [line for line in cm.output if "Progress: " in line]
+        self.assertEqual(len(progress_lines), 4)
+
+    def test_run_IndexCache(self):
+        index_cache_dir = os.path.join(self.temp_dir.name, "cache")
+        app = self.create_application(index_cache_dir=index_cache_dir)
+        app.run()
+        with open(app.output_path, "rt", encoding="utf8") as f:
+            expected = f.read()
+        self.assertEqual(len(os.listdir(index_cache_dir)), 1)
+
+        with unittest.mock.patch.object(ProductListingMatcher, "load_products") as mock:
+            app.run()
+        mock.assert_not_called()
+        with open(app.output_path, "rt", encoding="utf8") as f:
+            self.assertEqual(f.read(), expected)
+
+    def test_run_StateFile(self):
+        state_path = os.path.join(self.temp_dir.name, "state.json")
+        app = self.create_application(state_path=state_path)
+        app.run()
+        self.assertEqual(self.read_product_names(app.output_path),
+                         ["Sony_Cyber-shot_DSC-W310", "Canon_PowerShot_A1200"])
+
+        with open(app.listings_path, "at", encoding="utf8") as f:
+            print('{"title":"Sony Cyber-shot DSC-W310","manufacturer":"Sony",'
+                  '"currency":"USD","price":"89.99"}', file=f)
+            f.write('{"title":"Canon PowerShot A1200","manufa')
+        app.run()
+        self.assertEqual(self.read_product_names(app.output_path),
+                         ["Sony_Cyber-shot_DSC-W310"])
+
+        with open(app.listings_path, "at", encoding="utf8") as f:
+            print('cturer":"Canon","currency":"CAD","price":"119.99"}', file=f)
+        app.run()
+        self.assertEqual(self.read_product_names(app.output_path), ["Canon_PowerShot_A1200"])
+
+        state = IncrementalState.load(state_path)
+        self.assertEqual(state.listings_offset, os.path.getsize(app.listings_path))
+        self.assertEqual(state.listings_line_count, 6)
+        self.assertEqual(state.match_counts,
+                         {"Sony_Cyber-shot_DSC-W310": 2, "Canon_PowerShot_A1200": 2})
+
+        app.run()
+        self.assertEqual(self.read_product_names(app.output_path), [])
+
+    def test_run_StateFile_Jobs(self):
+        state_path = os.path.join(self.temp_dir.name, "state.json")
+        app = self.create_application(state_path=state_path, jobs=2)
+        app.run()
+        with open(app.listings_path, "at", encoding="utf8") as f:
+            print('{"title":"Sony Cyber-shot DSC-W310","manufacturer":"Sony",'
+                  '"currency":"USD","price":"89.99"}', file=f)
+            f.write('{"title":"Canon PowerShot A1200","manufa')
+        app.run()
+        self.assertEqual(self.read_product_names(app.output_path),
+                         ["Sony_Cyber-shot_DSC-W310"])
+        state = IncrementalState.load(state_path)
+        self.assertEqual(state.listings_line_count, 5)
+        self.assertEqual(state.match_counts,
+                         {"Sony_Cyber-shot_DSC-W310": 2, "Canon_PowerShot_A1200": 1})
+
+    def test_run_StateFile_ProductsChanged(self):
+        state_path = os.path.join(self.temp_dir.name, "state.json")
+        app = self.create_application(state_path=state_path)
+        app.run()
+        with open(app.products_path, "at", encoding="utf8") as f:
+            print('{"product_name":"Nikon_D90","manufacturer":"Nikon","model":"D90",'
+                  '"announced-date":"2008-08-26T20:00:00.000-04:00"}', file=f)
+        with self.assertLogs(app.logger) as cm:
+            app.run()
+        self.assertTrue(any("products file has changed" in line for line in cm.output))
+        self.assertEqual(self.read_product_names(app.output_path),
+                         ["Sony_Cyber-shot_DSC-W310", "Canon_PowerShot_A1200", "Nikon_D90"])
+        self.assertEqual(IncrementalState.load(state_path).match_counts["Nikon_D90"], 1)
+
+    def test_run_StateFile_Invalid(self):
+        state_path = self.create_file(["not json"], name="state.json")
+        app = self.create_application(state_path=state_path)
+        with self.assertRaises(app.Error):
+            app.run()
+
+    def test_run_StateFile_Compressed(self):
+        state_path = os.path.join(self.temp_dir.name, "state.json")
+        app = self.create_application(state_path=state_path)
+        app.listings_path = self.compress_file(app.listings_path)
+        with self.assertRaises(app.Error):
+            app.run()
+
+    def test_run_Compressed(self):
+        app = self.create_application()
+        app.run()
+        with open(app.output_path, "rt", encoding="utf8") as f:
+            expected = f.read()
+        for jobs in (1, 2):
+            with self.subTest(jobs=jobs):
+                app = self.create_application(jobs=jobs)
+                app.products_path = self.compress_file(app.products_path)
+                app.listings_path = self.compress_file(app.listings_path)
+                app.run()
+                with open(app.output_path, "rt", encoding="utf8") as f:
+                    self.assertEqual(f.read(), expected)
+
+    @staticmethod
+    def compress_file(path):
+        with open(path, "rb") as src, gzip.open(path + ".gz", "wb") as dst:
+            dst.write(src.read())
+        return path + ".gz"
+
+    @staticmethod
+    def read_product_names(path):
+        with open(path, "rt", encoding="utf8") as f:
+            return [json.loads(line)["product_name"] for line in f]
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_run_PriceFilter(self):
+        stats_json_path = os.path.join(self.temp_dir.name, "stats.json")
+        app = self.create_application(price_filter_ratio=0.5, stats_json_path=stats_json_path)
+        with open(app.listings_path, "at", encoding="utf8") as f:
+            print('{"title":"Battery for Sony DSC-W310","manufacturer":"Sony",'
+                  '"currency":"USD","price":"9.99"}', file=f)
+            print('{"title":"Sony Cyber-shot DSC-W310","manufacturer":"Sony",'
+                  '"currency":"USD","price":"89.99"}', file=f)
+        app.run()
+        with open(app.output_path, "rt", encoding="utf8") as f:
+            actual = [[listing["title"] for listing in json.loads(line)["listings"]]
+                      for line in f]
+        self.assertEqual(actual, [
+            ["Sony DSC-W310", "Sony Cyber-shot DSC-W310"],
+            ["Canon PowerShot A1200 (Black)"],
+        ])
+        with open(stats_json_path, "rt", encoding="utf8") as f:
+            self.assertEqual(json.load(f)["counters"]["rejected_price_outlier"], 1)
+
+    def test_run_AutomatonEngine(self):
+        app = self.create_application()
+        app.run()
+        with open(app.output_path, "rt", encoding="utf8") as f:
+            expected = f.read()
+        index_cache_dir = os.path.join(self.temp_dir.name, "cache")
+        for jobs in (1, 2):
+            with self.subTest(jobs=jobs):
+                app = self.create_application(engine="automaton", jobs=jobs,
+                                              index_cache_dir=index_cache_dir)
+                app.run()
+                with open(app.output_path, "rt", encoding="utf8") as f:
+                    self.assertEqual(f.read(), expected)
+
+    def test_run_Dedup(self):
+        app = self.create_application()
+        self.duplicate_listings(app.listings_path)
+        app.run()
+        with open(app.output_path, "rt", encoding="utf8") as f:
+            expected = f.read()
+        for kwargs in [{"jobs": 1}, {"jobs": 2}, {"jobs": 1, "dedup_parse": True},
+                       {"jobs": 2, "dedup_parse": True}, {"jobs": 1, "columnar": True},
+                       {"jobs": 1, "pipeline_queue_size": 1}]:
+            with self.subTest(**kwargs):
+                stats_json_path = os.path.join(self.temp_dir.name, "stats.json")
+                app = self.create_application(dedup_cache_size=100,
+                                              stats_json_path=stats_json_path, **kwargs)
+                self.duplicate_listings(app.listings_path)
+                app.run()
+                with open(app.output_path, "rt", encoding="utf8") as f:
+                    self.assertEqual(f.read(), expected)
+                with open(stats_json_path, "rt", encoding="utf8") as f:
+                    counters = json.load(f)["counters"]
+                self.assertEqual(counters["listings_read"], 7)
+                self.assertEqual(counters["listings_matched"], 5)
+                self.assertEqual(counters["parse_failures"], 2)
+                if kwargs["jobs"] == 1:
+                    self.assertEqual(counters["dedup_duplicate_listings"], 4)
+                    self.assertEqual(counters["dedup_distinct_listings"], 3)
+                    if kwargs.get("dedup_parse"):
+                        self.assertEqual(counters["dedup_duplicate_lines"], 3)
+                        self.assertEqual(counters["dedup_distinct_lines"], 6)
+                    else:
+                        self.assertNotIn("dedup_duplicate_lines", counters)
+
+    def test_run_Columnar(self):
+        app = self.create_application()
+        app.run()
+        with open(app.output_path, "rt", encoding="utf8") as f:
+            expected = f.read()
+        for kwargs in [{"jobs": 1}, {"jobs": 2}, {"pipeline_queue_size": 1},
+                       {"jobs": 2, "price_filter_ratio": 0.25}]:
+            if "price_filter_ratio" in kwargs and numpy is None:
+                continue
+            with self.subTest(**kwargs):
+                stats_json_path = os.path.join(self.temp_dir.name, "stats.json")
+                app = self.create_application(columnar=True, stats_json_path=stats_json_path,
+                                              **kwargs)
+                app.run()
+                with open(app.output_path, "rt", encoding="utf8") as f:
+                    self.assertEqual(f.read(), expected)
+                with open(stats_json_path, "rt", encoding="utf8") as f:
+                    counters = json.load(f)["counters"]
+                self.assertEqual(counters["listings_matched"], 2)
+                self.assertEqual(counters["parse_failures"], 1)
+
+    def test_run_AuditFile(self):
+        app = self.create_application()
+        app.run()
+        with open(app.output_path, "rt", encoding="utf8") as f:
+            expected = f.read()
+        audit_path = os.path.join(self.temp_dir.name, "audit.txt")
+        stats_json_path = os.path.join(self.temp_dir.name, "stats.json")
+        app = self.create_application(audit_path=audit_path, stats_json_path=stats_json_path,
+                                      jobs=2, columnar=True)
+        app.run()
+        with open(app.output_path, "rt", encoding="utf8") as f:
+            self.assertEqual(f.read(), expected)
+        with open(audit_path, "rt", encoding="utf8") as f:
+            actual = [(record["line_number"], record["decision"], record["product"])
+                      for record in map(json.loads, f)]
+        self.assertEqual(actual, [
+            (1, "single_candidate", "Sony_Cyber-shot_DSC-W310"),
+            (2, "single_candidate", "Canon_PowerShot_A1200"),
+            (3, "unknown_manufacturer", None),
+        ])
+        with open(stats_json_path, "rt", encoding="utf8") as f:
+            counters = json.load(f)["counters"]
+        self.assertEqual(counters["listings_audited"], 3)
+        self.assertEqual(counters["listings_matched"], 2)
+        self.assertEqual(counters["parse_failures"], 1)
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_run_AuditFile_PriceFilter(self):
+        audit_path = os.path.join(self.temp_dir.name, "audit.txt")
+        app = self.create_application(audit_path=audit_path,
+                                      audit_products=["Sony_Cyber-shot_DSC-W310"],
+                                      price_filter_ratio=0.5)
+        with open(app.listings_path, "at", encoding="utf8") as f:
+            print('{"title":"Battery for Sony DSC-W310","manufacturer":"Sony",'
+                  '"currency":"USD","price":"9.99"}', file=f)
+        app.run()
+        with open(app.output_path, "rt", encoding="utf8") as f:
+            actual = [[listing["title"] for listing in json.loads(line)["listings"]]
+                      for line in f]
+        self.assertEqual(actual, [["Sony DSC-W310"], ["Canon PowerShot A1200 (Black)"]])
+        with open(audit_path, "rt", encoding="utf8") as f:
+            actual = [(record["line_number"], record["price_filter"]["rejected"])
+                      for record in map(json.loads, f)]
+        self.assertEqual(actual, [(1, False), (5, True)])
+
+    def test_run_AuditFile_WriteError(self):
+        audit_path = os.path.join(self.temp_dir.name, "audit.txt")
+        app = self.create_application(audit_path=audit_path)
+        close = MatchAuditor.close
+
+        def close_failing(auditor):
+            close(auditor)
+            raise MatchAuditor.Error("disk full")
+
+        with unittest.mock.patch.object(MatchAuditor, "close", close_failing):
+            with self.assertRaises(app.Error) as cm:
+                app.run()
+        self.assertEqual(str(cm.exception), "disk full")
+
+    def test_run_Pipeline(self):
+        app = self.create_application()
+        app.run()
+        with open(app.output_path, "rt", encoding="utf8") as f:
+            expected = f.read()
+        stats_json_path = os.path.join(self.temp_dir.name, "stats.json")
+        app = self.create_application(pipeline_queue_size=1, stats_json_path=stats_json_path)
+        app.run()
+        with open(app.output_path, "rt", encoding="utf8") as f:
+            self.assertEqual(f.read(), expected)
+        with open(stats_json_path, "rt", encoding="utf8") as f:
+            stats = json.load(f)
+        self.assertEqual(stats["counters"]["listings_matched"], 2)
+        self.assertEqual(stats["counters"]["parse_failures"], 1)
+        for name in ("read", "parse", "match", "write"):
+            self.assertIn("pipeline_{}_input_stall".format(name), stats["timers_seconds"])
+        self.assertIn("match", stats["timers_seconds"])
+
+    @staticmethod
+    def duplicate_listings(path):
+        # repeats the listings, then adds one differing only in the case and spacing of its title
+        with open(path, "rt", encoding="utf8") as f:
+            lines = f.readlines()
+        with open(path, "wt", encoding="utf8") as f:
+            f.writelines(lines * 2)
+            print('{"title":"SONY  dsc-w310","manufacturer":"Sony","currency":"USD",'
+                  '"price":"99.99"}', file=f)
+
+    def test_run_CProfile(self):
+        self.assert_profile_written(CProfileProfiler, jobs=1)
+
+    def test_run_CProfile_Jobs(self):
+        self.assert_profile_written(CProfileProfiler, jobs=2)
+
+    @unittest.skipUnless(SamplingProfiler.is_supported(), "sampling profiler not supported")
+    def test_run_SamplingProfiler(self):
+        self.assert_profile_written(SamplingProfiler, jobs=1)
+
+    @unittest.skipUnless(SamplingProfiler.is_supported(), "sampling profiler not supported")
+    def test_run_SamplingProfiler_Jobs(self):
+        self.assert_profile_written(SamplingProfiler, jobs=2)
+
+    def assert_profile_written(self, profiler_class, jobs):
+        profile_path = os.path.join(self.temp_dir.name, "test.prof")
+        logger = self.create_logger()
+        profiler = profiler_class(profile_path, logger=logger)
+        app = self.create_application(profiler=profiler, jobs=jobs)
+        with self.assertLogs(logger) as cm:
+            app.run()
+        self.assertTrue(os.path.exists(profile_path))
+        self.assertTrue(any("Wrote profile" in line for line in cm.output))
+        worker_profile_paths = glob.glob(profile_path + ".worker-*")
+        self.assertEqual(len(worker_profile_paths), 0 if jobs == 1 else jobs)
+
+    def create_application(self, **kwargs):
+        products_path = self.create_file([
+            '{"product_name":"Sony_Cyber-shot_DSC-W310","manufacturer":"Sony",'
+            '"model":"DSC-W310","family":"Cyber-shot",'
+            '"announced-date":"2010-01-06T19:00:00.000-05:00"}',
+            '{"product_name":"Canon_PowerShot_A1200","manufacturer":"Canon",'
+            '"model":"A1200","family":"PowerShot",'
+            '"announced-date":"2011-01-04T19:00:00.000-05:00"}',
+        ], name="products.txt")
+        listings_path = self.create_file([
+            '{"title":"Sony DSC-W310","manufacturer":"Sony","currency":"USD","price":"99.99"}',
+            '{"title":"Canon PowerShot A1200 (Black)","manufacturer":"Canon Canada",'
+            '"currency":"CAD","price":"129.99"}',
+            '{"title":"Nikon D90","manufacturer":"Nikon","currency":"CAD","price":"899.99"}',
+            'not json',
+        ], name="listings.txt")
+        output_path = os.path.join(self.temp_dir.name, "results.txt")
+        return ProductListingMatcher(
+            products_path, listings_path, self.create_logger(), output_path=output_path,
+            **kwargs)
+
+
+class Test_ImportTime(TempFileTestCase):
+    """
+    Runs the program in a subprocess with python -X importtime, to keep small runs starting
+    quickly: the modules only needed by some features must not be imported by a plain run, and
+    the imports must fit in a budget, which is generous since machines differ a lot.
+    """
+
+    LAZY_MODULES = frozenset(["asyncio", "numpy", "multiprocessing", "cProfile", "pstats",
+                              "hashlib", "pickle", "gzip"])
+    # the imports took about 75 ms when this was written
+    IMPORT_TIME_BUDGET_SECONDS = 0.5
+
+    def test_Help(self):
+        self.assert_imports_within_budget(["--help"])
+
+    def test_SmallBatch(self):
+        products_path = self.create_file([
+            '{"product_name":"Sony_Cyber-shot_DSC-W310","manufacturer":"Sony",'
+            '"model":"DSC-W310","family":"Cyber-shot",'
+            '"announced-date":"2010-01-06T19:00:00.000-05:00"}',
+        ], name="products.txt")
+        listings_path = self.create_file([
+            '{"title":"Sony DSC-W310","manufacturer":"Sony","currency":"USD","price":"99.99"}',
+        ], name="listings.txt")
+        output_path = os.path.join(self.temp_dir.name, "results.txt")
+        self.assert_imports_within_budget(["-p", products_path, "-l", listings_path,
+                                           "-o", output_path])
+        self.assertTrue(os.path.exists(output_path))
+
+    def assert_imports_within_budget(self, args):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ProductListingMatcher.py")
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", path] + args,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True,
+            check=True)
+        # e.g. "import time:       409 |       2776 | json", with the modules imported by a
+        # module indented below it
+        module_names = set()
+        total_microseconds = 0
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:") or "[us]" in line:
+                continue
+            (_, cumulative_microseconds, name) = line[len("import time:"):].split("|")
+            module_names.add(name.strip())
+            if not name[1:].startswith(" "):
+                total_microseconds += int(cumulative_microseconds)
+        self.assertIn("json", module_names)
+        self.assertEqual(self.LAZY_MODULES & module_names, set())
+        self.assertLess(total_microseconds / 1e6, self.IMPORT_TIME_BUDGET_SECONDS)
+
+
 if __name__ == "__main__":
     unittest.main()